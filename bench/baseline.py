@@ -0,0 +1,43 @@
+"""
+Load nds.py as it was at an earlier commit, as a separate module, so
+benchmarks can compare against the old code.
+"""
+import os
+import subprocess
+import types
+
+import idastub
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def rootCommit():
+    """
+    Return the hash of the repository's first commit.
+    """
+    return subprocess.check_output(['git', 'rev-list', '--max-parents=0', 'HEAD'],
+                                   cwd=REPO, text=True).split()[0]
+
+
+def loadNds(rev=None, patches=()):
+    """
+    Return nds.py at commit rev (default: the first commit) as a
+    module named nds_<rev>, after applying patches, a list of (old,
+    new) source replacements.
+    """
+    if rev is None:
+        rev = rootCommit()
+    source = subprocess.check_output(['git', 'show', rev + ':nds.py'], cwd=REPO, text=True)
+    # The original file indents with a mix of tabs and spaces, which
+    # Python 3 refuses to compile
+    source = source.expandtabs(8)
+    for old, new in patches:
+        if old not in source:
+            raise ValueError('Patch does not apply: ' + repr(old))
+        source = source.replace(old, new)
+
+    idastub.install()
+    module = types.ModuleType('nds_' + rev[:7])
+    module.__file__ = 'nds.py@' + rev[:7]
+    exec(compile(source, module.__file__, 'exec'), module.__dict__)
+    return module
@@ -0,0 +1,85 @@
+"""
+Time crc16() over a 16 KiB secure area and over a whole ROM-sized
+buffer, against a bit-at-a-time loop and a byte-at-a-time table loop,
+and time how quickly probeHeader() rejects a truncated dump.
+
+    python bench/bench_crc.py [--rom-size BYTES]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import nds
+from tests.reference import crc16Bitwise
+from tests.synthetic import makeRom
+
+
+def crc16ByteTable(data, crc=0xFFFF):
+    table = nds._CRC16_TABLE
+    for b in data:
+        crc = (crc >> 8) ^ table[(crc ^ b) & 0xFF]
+    return crc
+
+
+def best(func, data, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(data)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def report(label, size, elapsed):
+    print('  {:<26} {:9.2f} ms {:7.1f} MiB/s'.format(
+        label, elapsed * 1000, size / (1 << 20) / elapsed))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rom-size', type=lambda s: int(s, 0), default=32 << 20)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    # Build the halfword table up front, so it isn't counted below
+    start = time.perf_counter()
+    nds._getCrc16WordTable()
+    print('Halfword table built in {:.1f} ms'.format((time.perf_counter() - start) * 1000))
+
+    secureArea = os.urandom(nds.SECURE_AREA_LEN)
+    expected = crc16Bitwise(secureArea)
+    print('16 KiB secure area:')
+    for label, func in (('bit at a time', crc16Bitwise),
+                        ('byte table', crc16ByteTable),
+                        ('crc16()', nds.crc16)):
+        elapsed, crc = best(func, secureArea, args.repeat)
+        assert crc == expected, label
+        report(label, len(secureArea), elapsed)
+
+    rom = os.urandom(args.rom_size)
+    print('{} MiB ROM:'.format(args.rom_size >> 20))
+    byteTable, expected = best(crc16ByteTable, rom, 1)
+    report('byte table', len(rom), byteTable)
+    elapsed, crc = best(nds.crc16, rom, max(1, args.repeat // 2))
+    assert crc == expected
+    report('crc16()', len(rom), elapsed)
+
+    # A dump cut off before the end of its files: only the header and
+    # the file size are needed to reject it
+    data = bytes(makeRom(fileCount=200).save())
+    truncated = data[:len(data) // 2]
+    times = []
+    for _ in range(1000):
+        start = time.perf_counter()
+        header = nds.probeHeader(truncated[:nds.HEADER_LEN], len(truncated))
+        times.append(time.perf_counter() - start)
+    assert header is None
+    assert nds.probeHeader(data[:nds.HEADER_LEN], len(data)) is not None
+    print('probeHeader() rejects a truncated dump in {:.1f} us'.format(min(times) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""
+Time decompressBlz(), decompressLz10() and decompressLz11() on a few
+MiB of compressible, code-like data, against straightforward
+byte-at-a-time decompressors. The inputs are made with the reference
+compressors in tests/reference.py, which takes a few seconds each.
+
+    python bench/bench_decompress.py [--size BYTES]
+"""
+import argparse
+import os
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import nds
+from tests.reference import compressBlz, compressLz10, compressLz11, sampleData
+
+
+def blzPerByte(data):
+    encLenAndHeaderLen, extraLen = struct.unpack_from('<II', data, len(data) - 8)
+    headerLen = encLenAndHeaderLen >> 24
+    end = len(data) - (encLenAndHeaderLen & 0xFFFFFF)
+    out = bytearray(len(data) + extraLen)
+    out[:end] = data[:end]
+    src = len(data) - headerLen
+    dst = len(out)
+    while src > end:
+        src -= 1
+        flags = data[src]
+        for _ in range(8):
+            if src <= end:
+                break
+            if flags & 0x80:
+                src -= 2
+                info = data[src + 1] << 8 | data[src]
+                disp = (info & 0xFFF) + 3
+                for _ in range((info >> 12) + 3):
+                    dst -= 1
+                    out[dst] = out[dst + disp]
+            else:
+                src -= 1
+                dst -= 1
+                out[dst] = data[src]
+            flags <<= 1
+    return out
+
+
+def lzPerByte(data):
+    size = struct.unpack_from('<I', data)[0] >> 8
+    lz11 = data[0] == 0x11
+    out = bytearray(size)
+    src, dst = 4, 0
+    while dst < size:
+        flags = data[src]
+        src += 1
+        for _ in range(8):
+            if dst >= size:
+                break
+            if flags & 0x80:
+                b0 = data[src]
+                if not lz11:
+                    length = (b0 >> 4) + 3
+                    src += 1
+                elif b0 >> 4 == 0:
+                    length = ((b0 & 0xF) << 4 | data[src + 1] >> 4) + 0x11
+                    src += 2
+                elif b0 >> 4 == 1:
+                    length = ((b0 & 0xF) << 12 | data[src + 1] << 4 | data[src + 2] >> 4) + 0x111
+                    src += 3
+                else:
+                    length = (b0 >> 4) + 1
+                    src += 1
+                disp = ((data[src - 1] & 0xF) << 8 | data[src]) + 1
+                src += 1
+                for _ in range(length):
+                    out[dst] = out[dst - disp]
+                    dst += 1
+            else:
+                out[dst] = data[src]
+                src += 1
+                dst += 1
+            flags <<= 1
+    return out
+
+
+def best(func, data, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(data)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size', type=lambda s: int(s, 0), default=4 << 20)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    raw = sampleData(args.size)
+    mib = len(raw) / (1 << 20)
+    print('{:.1f} MiB of sample data'.format(mib))
+    print('  {:<6} {:>6} {:>18} {:>18}'.format('', 'ratio', 'byte-at-a-time', 'nds.py'))
+    for name, compress, decompress in (
+            ('BLZ', compressBlz, nds.decompressBlz),
+            ('LZ10', compressLz10, nds.decompressLz10),
+            ('LZ11', compressLz11, nds.decompressLz11)):
+        compressed = compress(raw)
+        slow, slowOut = best(blzPerByte if name == 'BLZ' else lzPerByte, compressed, 1)
+        fast, fastOut = best(decompress, compressed, args.repeat)
+        assert slowOut == raw and fastOut == raw, name + ' round-trip failed'
+        print('  {:<6} {:6.2f} {:7.0f} ms {:4.1f} MiB/s {:7.0f} ms {:4.1f} MiB/s'.format(
+            name, len(compressed) / len(raw),
+            slow * 1000, mib / slow, fast * 1000, mib / fast))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+Time FNT load() and save() on a synthetic filename table, compared to
+the recursive versions from the first commit.
+
+The original save() rebinds nextFolderID inside a closure and raises
+UnboundLocalError, so it's timed with that one line fixed (a
+"nonlocal" added).
+
+    python bench/bench_fnt.py [--folders N] [--files-per-folder N] [--baseline REV]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import baseline
+import idastub
+idastub.install()
+
+import nds
+
+
+def makeTree(module, folders, filesPerFolder):
+    """
+    Build a root with folders // 25 top-level folders, each with 24
+    subfolders, and filesPerFolder files in every folder but the
+    root, using module's Folder class.
+    """
+    Folder = module.Folder
+    root = Folder()
+    fid = 0
+    for i in range(max(1, folders // 25)):
+        top = Folder(firstID=fid)
+        top.files = ['data_{:04d}.bin'.format(fid + j) for j in range(filesPerFolder)]
+        fid += filesPerFolder
+        for j in range(24):
+            sub = Folder(firstID=fid)
+            sub.files = ['entry_{:05d}.narc'.format(fid + k) for k in range(filesPerFolder)]
+            fid += filesPerFolder
+            top.folders.append(('sub{:02d}'.format(j), sub))
+        root.folders.append(('folder{:03d}'.format(i), top))
+    return root, fid
+
+
+def best(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--folders', type=int, default=1000)
+    parser.add_argument('--files-per-folder', type=int, default=61)
+    parser.add_argument('--baseline', default=None,
+                        help='commit to compare against (default: the first one)')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    # Fix the original save()'s closure bug so it can be timed at all
+    old = baseline.loadNds(args.baseline, [(
+        '        folderID = nextFolderID\n',
+        '        nonlocal nextFolderID\n        folderID = nextFolderID\n')])
+
+    newRoot, fileCount = makeTree(nds, args.folders, args.files_per_folder)
+    oldRoot, _ = makeTree(old, args.folders, args.files_per_folder)
+    print('FNT with {} files in {} folders'.format(fileCount, len(newRoot.walk()[0]) + 1))
+
+    oldSave, oldData = best(lambda: old.save(oldRoot), args.repeat)
+    newSave, newData = best(lambda: nds.save(newRoot), args.repeat)
+    assert bytes(oldData) == bytes(newData), 'save() output differs'
+    data = bytes(newData)
+    print('  {} bytes, identical output'.format(len(data)))
+
+    oldLoad, _ = best(lambda: old.load(data), args.repeat)
+    newLoad, _ = best(lambda: nds.load(data), args.repeat)
+    # Names are decoded when first looked at; time that separately
+    newLoadAll, _ = best(lambda: nds.load(data).walk(), args.repeat)
+
+    print('  {:<32} {:>8} {:>8}'.format('', 'old', 'new'))
+    print('  {:<32} {:7.1f}ms {:7.1f}ms'.format('save()', oldSave * 1000, newSave * 1000))
+    print('  {:<32} {:7.1f}ms {:7.1f}ms'.format('load()', oldLoad * 1000, newLoad * 1000))
+    print('  {:<32} {:>8} {:7.1f}ms'.format('load() + every path', '', newLoadAll * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+Time load_file() with the IDA API stubbed out (see idastub.py), and
+compare how the register segments are zero-filled: FillRange()'s
+single put_bytes() call per segment against the old loop of one
+PatchByte() call per byte.
+
+    python bench/bench_load_file.py [--files N] [--arm9-size BYTES]
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import idastub
+idastub.install()
+
+import nds
+from tests.reference import sampleData
+from tests.synthetic import makeRom
+
+
+def fillPerByte(startEA, endEA, value=0):
+    """
+    How load_file() used to fill register segments.
+    """
+    for i in range(startEA, endEA):
+        nds.idc.PatchByte(i, value)
+
+
+def timeFill(fill, segments, repeat):
+    best = None
+    for _ in range(repeat):
+        idastub.reset()
+        start = time.perf_counter()
+        for startEA, endEA, _ in segments:
+            fill(startEA, endEA, 0)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, idastub.totalCalls()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--files', type=int, default=1000)
+    parser.add_argument('--arm9-size', type=lambda s: int(s, 0), default=0x100000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    segments = nds.IO_SEGMENTS + nds.TWL_IO_SEGMENTS
+    size = sum(endEA - startEA for startEA, endEA, _ in segments)
+    print('Zero-filling {} register segments ({} bytes):'.format(len(segments), size))
+    for label, fill in (('PatchByte per byte', fillPerByte), ('FillRange', nds.FillRange)):
+        elapsed, count = timeFill(fill, segments, args.repeat)
+        print('  {:<20} {:>7} calls  {:8.2f} ms'.format(label, count, elapsed * 1000))
+
+    os.environ['NDS_CPU'] = 'both'
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'bench.nds')
+        makeRom(args.files, arm9=sampleData(args.arm9_size)).saveToFile(path)
+
+        times = []
+        for _ in range(args.repeat):
+            idastub.reset()
+            nds._romCache.clear()
+            li = idastub.LoaderInput(path)
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                nds.load_file(li, 0, 'Nintendo DS ROM')
+            times.append(time.perf_counter() - start)
+            li.close()
+        for rom in nds._romCache.values():
+            rom.close()
+        nds._romCache.clear()
+
+    print('load_file(), ARM9 and ARM7, {} KiB ARM9, {} files:'.format(
+        args.arm9_size // 1024, args.files))
+    # The first load also builds and caches the analysis plans
+    print('  {} IDA calls; {:.2f} ms first load, {:.2f} ms reloading'.format(
+        idastub.totalCalls(), times[0] * 1000, min(times[1:] or times) * 1000))
+    for name, count in idastub.calls.most_common(5):
+        print('    {:<28} {}'.format(name, count))
+
+
+if __name__ == '__main__':
+    main()
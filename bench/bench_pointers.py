@@ -0,0 +1,103 @@
+"""
+Time the pointer scan that seeds IDA's analysis on an 8 MiB code
+image: findPointers() with and without NumPy, findSeeds(), and
+SeedAnalysis() queueing the results with the IDA API stubbed out
+(see idastub.py).
+
+    python bench/bench_pointers.py [--size BYTES]
+"""
+import argparse
+import contextlib
+import io
+import os
+import random
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import idastub
+idastub.install()
+
+import nds
+
+RAM_ADDRESS = 0x02000000
+
+
+def makeImage(size, seed=0):
+    """
+    Make a code-like image: random words, with about one word in 80
+    a pointer into the image. A quarter of those are Thumb pointers
+    to a PUSH instruction.
+    """
+    rng = random.Random(seed)
+    image = bytearray(rng.getrandbits(8) for _ in range(size))
+    for off in range(0, size, 4):
+        # Keep random words from looking like pointers to the image
+        if image[off + 3] == 0x02:
+            image[off + 3] = 0xE5
+    for off in range(0, size - 4, 320):
+        target = RAM_ADDRESS + (rng.randrange(size // 2) * 2 & ~3)
+        if rng.random() < 0.25:
+            image[target - RAM_ADDRESS + 1] = 0xB5
+            target |= 1
+        struct.pack_into('<I', image, off, target)
+    return bytes(image)
+
+
+def best(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size', type=lambda s: int(s, 0), default=8 << 20)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    image = makeImage(args.size)
+    ranges = [(RAM_ADDRESS, RAM_ADDRESS + len(image))]
+    sections = [nds.CodeSection('ARM9', RAM_ADDRESS, image, 0)]
+    print('{} MiB image:'.format(len(image) >> 20))
+
+    numpy = nds.numpy
+    results = {}
+    for label, module in (('NumPy', numpy), ('pure Python', None)):
+        if label == 'NumPy' and numpy is None:
+            print('  NumPy is not installed')
+            continue
+        nds.numpy = module
+        try:
+            elapsed, results[label] = best(
+                lambda: nds.findPointers(image, RAM_ADDRESS, ranges),
+                args.repeat if module is not None else 1)
+        finally:
+            nds.numpy = numpy
+        print('  findPointers(), {:<12} {:8.1f} ms'.format(label + ':', elapsed * 1000))
+    if len(results) == 2:
+        assert results['NumPy'] == results['pure Python']
+
+    elapsed, (seeds, thumbFunctions) = best(lambda: nds.findSeeds(sections), args.repeat)
+    print('  findSeeds():               {:8.1f} ms ({} pointers, {} Thumb functions)'.format(
+        elapsed * 1000, len(seeds), len(thumbFunctions)))
+
+    plan = nds.AnalysisPlan()
+    plan.refs = seeds
+    plan.thumbFunctions = thumbFunctions
+    def seed():
+        idastub.reset()
+        with contextlib.redirect_stdout(io.StringIO()):
+            nds.SeedAnalysis(plan, sections)
+    elapsed, _ = best(seed, args.repeat)
+    print('  SeedAnalysis():            {:8.1f} ms ({} IDA calls)'.format(
+        elapsed * 1000, idastub.totalCalls()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,300 @@
+"""
+Stand-ins for the IDA modules nds.py uses, so that the loader hooks
+can be run and timed outside IDA. Call install() before importing
+nds. The stubs keep just enough state for the loader to work
+(segments, names, comments, netnodes and a sparse byte store) and
+count every call made, since the number of database calls is what
+dominates load time in IDA itself.
+"""
+import collections
+import os
+import sys
+import types
+
+
+# Number of calls made to each stubbed function, by "module.name"
+calls = collections.Counter()
+
+PAGE_SIZE = 0x1000
+
+
+class Segment:
+    def __init__(self, startEA, endEA):
+        self.start_ea = startEA
+        self.end_ea = endEA
+
+
+class Database:
+    """
+    The state of the fake database.
+    """
+    def __init__(self):
+        self.segments = []
+        self.segmentNames = {}
+        self.names = {}
+        self.comments = {}
+        # Data items, as ea -> (IDA flags, size)
+        self.items = {}
+        self.netnodes = {}
+        self.pages = {}
+
+
+    def write(self, ea, data):
+        """
+        Store bytes at ea, a page at a time.
+        """
+        data = memoryview(data)
+        while data:
+            page = self.pages.get(ea // PAGE_SIZE)
+            if page is None:
+                page = self.pages[ea // PAGE_SIZE] = bytearray(PAGE_SIZE)
+            off = ea % PAGE_SIZE
+            chunk = min(len(data), PAGE_SIZE - off)
+            page[off : off+chunk] = data[:chunk]
+            ea += chunk
+            data = data[chunk:]
+
+
+    def read(self, ea, length):
+        out = bytearray()
+        while length:
+            page = self.pages.get(ea // PAGE_SIZE) or bytes(PAGE_SIZE)
+            off = ea % PAGE_SIZE
+            chunk = min(length, PAGE_SIZE - off)
+            out += page[off : off+chunk]
+            ea += chunk
+            length -= chunk
+        return bytes(out)
+
+
+db = Database()
+
+
+def reset():
+    """
+    Empty the database and the call counts.
+    """
+    global db
+    db = Database()
+    calls.clear()
+
+
+class LoaderInput:
+    """
+    A loader_input_t over a file on disk.
+    """
+    def __init__(self, path=None):
+        self._file = None
+        if path is not None:
+            self.open(path)
+
+
+    def open(self, path):
+        self._path = path
+        self._file = open(path, 'rb')
+        return True
+
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+    def filename(self):
+        return self._path
+
+
+    def seek(self, offset, whence=0):
+        return self._file.seek(offset, whence)
+
+
+    def tell(self):
+        return self._file.tell()
+
+
+    def read(self, size):
+        return self._file.read(size)
+
+
+    def size(self):
+        return os.fstat(self._file.fileno()).st_size
+
+
+    def file2base(self, pos, startEA, endEA, patchable):
+        calls['loader_input_t.file2base'] += 1
+        self._file.seek(pos)
+        db.write(startEA, self._file.read(endEA - startEA))
+        return 1
+
+
+class Netnode:
+    def __init__(self, name, namelen=0, create=False):
+        self._values = db.netnodes.setdefault(name, {})
+
+
+    def supset(self, index, value):
+        self._values[index] = value
+
+
+    def supval(self, index):
+        return self._values.get(index)
+
+
+def _addSeg(startEA, endEA, base, use32, align, comb):
+    db.segments.append(Segment(startEA, endEA))
+    db.segments.sort(key=lambda seg: seg.start_ea)
+    return 1
+
+
+def _getseg(ea):
+    for seg in db.segments:
+        if seg.start_ea <= ea < seg.end_ea:
+            return seg
+    return None
+
+
+def _getNextSeg(ea):
+    for seg in db.segments:
+        if seg.start_ea > ea:
+            return seg
+    return None
+
+
+def _getSegmByName(name):
+    for ea, segName in db.segmentNames.items():
+        if segName == name:
+            return _getseg(ea)
+    return None
+
+
+def _makeName(ea, name, flags=0):
+    db.names[ea] = name
+    return 1
+
+
+def _patchByte(ea, value):
+    db.write(ea, bytes([value]))
+    return 1
+
+
+def _noop(*args, **kwargs):
+    return 1
+
+
+FF_DATA = 0x400
+MS_CLS = 0x600
+DT_TYPE = 0xF0000000
+FF_BYTE = 0x00000000
+FF_WORD = 0x10000000
+FF_DWRD = 0x20000000
+
+
+def _makeData(dataType, size):
+    def make(ea):
+        db.items[ea] = (FF_DATA | dataType, size)
+        return 1
+    return make
+
+
+def _makeArray(ea, count):
+    flags, size = db.items.get(ea, (FF_DATA | FF_BYTE, 1))
+    db.items[ea] = (flags, size * count)
+    return 1
+
+
+FUNCTIONS = {
+    'idaapi': {
+        'get_plugin_options': lambda name: None,
+        'get_input_file_path': lambda: None,
+        'loader_input_t': LoaderInput,
+        'mem2base': lambda data, ea, fpos=-1: db.write(ea, data) or 1,
+        'set_processor_type': _noop,
+        'add_entry': _noop,
+        'ask_yn': lambda default, prompt: default,
+    },
+    'idc': {
+        'AddSeg': _addSeg,
+        'RenameSeg': lambda ea, name: db.segmentNames.__setitem__(ea, name),
+        'MakeNameEx': _makeName,
+        'Name': lambda ea: db.names.get(ea, ''),
+        'MakeRptCmt': lambda ea, comment: db.comments.__setitem__(ea, comment),
+        'PatchByte': _patchByte,
+        'MakeByte': _makeData(FF_BYTE, 1),
+        'MakeWord': _makeData(FF_WORD, 2),
+        'MakeDword': _makeData(FF_DWRD, 4),
+        'make_array': _makeArray,
+        'GetFlags': lambda ea: db.items.get(ea, (0, 1))[0],
+        'ItemSize': lambda ea: db.items.get(ea, (0, 1))[1],
+        'isData': lambda flags: (flags & MS_CLS) == FF_DATA,
+        'ExtLinA': _noop,
+        'SetReg': _noop,
+        'AutoMark': _noop,
+        'add_dref': _noop,
+    },
+    'ida_bytes': {
+        'put_bytes': lambda ea, data: db.write(ea, data),
+    },
+    'ida_netnode': {
+        'netnode': Netnode,
+    },
+    'ida_segment': {
+        'getseg': _getseg,
+        'get_next_seg': _getNextSeg,
+        'get_segm_by_name': _getSegmByName,
+        'set_selector': _noop,
+        'set_segment_cmt': _noop,
+    },
+}
+
+CONSTANTS = {
+    'idaapi': {
+        'saRelPara': 2,
+        'scPub': 2,
+        'SETPROC_LOADER': 1,
+        'SETPROC_LOADER_NON_FATAL': 2,
+    },
+    'idc': {
+        'SN_NOCHECK': 0,
+        'SN_NOWARN': 0x100,
+        'AU_PROC': 30,
+        'dr_O': 1,
+        'DT_TYPE': DT_TYPE,
+        'FF_BYTE': FF_BYTE,
+        'FF_WORD': FF_WORD,
+        'FF_DWRD': FF_DWRD,
+    },
+}
+
+
+def _counted(moduleName, name, func):
+    key = moduleName + '.' + name
+    def wrapper(*args, **kwargs):
+        calls[key] += 1
+        return func(*args, **kwargs)
+    return wrapper
+
+
+def install():
+    """
+    Put the stub modules into sys.modules, in place of the real IDA
+    ones.
+    """
+    for moduleName, functions in FUNCTIONS.items():
+        module = types.ModuleType(moduleName)
+        for name, func in functions.items():
+            if isinstance(func, type):
+                setattr(module, name, func)
+            else:
+                setattr(module, name, _counted(moduleName, name, func))
+        for name, value in CONSTANTS.get(moduleName, {}).items():
+            setattr(module, name, value)
+        sys.modules[moduleName] = module
+
+    idaapi = sys.modules['idaapi']
+    idaapi.cvar = types.SimpleNamespace(
+        batch=1, inf=types.SimpleNamespace(startCS=0, startIP=0, beginEA=0))
+
+
+def totalCalls():
+    return sum(calls.values())
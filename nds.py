@@ -1,10 +1,35 @@
+import array
+import bisect
+import collections
+import collections.abc
+import hashlib
+import io
+import itertools
 import math
+import mmap
+import os
+import re
 import struct
-import idaapi
-import idc
-import ida_bytes
-import ida_netnode
-import ida_segment
+import sys
+import zlib
+
+# The ROM parsing half of this module works without IDA, so it can
+# also be run as a standalone tool (python -m nds); only the loader
+# hooks need these
+try:
+    import idaapi
+    import idc
+    import ida_bytes
+    import ida_netnode
+    import ida_segment
+except ImportError:
+    idaapi = idc = ida_bytes = ida_netnode = ida_segment = None
+
+# Optional, to speed up scanning code for pointers
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 def shortBytesRepr(data, maxLen=None):
     """
@@ -33,12 +58,88 @@ def shortBytesRepr(data, maxLen=None):
     else:
         return final
 
+class _TrackedList(list):
+    """
+    A list that bumps Folder._generation whenever it's modified, so
+    that path indices built from it know they're out of date.
+    """
+    def _changed(self):
+        Folder._generation += 1
+
+
+    def __setitem__(self, key, value):
+        list.__setitem__(self, key, value)
+        self._changed()
+
+
+    def __delitem__(self, key):
+        list.__delitem__(self, key)
+        self._changed()
+
+
+    def __iadd__(self, other):
+        self._changed()
+        return list.__iadd__(self, other)
+
+
+    def __imul__(self, n):
+        self._changed()
+        return list.__imul__(self, n)
+
+
+    def append(self, value):
+        list.append(self, value)
+        self._changed()
+
+
+    def extend(self, values):
+        list.extend(self, values)
+        self._changed()
+
+
+    def insert(self, i, value):
+        list.insert(self, i, value)
+        self._changed()
+
+
+    def pop(self, *args):
+        self._changed()
+        return list.pop(self, *args)
+
+
+    def remove(self, value):
+        list.remove(self, value)
+        self._changed()
+
+
+    def clear(self):
+        list.clear(self)
+        self._changed()
+
+
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        self._changed()
+
+
+    def reverse(self):
+        list.reverse(self)
+        self._changed()
+
+
 class Folder:
     """
     A single folder within a filename table, or an entire filename
     table.
     """
+    # Incremented whenever any Folder's contents change. Path indices
+    # remember the generation they were built at and rebuild
+    # themselves if it has moved on.
+    _generation = 0
+
     def __init__(self, folders=None, files=None, firstID=0):
+        self._index = None
+        self._pendingFiles = self._pendingFolders = None
         if folders is not None:
             self.folders = folders
         else:
@@ -50,6 +151,93 @@ class Folder:
         self.firstID = firstID
 
 
+    # Folders created by load() keep their names as (offset, length)
+    # spans into the filename table until they're first accessed
+
+    @property
+    def folders(self):
+        if self._pendingFolders is not None:
+            fnt, spans = self._pendingFolders
+            self._folders = _TrackedList(
+                (str(fnt[off : off+len_], 'latin-1'), folder)
+                for off, len_, folder in spans)
+            self._pendingFolders = None
+        return self._folders
+
+    @folders.setter
+    def folders(self, value):
+        self._folders = _TrackedList(value)
+        self._pendingFolders = None
+        Folder._generation += 1
+
+
+    @property
+    def files(self):
+        if self._pendingFiles is not None:
+            fnt, spans = self._pendingFiles
+            self._files = _TrackedList(
+                str(fnt[off : off+len_], 'latin-1') for off, len_ in spans)
+            self._pendingFiles = None
+        return self._files
+
+    @files.setter
+    def files(self, value):
+        self._files = _TrackedList(value)
+        self._pendingFiles = None
+        Folder._generation += 1
+
+
+    @property
+    def firstID(self):
+        return self._firstID
+
+    @firstID.setter
+    def firstID(self, value):
+        self._firstID = value
+        Folder._generation += 1
+
+
+    def _pathIndex(self):
+        """
+        Return (path -> file ID, file ID -> path, path -> Folder)
+        dicts for everything in and below this folder, building them
+        if they don't exist yet or are out of date.
+        """
+        index = self._index
+        if index is not None and index[0] == Folder._generation:
+            return index[1:]
+
+        ids = {}
+        names = {}
+        subfolders = {}
+        stack = [('', self)]
+        while stack:
+            prefix, folder = stack.pop()
+            for i, fileName in enumerate(folder.files):
+                path = prefix + fileName
+                if path not in ids:
+                    ids[path] = folder.firstID + i
+                names.setdefault(folder.firstID + i, path)
+            for folderName, subfolder in reversed(folder.folders):
+                path = prefix + folderName
+                subfolders[path] = subfolder
+                stack.append((path + '/', subfolder))
+
+        self._index = (Folder._generation, ids, names, subfolders)
+        return ids, names, subfolders
+
+
+    def walk(self):
+        """
+        Return everything in and below this folder: a sorted list of
+        the paths of all subfolders, and a list of (path, file ID) for
+        all files, in file ID order. Paths are separated by "/"s. The
+        tree is walked iteratively, so deep ones are fine.
+        """
+        _, names, subfolders = self._pathIndex()
+        return sorted(subfolders), [(path, fid) for fid, path in sorted(names.items())]
+
+
     def __iter__(self):
         raise ValueError('Sorry, a Folder is not iterable.')
 
@@ -93,34 +281,7 @@ class Folder:
         Find the file ID for the given filename, or for the given file
         path (using "/" as the separator) relative to this folder.
         """
-
-        def findInFolder(requestedPath, searchFolder):
-            """
-            Attempt to find filename in the given folder.
-            pathSoFar is the path up through this point, as a list.
-            """
-            pathPart = requestedPath[0]
-            if len(requestedPath) == 1:
-                # It's hopefully a file in this folder.
-                if pathPart in searchFolder.files:
-                    # Yay!
-                    return searchFolder.firstID + searchFolder.files.index(pathPart)
-                else:
-                    # Not here.
-                    return None
-
-            # Hopefully we have the requested subfolder...
-            for subfolderName, subfolder in searchFolder.folders:
-                if subfolderName == pathPart:
-                    # Yup.
-                    return findInFolder(requestedPath[1:], subfolder)
-            # Welp.
-            return None
-
-        pathList = path.split('/')
-        while not pathList[-1]: pathList = pathList[:-1]
-        while not pathList[0]: pathList = pathList[1:]
-        return findInFolder(pathList, self)
+        return self._pathIndex()[0].get(path.strip('/'))
 
 
     def subfolder(self, path):
@@ -129,29 +290,16 @@ class Folder:
         the given folder path (using "/" as the separator) relative to
         this folder.
         """
+        return self._pathIndex()[2].get(path.strip('/'))
 
-        def findInFolder(requestedPath, searchFolder):
-            """
-            Attempt to find filename in the given folder.
-            pathSoFar is the path up through this point, as a list.
-            """
-            pathPart = requestedPath[0]
-            for subfolderName, subfolder in searchFolder.folders:
-                if subfolderName == pathPart:
-                    if len(requestedPath) == 1:
-                        # Found the actual folder that was requested!
-                        return subfolder
-                    else:
-                        # Search another level down
-                        return findInFolder(requestedPath[1:], subfolder)
-            # Welp.
-            return None
-
-        pathList = path.split('/')
-        while not pathList[-1]: pathList = pathList[:-1]
-        while not pathList[0]: pathList = pathList[1:]
-        return findInFolder(pathList, self)
 
+    def filenameOf(self, id):
+        """
+        Find the filename of the file with the given ID. If it exists
+        in a subfolder, the filename will be returned as a path
+        separated by "/"s.
+        """
+        return self._pathIndex()[1].get(id)
 
 
     def _strListUncombined(self, indent=0, fileList=None):
@@ -227,45 +375,54 @@ def load(fnt):
     """
     Create a Folder from filename table data. This is the inverse of
     save().
+
+    Folders are read straight from the folder table in one pass,
+    without recursion, and their names stay as offsets into the data
+    until someone actually looks at them.
     """
-    def loadFolder(folderId):
-        """
-        Load the folder with ID `folderId` and return it as a Folder.
-        """
-        folderObj = Folder()
+    fnt = memoryview(fnt)
+    if len(fnt) < 8:
+        return Folder()
 
-        # Get the entries table offset and file ID from the top of the
-        # fnt file
-        off = 8 * (folderId & 0xFFF)
-        entriesTableOff, fileID = struct.unpack_from('<IH', fnt, off)
-        folderObj.firstID = fileID
+    # The root folder's "parent ID" is the total number of folders
+    _, _, folderCount = struct.unpack_from('<IHH', fnt, 0)
+    folders = [Folder() for _ in range(folderCount)]
+    referenced = bytearray(folderCount)
 
-        off = entriesTableOff
+    for folderObj, (entriesTableOff, fileID, _) in zip(folders,
+            struct.iter_unpack('<IHH', fnt[:8 * folderCount])):
+        folderObj._firstID = fileID
 
         # Read file and folder entries from the entries table
+        fileSpans = []
+        folderSpans = []
+        off = entriesTableOff
         while True:
-            control, = struct.unpack_from('B', fnt, off); off += 1
+            # The first byte is a control byte that includes the length
+            # of the upcoming string and if this entry is a folder
+            control = fnt[off]; off += 1
             if control == 0:
                 break
+            len_ = control & 0x7F
 
-            # That first byte is a control byte that includes the length
-            # of the upcoming string and if this entry is a folder
-            len_, isFolder = control & 0x7F, control & 0x80
-
-            name = fnt[off : off+len_].decode('latin-1'); off += len_
-
-            if isFolder:
+            if control & 0x80:
                 # There's an additional 2-byte value with the subfolder
-                # ID. Get that and load the folder
-                subFolderID, = struct.unpack_from('<H', fnt, off); off += 2
-                folderObj.folders.append((name, loadFolder(subFolderID)))
+                # ID after the name
+                subFolderID = (fnt[off+len_] | fnt[off+len_+1] << 8) & 0xFFF
+                if not 0 < subFolderID < folderCount or referenced[subFolderID]:
+                    raise ValueError('Invalid subfolder ID ' + hex(subFolderID)
+                                     + ' in filename table')
+                referenced[subFolderID] = 1
+                folderSpans.append((off, len_, folders[subFolderID]))
+                off += len_ + 2
             else:
-                folderObj.files.append(name)
+                fileSpans.append((off, len_))
+                off += len_
 
-        return folderObj
+        folderObj._pendingFiles = (fnt, fileSpans)
+        folderObj._pendingFolders = (fnt, folderSpans)
 
-    # Root folder is always 0xF000
-    return loadFolder(0xF000)
+    return folders[0] if folders else Folder()
 
 
 def save(root):
@@ -274,221 +431,2203 @@ def save(root):
     table. This is the inverse of load().
     """
 
-    # folderEntries is a dict of tuples:
-    # {
-    #     folderID: (initialFileID, parentFolderID, b'file entries data'),
-    #     folderID: (initialFileID, parentFolderID, b'file entries data'),
-    # }
-    # This is an intermediate representation of the filenames data that
-    # can be converted to the final binary representation much more
-    # easily than the nested lists can.
-    folderEntries = {}
+    # Folder IDs are assigned in depth-first order, starting with the
+    # root folder (0xF000). This walks the tree with an explicit stack
+    # to find that order, each folder's parent and each folder's
+    # subfolders' IDs.
+    order = []
+    parents = []
+    childIDs = []
+    stack = [(root, None)]
+    while stack:
+        folder, parent = stack.pop()
+        folderID = 0xF000 + len(order)
+        order.append(folder)
+        parents.append(parent)
+        childIDs.append([])
+        if parent is not None:
+            childIDs[parent - 0xF000].append(folderID)
+        for _, subfolder in reversed(folder.folders):
+            stack.append((subfolder, folderID))
+
+    if len(order) > 0x1000:
+        raise ValueError('Too many folders (' + str(len(order))
+                         + '; maximum is 4096)!')
+
+    # Encode each folder's entries table as one latin-1 string (the
+    # control bytes and subfolder IDs are all < 0x100 too), so that
+    # the whole table can then be laid out in one presized buffer
+    entriesTables = []
+    for folder, folderChildIDs in zip(order, childIDs):
+        files = folder.files
+        subfolders = folder.folders
+
+        # Each file entry is preceded by a 1-byte length value. Top
+        # bit must be 0 or else it'll be interpreted as a folder.
+        for file in files:
+            if len(file) > 127:
+                raise ValueError('Filename "' + file + '" is '
+                    + str(len(file)) + ' characters long (maximum is 127)!')
+        for folderName, _ in subfolders:
+            if len(folderName) > 127:
+                raise ValueError('Folder name "' + folderName + '" is '
+                    + str(len(folderName)) + ' characters long (maximum'
+                    ' is 127)!')
+
+        # Folder names are preceded by a 1-byte length value, OR'ed
+        # with 0x80 to mark them as folders, and followed by the
+        # subfolder's ID as a 2-byte value. And the entries table
+        # needs to end with a null byte to mark its end.
+        entriesTables.append((
+            ''.join([chr(len(file)) + file for file in files])
+            + ''.join([chr(len(folderName) | 0x80) + folderName
+                       + chr(childID & 0xFF) + chr(childID >> 8)
+                       for (folderName, _), childID
+                       in zip(subfolders, folderChildIDs)])
+            + '\0').encode('latin-1'))
+
+    fnt = bytearray(8 * len(order) + sum(map(len, entriesTables)))
+
+    # The root folder's parent's ID is the total number of folders.
+    parents[0] = len(order)
+
+    off = 8 * len(order)
+    for i, (folder, entriesTable) in enumerate(zip(order, entriesTables)):
+        struct.pack_into('<IHH', fnt, 8 * i, off, folder.firstID, parents[i])
+        fnt[off : off+len(entriesTable)] = entriesTable
+        off += len(entriesTable)
+
+    return fnt
+
+def err(owo):
+    if (owo == 0):
+        raise Exception("owo)")
+
+class LazyFileList(collections.abc.Sequence):
+    """
+    The files of a ROM, as a list-like object that slices each file
+    out of a shared buffer (usually a memory-mapped ROM) only when it's
+    asked for. The slices are memoryviews, so no file data is copied.
+
+    Files can be replaced by assigning to them like with a list; the
+    new data is kept separately, and the shared buffer is never
+    written to. To edit a file in place, assign a copy of it first:
+        rom.files[i] = bytearray(rom.files[i])
+    """
+    def __init__(self, data, starts, ends):
+        self._data = data
+        self._starts = starts
+        self._ends = ends
+        self._replaced = {}
+        self._appended = []
+
+
+    def _checkIndex(self, i):
+        length = len(self)
+        if i < 0:
+            i += length
+        if not 0 <= i < length:
+            raise IndexError('file ID out of range')
+        return i
+
+
+    def __len__(self):
+        return len(self._starts) + len(self._appended)
+
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        i = self._checkIndex(i)
+        if i >= len(self._starts):
+            return self._appended[i - len(self._starts)]
+        replaced = self._replaced.get(i)
+        if replaced is not None:
+            return replaced
+        return self._data[self._starts[i] : self._ends[i]]
+
+
+    def __setitem__(self, i, value):
+        i = self._checkIndex(i)
+        if i >= len(self._starts):
+            self._appended[i - len(self._starts)] = value
+        else:
+            self._replaced[i] = value
+
+
+    def isOriginal(self, i):
+        """
+        Check if file i is still the data it was loaded with.
+        """
+        return 0 <= i < len(self._starts) and i not in self._replaced
 
-    # nextFolderID allows us to assign folder IDs in sequential order.
-    # The root folder always has ID 0xF000.
-    nextFolderID = 0xF000
 
-    def parseFolder(d, parentID):
+    def sourceRange(self, i):
         """
-        Parse a Folder and add its entries to folderEntries.
-        `parentID` is the ID of the folder containing this one.
+        Return the (start, end) offsets file i was loaded from.
         """
+        return self._starts[i], self._ends[i]
 
-        # Grab the next folder ID
-        folderID = nextFolderID
-        nextFolderID += 1
 
-        # Create an entries table and add filenames and folders to it
-        entriesTable = bytearray()
-        for file in d.files:
-            # Each file entry is preceded by a 1-byte length value.
-            # Top bit must be 0 or else it'll be interpreted as a
-            # folder.
-            if len(file) > 127:
-                raise ValueError('Filename "{file}" is {len(file)}'
-                    ' characters long (maximum is 127)!')
-            entriesTable.append(len(file))
-            entriesTable.extend(file.encode('latin-1'))
-
-        for folderName, folder in d.folders:
-            # First, parse the subfolder and get its ID, so we can save
-            # that to the entries table.
-            otherID = parseFolder(folder, folderID)
-
-            # Folder name is preceded by a 1-byte length value, OR'ed
-            # with 0x80 to mark it as a folder.
-            if len(folderName) > 127:
-                raise ValueError('Folder name "{folderName}" is'
-                    ' {len(folderName)} characters long (maximum is'
-                     ' 127)!')
-            entriesTable.append(len(folderName) | 0x80)
-            entriesTable.extend(folderName.encode('latin-1'))
+    def append(self, value):
+        self._appended.append(value)
 
-            # And the ID of the subfolder goes after its name, as a
-            # 2-byte value.
-            entriesTable.extend(struct.pack('<H', otherID))
 
-        # And the entries table needs to end with a null byte to mark
-        # its end.
-        entriesTable.extend(b'\0')
+    def extend(self, values):
+        self._appended.extend(values)
 
-        folderEntries[folderID] = (d.firstID, parentID, entriesTable)
-        return folderID
 
-    # The root folder's parent's ID is the total number of folders.
-    def countFoldersIn(folder):
-        folderCount = 0
-        for _, f in folder.folders:
-            folderCount += countFoldersIn(f)
-        return folderCount + 1
-    rootParentId = countFoldersIn(root)
+    def __repr__(self):
+        return '<' + type(self).__name__ + ' (' + str(len(self)) + ' files)>'
 
-    # Ensure that the root folder has the proper folder ID.
-    rootId = parseFolder(root, rootParentId)
-    assert rootId == 0xF000, 'Root FNT folder has incorrect root folder ID: {hex(rootId)}'
 
-    # Allocate space for the folders table at the beginning of the file
-    fnt = bytearray(len(folderEntries) * 8)
+class FatReport:
+    """
+    Problems found in a file allocation table by FatIndex.validate().
+    Each list is in ROM offset order.
+    """
+    def __init__(self):
+        # (file ID, file ID) pairs of files that partially overlap
+        self.overlaps = []
+        # (file ID, file ID) pairs of files with exactly the same range
+        self.duplicates = []
+        # (start, end) ranges not used by any file, other than padding
+        # up to the next ROM_ALIGNMENT boundary
+        self.gaps = []
+        # IDs of files that end before they start, or past the ROM end
+        self.outOfBounds = []
+
+
+    def isValid(self):
+        """
+        Check if no overlapping, duplicate or out-of-bounds files were
+        found. Gaps don't count, since they're harmless.
+        """
+        return not (self.overlaps or self.duplicates or self.outOfBounds)
 
-    # We need to iterate over the folders in order of increasing ID.
-    for currentFolderID in sorted(folderEntries.keys()):
-        fileID, parentID, entriesTable = folderEntries[currentFolderID]
 
-        # Add the folder entries to the folder table
-        offsetInFolderTable = 8 * (currentFolderID & 0xFFF)
-        struct.pack_into('<IHH', fnt, offsetInFolderTable,
-            len(fnt), fileID, parentID)
+    def __str__(self):
+        return ('<FAT report: ' + str(len(self.overlaps)) + ' overlaps, '
+                + str(len(self.duplicates)) + ' duplicates, '
+                + str(len(self.gaps)) + ' gaps, '
+                + str(len(self.outOfBounds)) + ' out of bounds>')
 
-        # And tack the folder's entries table onto the end of the file
-        fnt.extend(entriesTable)
 
-    return fnt
+class FatIndex:
+    """
+    A file allocation table, indexed by ROM offset: the start and end
+    offsets of each file (parallel arrays, by file ID), plus the file
+    IDs sorted by start offset.
+    """
+    def __init__(self, starts, ends):
+        self.starts = starts
+        self.ends = ends
+
+        # Sorting is stable, so files sharing a start offset stay in ID
+        # order, and none of them are lost
+        self.order = array.array('I', sorted(range(len(starts)), key=starts.__getitem__))
+        self._sortedStarts = array.array('I', (starts[fid] for fid in self.order))
+
+        # The largest end offset of any file up to each position in
+        # self.order, so lookups can tell when an earlier file overlaps
+        self._maxEnds = array.array('I', itertools.accumulate(
+            (ends[fid] for fid in self.order), max))
+
+
+    @classmethod
+    def fromFat(cls, fat):
+        """
+        Create a FatIndex from raw FAT data.
+        """
+        entries = array.array('I', bytes(fat[:len(fat) & ~7]))
+        if sys.byteorder != 'little':
+            entries.byteswap()
+        return cls(entries[0::2], entries[1::2])
+
+
+    def __len__(self):
+        return len(self.starts)
+
+
+    def ownerOf(self, offset):
+        """
+        Return the ID of the file containing ROM offset offset, or None
+        if it's not part of any file. If several files contain it, the
+        one starting closest before it wins.
+        """
+        pos = bisect.bisect_right(self._sortedStarts, offset) - 1
+        if pos < 0 or self._maxEnds[pos] <= offset:
+            return None
+
+        # Without overlapping files, this finds the owner immediately
+        order, ends, maxEnds = self.order, self.ends, self._maxEnds
+        while pos >= 0 and maxEnds[pos] > offset:
+            if ends[order[pos]] > offset:
+                return order[pos]
+            pos -= 1
+        return None
+
+
+    def validate(self, romSize=None):
+        """
+        Check the whole table for overlapping, duplicate and
+        out-of-bounds files, and for unused gaps, in one pass. romSize
+        is the size of the ROM the offsets point into, if known.
+        Returns a FatReport.
+        """
+        report = FatReport()
+        starts, ends = self.starts, self.ends
+
+        prevFid = None
+        maxEnd = 0
+        maxFid = None
+        for fid in self.order:
+            start, end = starts[fid], ends[fid]
+            if end < start or (romSize is not None and end > romSize):
+                report.outOfBounds.append(fid)
+                continue
+            if start == end:
+                # Empty files don't take up any space
+                continue
+
+            if prevFid is not None and starts[prevFid] == start and ends[prevFid] == end:
+                report.duplicates.append((prevFid, fid))
+            elif start < maxEnd:
+                report.overlaps.append((maxFid, fid))
+            elif maxFid is not None:
+                padded = (maxEnd + ROM_ALIGNMENT - 1) & ~(ROM_ALIGNMENT - 1)
+                if start > padded:
+                    report.gaps.append((maxEnd, start))
+
+            prevFid = fid
+            if end > maxEnd:
+                maxEnd, maxFid = end, fid
+
+        return report
+
+
+# Sidecar files next to ROMs that cache the hashes of their files
+FILE_HASH_CACHE_SUFFIX = '.hashes'
+
+# Suffix of the sidecar files analysis plans are cached in, next to
+# the ROM, unless a cache directory is given (see
+# NintendoDSRom.analysisPlan())
+ANALYSIS_PLAN_SUFFIX = '.{}.plan'
+_FILE_HASH_MAGIC = b'NDSH'
+_FILE_HASH_LEN = hashlib.sha1().digest_size
+
+# Files are handed to hashing threads in chunks of about this many
+# bytes, since most files are too small to be worth a task each
+FILE_HASH_CHUNK_SIZE = 0x100000
+
+# The manifest NintendoDSRom.extractTo() writes into the directory it
+# extracts to, recording the size, modification time and hash of each
+# file, so importFrom() can tell which ones changed
+EXTRACT_MANIFEST_NAME = '.nds-manifest.json'
+
+# How many file reads or writes extractTo() and importFrom() keep in
+# flight per thread
+EXTRACT_WINDOW_PER_THREAD = 4
+
+
+def _hashFiles(files, fids, threads=None):
+    """
+    Return the SHA-1 digests of files[fid] for each fid in fids. With
+    more than one thread, hashing runs in parallel (hashlib releases
+    the GIL while it works).
+    """
+    def hashChunk(chunk):
+        return [hashlib.sha1(files[fid]).digest() for fid in chunk]
+
+    if threads == 1 or len(fids) < 2:
+        return hashChunk(fids)
+
+    chunks = []
+    chunk = []
+    chunkSize = 0
+    for fid in fids:
+        chunk.append(fid)
+        chunkSize += len(files[fid])
+        if chunkSize >= FILE_HASH_CHUNK_SIZE:
+            chunks.append(chunk)
+            chunk = []
+            chunkSize = 0
+    if chunk:
+        chunks.append(chunk)
+
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        return [digest for digests in executor.map(hashChunk, chunks)
+                for digest in digests]
+
+
+def _readHashCache(path, key, count):
+    """
+    Read a list of count file hashes from a sidecar cache file, or
+    return None if it doesn't exist or isn't for the ROM identified
+    by key.
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    headerLen = 8 + len(key)
+    if (len(data) != headerLen + count * _FILE_HASH_LEN
+            or data[:4] != _FILE_HASH_MAGIC
+            or data[8:headerLen] != key
+            or struct.unpack_from('<I', data, 4)[0] != count):
+        return None
+    return [data[i : i+_FILE_HASH_LEN]
+            for i in range(headerLen, len(data), _FILE_HASH_LEN)]
+
+
+def _writeHashCache(path, key, hashes):
+    """
+    Write file hashes to a sidecar cache file. Failing to (e.g.
+    because the ROM is in a read-only directory) isn't an error.
+    """
+    tempPath = path + '.tmp'
+    try:
+        with open(tempPath, 'wb') as f:
+            f.write(_FILE_HASH_MAGIC + struct.pack('<I', len(hashes)) + key)
+            f.write(b''.join(hashes))
+        os.replace(tempPath, path)
+    except OSError:
+        pass
+
+
+def _extractPath(directory, path):
+    """
+    Return where the file or folder at a "/"-separated path from a
+    filename table goes under directory. Names that could lead outside
+    of it ("..", or ones with path separators) are rejected.
+    """
+    parts = path.split('/')
+    for part in parts:
+        if (part in ('', '.', '..') or os.sep in part
+                or (os.altsep and os.altsep in part) or '\0' in part):
+            raise ValueError('Unsafe path in the filename table: ' + repr(path))
+    return os.path.join(directory, *parts)
+
+
+def _readManifest(directory):
+    """
+    Read the manifest (path -> [size, mtime in ns, SHA-1 hex digest])
+    in a directory written by NintendoDSRom.extractTo(), or return an
+    empty one if there isn't a valid one.
+    """
+    import json
+    try:
+        with open(os.path.join(directory, EXTRACT_MANIFEST_NAME), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return manifest if isinstance(manifest, dict) else {}
+
+
+def _writeManifest(directory, manifest):
+    import json
+    path = os.path.join(directory, EXTRACT_MANIFEST_NAME)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def _runBounded(tasks, threads, onResult):
+    """
+    Run (key, function, args) tasks on a pool of threads, keeping at
+    most EXTRACT_WINDOW_PER_THREAD tasks per thread in flight, and call
+    onResult(key, result) on the calling thread for each one, in order.
+    """
+    import concurrent.futures
+    if threads is None:
+        threads = min(32, (os.cpu_count() or 1) + 4)
+    window = threads * EXTRACT_WINDOW_PER_THREAD
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        pending = collections.deque()
+        for key, function, args in tasks:
+            pending.append((key, executor.submit(function, *args)))
+            if len(pending) >= window:
+                key, future = pending.popleft()
+                onResult(key, future.result())
+        while pending:
+            key, future = pending.popleft()
+            onResult(key, future.result())
+
+
+# How much _copyFileRange() reads at a time when it has to hash what
+# it copies
+_COPY_CHUNK_SIZE = 0x100000
+
+
+def _copyFileRange(srcFd, srcOffset, dst, length, hasher=None):
+    """
+    Copy up to length bytes from srcFd (at srcOffset) to the current
+    position of file object dst, using copy_file_range() or sendfile()
+    so the data never passes through Python. Returns how many bytes
+    were copied, which is 0 if the OS or dst doesn't support it.
+
+    If hasher (a hashlib object) is given, the data has to pass
+    through Python to be hashed, so it's read with pread() and fed to
+    hasher as it's written instead.
+    """
+    if hasher is not None:
+        if not hasattr(os, 'pread'):
+            return 0
+        copied = 0
+        while copied < length:
+            chunk = os.pread(srcFd, min(_COPY_CHUNK_SIZE, length - copied),
+                             srcOffset + copied)
+            if not chunk:
+                break
+            hasher.update(chunk)
+            dst.write(chunk)
+            copied += len(chunk)
+        return copied
+
+    try:
+        dstFd = dst.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return 0
+    dst.flush()
+    dstOffset = dst.tell()
+
+    copied = 0
+    try:
+        while copied < length:
+            if hasattr(os, 'copy_file_range'):
+                n = os.copy_file_range(srcFd, dstFd, length - copied,
+                    srcOffset + copied, dstOffset + copied)
+            elif hasattr(os, 'sendfile'):
+                os.lseek(dstFd, dstOffset + copied, os.SEEK_SET)
+                n = os.sendfile(dstFd, srcFd, srcOffset + copied, length - copied)
+            else:
+                break
+            if not n:
+                break
+            copied += n
+    except OSError:
+        # Not supported for these files (e.g. across filesystems on
+        # older kernels); the caller writes whatever is left
+        pass
+
+    dst.seek(dstOffset + copied)
+    return copied
 
-def err(owo):
-    if (owo == 0):
-        raise Exception("owo)")
 
 ICON_BANNER_LEN = 0x840
 
+# Icon/banner lengths by banner version: version 2 adds a Chinese
+# title, version 3 a Korean one, and version 0x103 (DSi) an animated
+# icon. Unknown versions are assumed to be ICON_BANNER_LEN long.
+BANNER_LENGTHS = {1: 0x840, 2: 0x940, 3: 0xA40, 0x103: 0x23C0}
+
+# Banner title languages, in the order the titles are stored in
+BANNER_LANGUAGES = ['japanese', 'english', 'french', 'german',
+                    'italian', 'spanish', 'chinese', 'korean']
+HEADER_LEN = 0x200
+# DSi-enhanced ROMs extend the header up to here (see TwlHeader)
+TWL_HEADER_LEN = 0x1000
+ROM_ALIGNMENT = 0x200
+NINTENDO_LOGO_CHECKSUM = 0xCF56
+
+
+SECURE_AREA_OFFSET = 0x4000
+SECURE_AREA_LEN = 0x4000
+
+# The first 8 bytes of a decrypted secure area. Its checksum is over
+# the encrypted version, which can't be recreated without the KEY1
+# table from the BIOS, so it can't be verified or recalculated.
+DECRYPTED_SECURE_AREA_ID = b'\xff\xde\xff\xe7\xff\xde\xff\xe7'
+
+
+def _makeCrc16Table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0xA001
+            else:
+                crc >>= 1
+        table.append(crc)
+    return table
 
-class NintendoDSRom:
+_CRC16_TABLE = _makeCrc16Table()
+
+# Table for processing two bytes at a time: since the CRC is 16 bits
+# wide, XORing it with the next (little-endian) halfword and looking
+# that up gives the new CRC directly. This is 64K entries, so it's
+# only built the first time some large data is checksummed.
+_crc16WordTable = None
+
+
+def _getCrc16WordTable():
+    global _crc16WordTable
+    if _crc16WordTable is None:
+        table = _CRC16_TABLE
+        half = [(x >> 8) ^ table[x & 0xFF] for x in range(0x10000)]
+        _crc16WordTable = [(c >> 8) ^ table[c & 0xFF] for c in half]
+    return _crc16WordTable
+
+
+def crc16(data, crc=0xFFFF):
     """
-    A Nintendo DS ROM file (.nds).
+    Calculate the CRC16 (reflected polynomial 0xA001, as used by the
+    DS BIOS) of some data.
+    """
+    data = memoryview(data).cast('B')
+    if len(data) < 0x400:
+        table = _CRC16_TABLE
+        for b in data:
+            crc = (crc >> 8) ^ table[(crc ^ b) & 0xFF]
+        return crc
+
+    table = _getCrc16WordTable()
+    words = data[:len(data) & ~1].cast('H')
+    if sys.byteorder != 'little':
+        words = array.array('H', words)
+        words.byteswap()
+    for w in words:
+        crc = table[crc ^ w]
+    if len(data) & 1:
+        crc = (crc >> 8) ^ _CRC16_TABLE[(crc ^ data[-1]) & 0xFF]
+    return crc
+
+
+def secureAreaChecksum(secureArea):
+    """
+    Calculate the checksum of a (0x4000-byte) secure area, or return
+    None if it's decrypted and so can't be checksummed.
     """
+    if bytes(secureArea[:8]) == DECRYPTED_SECURE_AREA_ID:
+        return None
+    return crc16(secureArea)
 
-    def __init__(self, data=None):
 
-        if data is None:
-            self._initAsNew()
-        else:
-            self._initFromData(data)
+class NintendoDSHeader:
+    """
+    The 0x200-byte header at the start of a Nintendo DS ROM, without
+    any of the data it points to. This is much cheaper to create than
+    a full NintendoDSRom, and is what accept_file() uses to recognize
+    ROMs.
+    """
+    # Everything from 0x000 up to the end of the debug ROM fields
+    # (0x16C), in one go
+    _STRUCT = struct.Struct('<12s4s2sBBB8xBBB16I3I2H2I8s2I56x156s2H3I')
+
+    def __init__(self, data):
+        if len(data) < self._STRUCT.size:
+            raise ValueError('Header data is too short (' + hex(len(data)) + ' bytes)')
+
+        (name, self.idCode, self.developerCode, self.unitCode,
+            self.encryptionSeedSelect, self.deviceCapacity, self.region,
+            self.version, self.autostart,
+            self.arm9Offset, self.arm9EntryAddress, self.arm9RamAddress, self.arm9Len,
+            self.arm7Offset, self.arm7EntryAddress, self.arm7RamAddress, self.arm7Len,
+            self.fntOffset, self.fntLen, self.fatOffset, self.fatLen,
+            self.arm9OverlayTableOffset, self.arm9OverlayTableLen,
+            self.arm7OverlayTableOffset, self.arm7OverlayTableLen,
+            self.normalCardControlRegisterSettings,
+            self.secureCardControlRegisterSettings, self.iconBannerOffset,
+            self.secureAreaChecksum, self.secureTransferDelay,
+            self.arm9CodeSettingsPointerAddress,
+            self.arm7CodeSettingsPointerAddress, self.secureAreaDisable,
+            self.romSizeOrRsaSigOffset, self.headerSize,
+            self.nintendoLogo, self.nintendoLogoChecksum, self.headerChecksum,
+            self.debugRomOffset, self.debugRomSize, self.debugRomAddress,
+            ) = self._STRUCT.unpack_from(data)
+        self.name = name.rstrip(b'\0')
+        self.calculatedHeaderChecksum = crc16(memoryview(data)[:0x15E])
+
+
+    def logoIsValid(self):
+        """
+        Check the checksum of the Nintendo logo bitmap.
+        """
+        return (self.nintendoLogoChecksum == NINTENDO_LOGO_CHECKSUM
+                and crc16(self.nintendoLogo) == NINTENDO_LOGO_CHECKSUM)
 
 
-    def _initAsNew(self):
+    def checksumIsValid(self):
         """
-        Initialize this ROM with default values.
+        Check the header checksum (CRC16 of 0x000-0x15D).
         """
+        return self.headerChecksum == self.calculatedHeaderChecksum
 
-        self.name = b''
-        self.idCode = b'####'
-        self.developerCode = b'\0\0'
-        self.unitCode = 0
-        self.encryptionSeedSelect = 0
-        self.deviceCapacity = 9
-        self.pad015 = 0
-        self.pad016 = 0
-        self.pad017 = 0
-        self.pad018 = 0
-        self.pad019 = 0
-        self.pad01A = 0
-        self.pad01B = 0
-        self.pad01C = 0
-        self.region = 0
-        self.version = 0
-        self.autostart = 0
-        self.arm7Len = 0
-        self.arm9Len = 0
-        self.arm7Offset = 0
-        self.arm9Offset = 0
-        self.arm9EntryAddress = 0x2000800
-        self.arm9RamAddress = 0x2000000
-        self.arm7EntryAddress = 0x2380000
-        self.arm7RamAddress = 0x2380000
-        self.normalCardControlRegisterSettings = 0x0416657
-        self.secureCardControlRegisterSettings = 0x81808f8
-        self.secureAreaChecksum = 0x0000
-        self.secureTransferDelay = 0x0D7E
-        self.arm9CodeSettingsPointerAddress = 0
-        self.arm7CodeSettingsPointerAddress = 0
-        self.secureAreaDisable = b'\0' * 8
-        self.pad088 = b'\0' * 0x38
-        self.nintendoLogo = (b'$\xff\xaeQi\x9a\xa2!=\x84\x82\n\x84\xe4\t\xad'
-            b"\x11$\x8b\x98\xc0\x81\x7f!\xa3R\xbe\x19\x93\t\xce \x10FJJ\xf8'1"
-            b'\xecX\xc7\xe83\x82\xe3\xce\xbf\x85\xf4\xdf\x94\xceK\t\xc1\x94V'
-            b"\x8a\xc0\x13r\xa7\xfc\x9f\x84Ms\xa3\xca\x9aaX\x97\xa3'\xfc\3\x98"
-            b'v#\x1d\xc7a\3\4\xaeV\xbf8\x84\0@\xa7\x0e\xfd\xffR\xfe\3o\x950'
-            b'\xf1\x97\xfb\xc0\x85`\xd6\x80%\xa9c\xbe\3\1N8\xe2\xf9\xa24\xff'
-            b'\xbb>\3Dx\0\x90\xcb\x88\x11:\x94e\xc0|c\x87\xf0<\xaf\xd6%\xe4'
-            b'\x8b8\n\xacr!\xd4\xf8\7')
-        self.debugRomAddress = 0
-        self.pad16C = b'\0' * 0x94
-        self.pad200 = b'\0' * 0x3E00
 
-        self.rsaSignature = b''
+    def dataEnd(self):
+        """
+        The offset of the end of the furthest piece of data (code,
+        tables, banner...) that this header points to. A dump smaller
+        than this is truncated.
+        """
+        return max(self.romSizeOrRsaSigOffset,
+                   self.arm9Offset + self.arm9Len,
+                   self.arm7Offset + self.arm7Len,
+                   self.fntOffset + self.fntLen,
+                   self.fatOffset + self.fatLen,
+                   self.arm9OverlayTableOffset + self.arm9OverlayTableLen,
+                   self.arm7OverlayTableOffset + self.arm7OverlayTableLen,
+                   self.iconBannerOffset + ICON_BANNER_LEN if self.iconBannerOffset else 0,
+                   self.debugRomOffset + self.debugRomSize)
 
-        self.arm9 = b''
-        self.arm9PostData = b''
-        self.arm7 = b''
-        self.arm9OverlayTable = b''
-        self.arm7OverlayTable = b''
-        self.iconBanner = b''
-        self.debugRom = b''
 
-        self.filenames = Folder()
-        self.files = []
-        self.sortedFileIds = []
-        self.romSizeOrRsaSigOffset = 0
+    def __str__(self):
+        title = repr(bytes(self.name))[2:-1].rstrip(' ')
+        code = repr(bytes(self.idCode))[2:-1]
+        return '<header "' + title + '" (' + code + ')>'
 
-    
-    def _initFromData(self, data):
+
+class TwlHeader:
+    """
+    The DSi ("TWL") extension of the header of a DSi-enhanced or
+    DSi-exclusive ROM (unit code 2 or 3), at 0x180-0x238 (the hashes
+    and RSA signature after that aren't parsed). It says where the
+    DSi-only ARM9i and ARM7i binaries are, and how each CPU's new
+    shared WRAM (set up by the MBK registers) is mapped.
+    """
+    OFFSET = 0x180
+    _STRUCT = struct.Struct('<5I3I3I4I3xBI4x2II4x2I8I2II4xI12x4IQ')
+
+    def __init__(self, data):
+        if len(data) < self.OFFSET + self._STRUCT.size:
+            raise ValueError('TWL header data is too short (' + hex(len(data)) + ' bytes)')
+
+        fields = self._STRUCT.unpack_from(data, self.OFFSET)
+        self.globalMbk = fields[0:5]
+        self.arm9Mbk = fields[5:8]
+        self.arm7Mbk = fields[8:11]
+        (self.mbk9, self.regionFlags, self.accessControl, self.scfgExtMask,
+            self.appFlags,
+            self.arm9iOffset, self.arm9iRamAddress, self.arm9iLen,
+            self.arm7iOffset, self.arm7iRamAddress, self.arm7iLen,
+            self.ntrDigestOffset, self.ntrDigestLen,
+            self.twlDigestOffset, self.twlDigestLen,
+            self.sectorHashTableOffset, self.sectorHashTableLen,
+            self.blockHashTableOffset, self.blockHashTableLen,
+            self.digestSectorSize, self.digestBlockSectorCount,
+            self.bannerLen, self.twlRomSize,
+            self.modcrypt1Offset, self.modcrypt1Len,
+            self.modcrypt2Offset, self.modcrypt2Len,
+            self.titleId) = fields[11:]
+        # Bit 1 of the flags at 0x1C says the modcrypt areas are
+        # (still) encrypted
+        self.modcrypted = bool(data[0x1C] & 2)
+
+
+    def dsiRanges(self):
         """
-        Initialize this ROM from existing data.
+        Return the (start, end) ranges of the ROM that only the DSi
+        part of the header points to, and that a saved ROM has to keep
+        where they are: the ARM9i and ARM7i binaries, the TWL digest
+        region around them, and the sector and block hash tables.
+        Overlapping ranges are merged, and the list is sorted.
         """
-        # I could read the header as one huge struct,
-        # but... no.
-        self.headerOffset = 0
-        data = bytearray(data)
-        if len(data) < 0x200:
-            data.extend(b'\0' * (0x200 - len(data)))
-            assert len(data) == 0x200, 'ROM data extension to length 0x200 failed (actual new length' + hex(len(data)) + ')'
+        ranges = sorted((offset, offset + length) for offset, length in (
+            (self.arm9iOffset, self.arm9iLen),
+            (self.arm7iOffset, self.arm7iLen),
+            (self.twlDigestOffset, self.twlDigestLen),
+            (self.sectorHashTableOffset, self.sectorHashTableLen),
+            (self.blockHashTableOffset, self.blockHashTableLen))
+            if offset and length)
+        merged = []
+        for start, end in ranges:
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        return [(start, end) for start, end in merged]
 
-        def readRaw(length):
-            retVal = data[self.headerOffset : self.headerOffset+length]
-            self.headerOffset += length
-            return retVal
-        def read8():
-            
-            retVal = data[self.headerOffset]
-            self.headerOffset += 1
-            return retVal
-        def read16():
-            
-            retVal, = struct.unpack_from('<H', data, self.headerOffset)
-            self.headerOffset += 2
-            return retVal
-        def read32():
-            
-            retVal, = struct.unpack_from('<I', data, self.headerOffset)
-            self.headerOffset += 4
-            return retVal
 
-        assert self.headerOffset == 0, '(Load) Header offset check at 0x00: '+ hex(self.headerOffset)
-        self.name = readRaw(12).rstrip(b'\0')
-        self.idCode = readRaw(4)
-        self.developerCode = readRaw(2)
-        self.unitCode = read8()
-        self.encryptionSeedSelect = read8()
-        self.deviceCapacity = read8()
+    def isEncrypted(self, offset, length):
+        """
+        Check whether any of the given range of the ROM is inside an
+        encrypted modcrypt area.
+        """
+        if not self.modcrypted:
+            return False
+        for start, size in ((self.modcrypt1Offset, self.modcrypt1Len),
+                            (self.modcrypt2Offset, self.modcrypt2Len)):
+            if size and offset < start + size and start < offset + length:
+                return True
+        return False
+
+
+    def wramWindows(self, cpu='ARM9'):
+        """
+        Return where a CPU sees the DSi's new shared WRAM (WRAM-A, B
+        and C), as set up by the MBK6-8 values in the header: a list
+        of (name, start, end) tuples, leaving out empty windows.
+        """
+        windows = []
+        mbks = self.arm7Mbk if cpu == 'ARM7' else self.arm9Mbk
+        # WRAM-A's start and end are in 64K units (bits 4-11 and
+        # 20-28), WRAM-B and C's in 32K ones (bits 3-11 and 19-28)
+        for name, mbk, shift, unit in (('WRAM_A', mbks[0], 4, 0x10000),
+                                       ('WRAM_B', mbks[1], 3, 0x8000),
+                                       ('WRAM_C', mbks[2], 3, 0x8000)):
+            start = 0x03000000 + ((mbk & 0xFFF) >> shift) * unit
+            end = 0x03000000 + ((mbk & 0x1FFFFFFF) >> (shift + 16)) * unit
+            if end > start:
+                windows.append((name, start, end))
+        return windows
+
+
+def probeHeader(data, fileSize=None):
+    """
+    Parse and validate a ROM header from (at least) the first 0x200
+    bytes of a ROM. Returns a NintendoDSHeader, or None if the data
+    doesn't look like a Nintendo DS ROM. If the size of the whole
+    file is given, truncated dumps are rejected too.
+    """
+    if len(data) < HEADER_LEN:
+        return None
+    header = NintendoDSHeader(data)
+    if not header.logoIsValid() or not header.checksumIsValid():
+        return None
+    if fileSize is not None and fileSize < header.dataEnd():
+        return None
+    return header
+
+
+# For each flags byte of an LZ-style compressed stream (most
+# significant bit first), the runs it describes: a positive number is
+# a run of that many literal bytes, and 0 is a back-reference. This
+# lets the decompressors copy literal runs with one slice assignment.
+def _makeFlagRuns():
+    table = []
+    for flags in range(256):
+        runs = []
+        for bit in range(7, -1, -1):
+            if flags & (1 << bit):
+                runs.append(0)
+            elif runs and runs[-1]:
+                runs[-1] += 1
+            else:
+                runs.append(1)
+        table.append(tuple(runs))
+    return table
+_FLAG_RUNS = _makeFlagRuns()
+
+
+def decompressBlz(data):
+    """
+    Decompress "bottom-up LZ" (BLZ) data, the format used for
+    compressed ARM9 and ARM7 binaries and overlays. It's decompressed
+    from the end backwards, into one preallocated buffer. Data that
+    isn't actually compressed is returned as an unchanged copy.
+    """
+    if len(data) < 8:
+        return bytearray(data)
+    encLenAndHeaderLen, extraLen = struct.unpack_from('<II', data, len(data) - 8)
+    if extraLen == 0:
+        return bytearray(data)
+
+    headerLen = encLenAndHeaderLen >> 24
+    encLen = encLenAndHeaderLen & 0xFFFFFF
+    # Everything before the compressed part is stored uncompressed
+    end = len(data) - encLen
+    if not 8 <= headerLen <= encLen <= len(data):
+        raise ValueError('Invalid BLZ footer')
+
+    # Indexing bytes is quicker than indexing other buffer types
+    if not isinstance(data, bytes):
+        data = bytes(data)
+    out = bytearray(len(data) + extraLen)
+    out[:end] = data[:end]
+    src = len(data) - headerLen
+    dst = len(out)
+
+    while src > end and dst > end:
+        src -= 1
+        for run in _FLAG_RUNS[data[src]]:
+            if run:
+                # Literal bytes, copied downwards in the same order
+                if run > src - end or run > dst - end:
+                    run = min(src - end, dst - end)
+                    if run <= 0:
+                        break
+                src -= run
+                dst -= run
+                out[dst : dst+run] = data[src : src+run]
+            else:
+                if src - 2 < end:
+                    break
+                src -= 2
+                info = data[src + 1] << 8 | data[src]
+                length = (info >> 12) + 3
+                disp = (info & 0xFFF) + 3
+                if length > dst - end:
+                    length = dst - end
+
+                if length <= disp:
+                    out[dst-length : dst] = out[dst-length+disp : dst+disp]
+                else:
+                    # Overlapping copy: the disp bytes after dst repeat
+                    # downwards, so the result ends with them
+                    pattern = out[dst : dst+disp]
+                    out[dst-length : dst] = (pattern * (length // disp + 1))[-length:]
+                dst -= length
+            if dst <= end:
+                break
+
+    return out
+
+
+def _lzHeader(data, expectedType):
+    """
+    Parse the header of LZ10/LZ11 data. Returns (decompressed size,
+    data offset).
+    """
+    header, = struct.unpack_from('<I', data, 0)
+    if header & 0xFF != expectedType:
+        raise TypeError('This isn\'t LZ' + hex(expectedType)[2:] + '-compressed data')
+    size = header >> 8
+    if size == 0 and len(data) >= 8:
+        # Extended header, for data of 16 MiB or more
+        size, = struct.unpack_from('<I', data, 4)
+        return size, 8
+    return size, 4
+
+
+def _lzCopy(out, dst, disp, length):
+    """
+    Copy length bytes to out[dst:] from disp bytes before it. If the
+    copy overlaps itself, the disp bytes it starts from repeat, so
+    they're repeated with one multiplication rather than copied a
+    chunk at a time.
+    """
+    src = dst - disp
+    if src < 0:
+        raise ValueError('LZ back-reference before the start of the data')
+    out[dst : dst+length] = (out[src : dst] * (length // disp + 1))[:length]
+
+
+def decompressLz10(data, limit=None):
+    """
+    Decompress LZ10 (GBA/DS BIOS "LZ77") compressed data. If limit is
+    given, stop after that many decompressed bytes.
+    """
+    size, src = _lzHeader(data, 0x10)
+    if limit is not None:
+        size = min(size, limit)
+    if not isinstance(data, bytes):
+        data = bytes(data)
+    out = bytearray(size)
+    dst = 0
+
+    while dst < size:
+        flags = data[src]; src += 1
+        for run in _FLAG_RUNS[flags]:
+            if run:
+                if run > size - dst:
+                    run = size - dst
+                out[dst : dst+run] = data[src : src+run]
+                src += run
+                dst += run
+            else:
+                b0 = data[src]
+                length = (b0 >> 4) + 3
+                disp = ((b0 & 0xF) << 8 | data[src + 1]) + 1
+                src += 2
+                if length > size - dst:
+                    length = size - dst
+                if length <= disp <= dst:
+                    out[dst : dst+length] = out[dst-disp : dst-disp+length]
+                else:
+                    _lzCopy(out, dst, disp, length)
+                dst += length
+            if dst >= size:
+                break
+
+    return out
+
+
+def decompressLz11(data, limit=None):
+    """
+    Decompress LZ11 compressed data. If limit is given, stop after
+    that many decompressed bytes.
+    """
+    size, src = _lzHeader(data, 0x11)
+    if limit is not None:
+        size = min(size, limit)
+    if not isinstance(data, bytes):
+        data = bytes(data)
+    out = bytearray(size)
+    dst = 0
+
+    while dst < size:
+        flags = data[src]; src += 1
+        for run in _FLAG_RUNS[flags]:
+            if run:
+                if run > size - dst:
+                    run = size - dst
+                out[dst : dst+run] = data[src : src+run]
+                src += run
+                dst += run
+            else:
+                b0 = data[src]
+                indicator = b0 >> 4
+                if indicator == 0:
+                    b1, b2 = data[src + 1], data[src + 2]
+                    length = ((b0 & 0xF) << 4 | b1 >> 4) + 0x11
+                    disp = ((b1 & 0xF) << 8 | b2) + 1
+                    src += 3
+                elif indicator == 1:
+                    b1, b2, b3 = data[src + 1], data[src + 2], data[src + 3]
+                    length = ((b0 & 0xF) << 12 | b1 << 4 | b2 >> 4) + 0x111
+                    disp = ((b2 & 0xF) << 8 | b3) + 1
+                    src += 4
+                else:
+                    length = indicator + 1
+                    disp = ((b0 & 0xF) << 8 | data[src + 1]) + 1
+                    src += 2
+                if length > size - dst:
+                    length = size - dst
+                if length <= disp <= dst:
+                    out[dst : dst+length] = out[dst-disp : dst-disp+length]
+                else:
+                    _lzCopy(out, dst, disp, length)
+                dst += length
+            if dst >= size:
+                break
+
+    return out
+
+
+def decompressLz(data, limit=None):
+    """
+    Decompress LZ10 or LZ11 data, depending on its header.
+    """
+    if data[0] == 0x11:
+        return decompressLz11(data, limit)
+    return decompressLz10(data, limit)
+
+
+# Magic numbers of common file formats, and the names they're known
+# by (usually their file extensions)
+FILE_MAGICS = {
+    b'NARC': 'NARC',
+    b'SDAT': 'SDAT',
+    b'SSEQ': 'SSEQ',
+    b'SSAR': 'SSAR',
+    b'SBNK': 'SBNK',
+    b'SWAR': 'SWAR',
+    b'STRM': 'STRM',
+    b'RGCN': 'NCGR',
+    b'RLCN': 'NCLR',
+    b'RCSN': 'NSCR',
+    b'RECN': 'NCER',
+    b'RNAN': 'NANR',
+    b'BMD0': 'NSBMD',
+    b'BTX0': 'NSBTX',
+    b'BCA0': 'NSBCA',
+    b'BTP0': 'NSBTP',
+    b'BTA0': 'NSBTA',
+    b'BMA0': 'NSBMA',
+    b'BVA0': 'NSBVA',
+    b'MESG': 'BMG',
+}
+
+# How much of each file sniffFile() looks at, and how much of a
+# compressed file it decompresses to find the magic number inside
+SNIFF_LEN = 0x40
+SNIFF_DECOMPRESSED_LEN = 0x10
+
+
+def _sniffMagic(head):
+    type = FILE_MAGICS.get(bytes(head[:4]))
+    if type == 'BMG' and bytes(head[4:8]) != b'bmg1':
+        return None
+    return type
+
+
+def sniffFile(data):
+    """
+    Guess the type of a file from its first few bytes, looking inside
+    LZ10/LZ11 compression if needed. Returns (type, compression):
+    type is a name from FILE_MAGICS, 'empty', or None if unknown;
+    compression is 'LZ10', 'LZ11' or None. Only the first SNIFF_LEN
+    bytes of data are read.
+    """
+    head = data[:SNIFF_LEN]
+    if not len(head):
+        return 'empty', None
+
+    type = _sniffMagic(head)
+    if type is not None or len(head) < 5 or head[0] not in (0x10, 0x11):
+        return type, None
+
+    # Could be compressed: it is if the start of it decompresses
+    # properly. The first token can't be a back-reference, since
+    # there's nothing to refer back to yet.
+    compression = 'LZ10' if head[0] == 0x10 else 'LZ11'
+    size = int.from_bytes(head[1:4], 'little')
+    flagsOffset = 4
+    if size == 0:
+        # Extended LZ11 header, with the size in the next word
+        flagsOffset = 8
+        if compression == 'LZ10' or len(head) <= flagsOffset:
+            return None, None
+    if head[flagsOffset] & 0x80:
+        return None, None
+    if compression == 'LZ10' and size > 9 * len(data):
+        return None, None
+    limit = min(size, SNIFF_DECOMPRESSED_LEN) if size else SNIFF_DECOMPRESSED_LEN
+    try:
+        decompressed = decompressLz(head, limit)
+    except (IndexError, ValueError, struct.error):
+        return None, None
+    if len(decompressed) != limit:
+        return None, None
+    return _sniffMagic(decompressed), compression
+
+
+class FileTypeIndex:
+    """
+    The types of all files in a ROM, as found by sniffFile(): file IDs
+    by type, and the compression of each compressed file.
+    """
+    def __init__(self, sniffed):
+        # type -> list of file IDs (unknown files are under None)
+        self.types = {}
+        # file ID -> 'LZ10' or 'LZ11'
+        self.compression = {}
+        for fid, (type, compression) in enumerate(sniffed):
+            self.types.setdefault(type, []).append(fid)
+            if compression is not None:
+                self.compression[fid] = compression
+
+
+    def filesOfType(self, type, compressed=None):
+        """
+        Return the IDs of files of some type. If compressed is True or
+        False, only compressed or uncompressed ones are returned.
+        """
+        fids = self.types.get(type, [])
+        if compressed is None:
+            return list(fids)
+        return [fid for fid in fids if (fid in self.compression) == compressed]
+
+
+    def census(self):
+        """
+        Return a dict of the number of files of each type.
+        """
+        return {type: len(fids) for type, fids in self.types.items()}
+
+
+    def __str__(self):
+        known = sum(len(fids) for type, fids in self.types.items() if type is not None)
+        return ('<file type index: ' + str(known) + ' known, '
+                + str(len(self.types.get(None, []))) + ' unknown, '
+                + str(len(self.compression)) + ' compressed>')
+
+
+class NARC:
+    """
+    A NARC archive: a FAT (BTAF), a filename table (BTNF) and file
+    data (GMIF), like a miniature ROM filesystem inside one file. The
+    files are memoryviews into the archive data (so, for a lazily
+    loaded ROM, into the memory-mapped ROM file), and opening an
+    archive copies none of them. Writable archive data, such as a file
+    of an eagerly loaded ROM, is copied once instead, so that it can
+    still be resized.
+    """
+
+    def __init__(self, data=None):
+        self.filenames = Folder()
+        self.files = []
+        self._narcCache = {}
+        if data is not None:
+            self._initFromData(data)
+
+
+    def _initFromData(self, data):
+        """
+        Initialize this archive from existing data.
+        """
+        data = memoryview(data)
+        if not data.readonly:
+            # Views of writable data (an eagerly loaded ROM's files are
+            # bytearrays) would stop it from being resized, so work on
+            # a copy of it instead
+            data = memoryview(bytes(data))
+        if len(data) < 0x10 or bytes(data[:4]) != b'NARC':
+            raise ValueError('This isn\'t a NARC archive')
+        headerSize, numBlocks = struct.unpack_from('<2H', data, 0xC)
+
+        blocks = {}
+        off = headerSize
+        for _ in range(numBlocks):
+            if off + 8 > len(data):
+                break
+            magic, size = struct.unpack_from('<4sI', data, off)
+            if size < 8:
+                raise ValueError('Invalid ' + repr(magic)[2:-1] + ' block size in NARC')
+            blocks[magic] = (off + 8, min(off + size, len(data)))
+            off += size
+        if b'BTAF' not in blocks or b'GMIF' not in blocks:
+            raise ValueError('NARC is missing its BTAF or GMIF block')
+
+        btafStart, btafEnd = blocks[b'BTAF']
+        count, = struct.unpack_from('<H', data, btafStart)
+        if btafStart + 4 + 8 * count > btafEnd:
+            raise ValueError('NARC BTAF block is too short for '
+                             + str(count) + ' files')
+        entries = array.array('I', bytes(data[btafStart + 4 : btafStart + 4 + 8 * count]))
+        if sys.byteorder != 'little':
+            entries.byteswap()
+
+        # FAT offsets are relative to the start of the GMIF data
+        gmifStart, gmifEnd = blocks[b'GMIF']
+        starts = array.array('I', (gmifStart + start for start in entries[0::2]))
+        ends = array.array('I', (gmifStart + end for end in entries[1::2]))
+        if any(end < start or end > gmifEnd for start, end in zip(starts, ends)):
+            raise ValueError('NARC file entry out of bounds')
+        self.files = LazyFileList(data, starts, ends)
+
+        if b'BTNF' in blocks:
+            btnfStart, btnfEnd = blocks[b'BTNF']
+            self.filenames = load(data[btnfStart:btnfEnd])
+
+
+    def getFileByName(self, filename):
+        """
+        Return the data for the file with the given filename (path).
+        This is a convenience function.
+        """
+        fid = self.filenames.idOf(filename)
+        if fid is None:
+            raise ValueError('Cannot find file ID of "' + filename + '"')
+        return self.files[fid]
+
+
+    def resolvePath(self, path):
+        """
+        Return the data for the file at path, which can continue into
+        NARC archives nested in this one; see
+        NintendoDSRom.resolvePath().
+        """
+        return _resolvePath(self.filenames, self.files, path, self._narcCache)
+
+
+    def __str__(self):
+        return '<narc (' + str(len(self.files)) + ' files)>'
+
+
+    def __repr__(self):
+        return '<' + type(self).__name__ + ' (' + str(len(self.files)) + ' files)>'
+
+
+def _fileIdentity(files, fid):
+    """
+    Return something that stays the same (by identity) until file fid
+    is replaced: None for a file that's still a view of what it was
+    loaded from, and otherwise the file's data.
+    """
+    if isinstance(files, LazyFileList) and files.isOriginal(fid):
+        return None
+    return files[fid]
+
+
+def _resolvePath(filenames, files, path, narcCache):
+    """
+    Find the data for the file at path, where each part of the path
+    that names a NARC archive can be followed by a path inside it,
+    e.g. "a/0/1/2.narc/15" or "data/maps.narc/town/tiles.narc/3".
+    Inside an archive, a number that isn't a filename is a file ID,
+    for archives without filenames. Opened archives are cached in
+    narcCache, by their paths, so each lookup is a few dict lookups.
+    """
+    parts = path.strip('/').split('/')
+    start = 0
+    archivePath = ''
+    while True:
+        # Find the part of the path that names a file at this level
+        fid = None
+        for end in range(start + 1, len(parts) + 1):
+            fid = filenames.idOf('/'.join(parts[start:end]))
+            if fid is not None:
+                break
+        if fid is None and parts[start].isdigit() and int(parts[start]) < len(files):
+            fid, end = int(parts[start]), start + 1
+        if fid is None or fid >= len(files):
+            raise ValueError('Cannot find "' + '/'.join(parts[start:])
+                             + '" in "' + (archivePath or '/') + '"')
+        if end == len(parts):
+            return files[fid]
+
+        archivePath += '/'.join(parts[start:end]) + '/'
+        identity = _fileIdentity(files, fid)
+        cached = narcCache.get(archivePath)
+        if cached is None or cached[0] is not identity:
+            cached = narcCache[archivePath] = (identity, NARC(files[fid]))
+        narc = cached[1]
+        filenames, files = narc.filenames, narc.files
+        start = end
+
+
+class ModuleParams:
+    """
+    The Nitro SDK "module params" block of an ARM9 or ARM7 binary,
+    which the ROM header's code settings pointer points to. It
+    describes the autoload blocks and whether the binary is
+    compressed.
+    """
+    _STRUCT = struct.Struct('<9I')
+    NITRO_CODE_BE = 0xDEC00621
+    NITRO_CODE_LE = 0x2106C0DE
+
+    def __init__(self, autoloadListStart, autoloadListEnd, autoloadStart,
+            staticBssStart, staticBssEnd, compressedStaticEnd, sdkVersion):
+        self.autoloadListStart = autoloadListStart
+        self.autoloadListEnd = autoloadListEnd
+        self.autoloadStart = autoloadStart
+        self.staticBssStart = staticBssStart
+        self.staticBssEnd = staticBssEnd
+        self.compressedStaticEnd = compressedStaticEnd
+        self.sdkVersion = sdkVersion
+
+
+    @classmethod
+    def fromCode(cls, code, ramAddress, paramsAddress):
+        """
+        Find and parse the module params in a code binary loaded at
+        ramAddress. Returns None if there aren't any.
+        """
+        offset = paramsAddress - ramAddress
+        if not paramsAddress or not 0 <= offset <= len(code) - cls._STRUCT.size:
+            return None
+        fields = cls._STRUCT.unpack_from(code, offset)
+        if fields[7] != cls.NITRO_CODE_BE or fields[8] != cls.NITRO_CODE_LE:
+            return None
+        params = cls(*fields[:7])
+        params.offset = offset
+        return params
+
+
+def decompressCode(code, ramAddress, paramsAddress):
+    """
+    Return a decompressed copy of an ARM9 or ARM7 binary, or the
+    binary itself if it isn't compressed. Its module params are
+    updated to say it's no longer compressed, like the SDK's startup
+    code does.
+    """
+    params = ModuleParams.fromCode(code, ramAddress, paramsAddress)
+    if params is None or not params.compressedStaticEnd:
+        return code
+    compressedEnd = params.compressedStaticEnd - ramAddress
+    if not 0 < compressedEnd <= len(code):
+        raise ValueError('Compressed code end is out of bounds: '
+                         + hex(params.compressedStaticEnd))
+
+    out = decompressBlz(memoryview(code)[:compressedEnd])
+    out.extend(memoryview(code)[compressedEnd:])
+    struct.pack_into('<I', out, params.offset + 0x14, 0)
+    return out
+
+
+class CodeSection:
+    """
+    One section of a main code file: the static module itself, or an
+    autoload block that the startup code copies somewhere else (ITCM,
+    DTCM, ...). data is a view into the (decompressed) code file,
+    starting fileOffset bytes into it.
+    """
+    def __init__(self, name, ramAddress, data, bssSize, fileOffset=0):
+        self.name = name
+        self.ramAddress = ramAddress
+        self.data = data
+        self.bssSize = bssSize
+        self.fileOffset = fileOffset
+
+
+    def __str__(self):
+        return ('<code section "' + self.name + '" at ' + hex(self.ramAddress)
+                + ' (' + hex(len(self.data)) + ' + ' + hex(self.bssSize) + ' bss)>')
+
+
+def _autoloadName(ramAddress):
+    """
+    Guess what memory an autoload block is for, from its address.
+    """
+    if ramAddress < 0x02000000:
+        return 'ITCM'
+    if 0x027C0000 <= ramAddress < 0x02800000:
+        return 'DTCM'
+    if 0x03000000 <= ramAddress < 0x03800000:
+        return 'SHARED_WRAM'
+    if 0x03800000 <= ramAddress < 0x04000000:
+        return 'ARM7_WRAM'
+    return 'AUTOLOAD'
+
+
+class MainCodeFile:
+    """
+    An ARM9 or ARM7 main code file, decompressed and split into its
+    static module and its autoload blocks using its module params.
+    """
+    def __init__(self, data, ramAddress, codeSettingsPointerAddress=0):
+        self.ramAddress = ramAddress
+        self.data = decompressCode(data, ramAddress, codeSettingsPointerAddress)
+        self.compressed = self.data is not data
+        self.moduleParams = ModuleParams.fromCode(self.data, ramAddress,
+                                                  codeSettingsPointerAddress)
+        self.sections = self._findSections()
+
+
+    def _findSections(self):
+        """
+        Split the code file into CodeSections using the autoload list
+        from its module params. Without module params, the whole file
+        is one section.
+        """
+        view = memoryview(self.data)
+        params = self.moduleParams
+        if params is None or params.autoloadListStart == params.autoloadListEnd:
+            return [CodeSection('static', self.ramAddress, view, 0)]
+
+        dataOff = params.autoloadStart - self.ramAddress
+        listStart = params.autoloadListStart - self.ramAddress
+        listEnd = params.autoloadListEnd - self.ramAddress
+        if not 0 <= dataOff <= listStart <= listEnd <= len(view):
+            return [CodeSection('static', self.ramAddress, view, 0)]
+
+        # The static module ends where the autoload data starts, and
+        # its BSS (which overwrites the autoload data once that's been
+        # copied) goes up to staticBssEnd
+        staticEnd = self.ramAddress + dataOff
+        sections = [CodeSection('static', self.ramAddress, view[:dataOff],
+                                max(0, params.staticBssEnd - staticEnd))]
+
+        for off in range(listStart, listEnd - 11, 12):
+            ramAddress, size, bssSize = struct.unpack_from('<3I', view, off)
+            sections.append(CodeSection(_autoloadName(ramAddress), ramAddress,
+                                        view[dataOff : dataOff+size], bssSize,
+                                        dataOff))
+            dataOff += size
+        return sections
+
+
+    @property
+    def autoloads(self):
+        return self.sections[1:]
+
+
+def findPointers(data, baseAddress, ranges):
+    """
+    Find all aligned 32-bit words in data (mapped at baseAddress,
+    which must be word-aligned) whose values fall inside any of the
+    given (start, end) address ranges. Thumb pointers (with the low
+    bit set) count too. Returns two lists: the addresses of the words,
+    and their values.
+
+    This uses NumPy if it's installed, and is much slower without it.
+    """
+    count = len(data) // 4
+    if numpy is not None:
+        words = numpy.frombuffer(data, dtype='<u4', count=count)
+        mask = numpy.zeros(count, dtype=bool)
+        for start, end in ranges:
+            mask |= (words >= start) & (words < end)
+        positions = numpy.flatnonzero(mask)
+        return (positions * 4 + baseAddress).tolist(), words[positions].tolist()
+
+    words = array.array('I', bytes(data[:count * 4]))
+    if sys.byteorder != 'little':
+        words.byteswap()
+    addresses = []
+    values = []
+    for i, word in enumerate(words):
+        for start, end in ranges:
+            if start <= word < end:
+                addresses.append(baseAddress + 4 * i)
+                values.append(word)
+                break
+    return addresses, values
+
+
+def findSeeds(sections):
+    """
+    Find the pointers in a list of CodeSections that point into any of
+    them, to seed analysis with. Returns two lists: (address, target)
+    pairs for every pointer, and the addresses of Thumb functions:
+    targets of odd pointers that are a Thumb PUSH instruction (odd
+    pointers to strings and other byte data are common, so the
+    prologue check keeps those out). Pointers to Thumb functions have
+    the low bit of their target cleared.
+    """
+    ranges = [(s.ramAddress, s.ramAddress + len(s.data) + s.bssSize) for s in sections]
+    # DTCM is data-only, and nothing executes from BSS
+    codeSections = [s for s in sections if s.name != 'DTCM']
+
+    def isThumbPush(ea):
+        for section in codeSections:
+            off = ea - section.ramAddress
+            if 0 <= off < len(section.data) - 1:
+                return section.data[off + 1] & 0xFE == 0xB4
+        return False
+
+    refs = []
+    for section in sections:
+        addresses, values = findPointers(section.data, section.ramAddress, ranges)
+        refs.extend(zip(addresses, values))
+
+    seeds = []
+    thumbFunctions = set()
+    for ea, target in refs:
+        if target & 1 and isThumbPush(target & ~1):
+            target &= ~1
+            thumbFunctions.add(target)
+        seeds.append((ea, target))
+    return seeds, sorted(thumbFunctions)
+
+
+# Bundled function signatures: (name, mode, pattern), where mode is
+# 'arm' or 'thumb' and the pattern is hex bytes, with ?? for any byte.
+# These are only the Nitro SDK's Thumb wrappers around BIOS calls
+# ("swi N; bx lr"), named after the BIOS functions (see GBATEK).
+# Patterns for the rest of the SDK (MI_*, OS_*, FS_*...) aren't
+# bundled: their code differs between SDK versions and compiler
+# settings, so they have to be made from a game that's known to use
+# the same SDK build, and loaded from files listed in the
+# NDS_SIGNATURES environment variable, in the format
+# parseSignatures() reads.
+SDK_SIGNATURES = [
+    ('SVC_SoftReset',                          'thumb', '00 DF 70 47'),
+    ('SVC_WaitByLoop',                         'thumb', '03 DF 70 47'),
+    ('SVC_IntrWait',                           'thumb', '04 DF 70 47'),
+    ('SVC_VBlankIntrWait',                     'thumb', '05 DF 70 47'),
+    ('SVC_Halt',                               'thumb', '06 DF 70 47'),
+    ('SVC_Sleep',                              'thumb', '07 DF 70 47'),
+    ('SVC_SoundBias',                          'thumb', '08 DF 70 47'),
+    ('SVC_Div',                                'thumb', '09 DF 70 47'),
+    # Div, then moving the remainder (r1) into r0, with either
+    # encoding of "mov r0, r1"
+    ('SVC_DivRem',                             'thumb', '09 DF 08 1C 70 47'),
+    ('SVC_DivRem',                             'thumb', '09 DF 08 46 70 47'),
+    ('SVC_CpuSet',                             'thumb', '0B DF 70 47'),
+    ('SVC_CpuFastSet',                         'thumb', '0C DF 70 47'),
+    ('SVC_Sqrt',                               'thumb', '0D DF 70 47'),
+    ('SVC_GetCRC16',                           'thumb', '0E DF 70 47'),
+    ('SVC_IsDebugger',                         'thumb', '0F DF 70 47'),
+    ('SVC_BitUnPack',                          'thumb', '10 DF 70 47'),
+    ('SVC_LZ77UnCompReadNormalWrite8bit',      'thumb', '11 DF 70 47'),
+    ('SVC_LZ77UnCompReadByCallbackWrite16bit', 'thumb', '12 DF 70 47'),
+    ('SVC_HuffUnCompReadByCallback',           'thumb', '13 DF 70 47'),
+    ('SVC_RLUnCompReadNormalWrite8bit',        'thumb', '14 DF 70 47'),
+    ('SVC_RLUnCompReadByCallbackWrite16bit',   'thumb', '15 DF 70 47'),
+    ('SVC_GetSineTable',                       'thumb', '1A DF 70 47'),
+    ('SVC_GetPitchTable',                      'thumb', '1B DF 70 47'),
+    ('SVC_GetVolumeTable',                     'thumb', '1C DF 70 47'),
+    ('SVC_CustomPost',                         'thumb', '1F DF 70 47'),
+]
+
+
+# Signatures with wildcards that have fewer known bytes than this
+# can match almost anywhere, so the loader leaves their matches out
+# (see trustedNames())
+MIN_WILDCARD_SIGNATURE_LEN = 8
+
+
+def parseSignatures(text):
+    """
+    Parse a signature database: one signature per line, as a name, a
+    mode (arm or thumb) and hex bytes with ?? wildcards, separated by
+    whitespace. "#" starts a comment. Returns a list of (name, mode,
+    pattern) tuples like SDK_SIGNATURES.
+    """
+    signatures = []
+    for lineNum, line in enumerate(text.splitlines(), 1):
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+        parts = line.split(None, 2)
+        if len(parts) < 3 or parts[1].lower() not in ('arm', 'thumb'):
+            raise ValueError('Invalid signature on line ' + str(lineNum) + ': ' + line)
+        signatures.append((parts[0], parts[1].lower(), parts[2]))
+    return signatures
+
+
+def loadSignatures():
+    """
+    Return the bundled signatures plus the ones in the files listed
+    (separated by os.pathsep) in the NDS_SIGNATURES environment
+    variable.
+    """
+    signatures = list(SDK_SIGNATURES)
+    for path in os.environ.get('NDS_SIGNATURES', '').split(os.pathsep):
+        if path:
+            with open(path, 'r', encoding='utf-8') as f:
+                signatures.extend(parseSignatures(f.read()))
+    return signatures
+
+
+def _patternRegex(pattern):
+    """
+    Convert a hex pattern with ?? wildcards to a bytes regex.
+    """
+    parts = []
+    for byte in pattern.split():
+        if byte == '??':
+            parts.append(b'.')
+        else:
+            parts.append(re.escape(bytes([int(byte, 16)])))
+    return b''.join(parts)
+
+
+def trustedNames(names, signatures=None):
+    """
+    Leave out the (address, name, thumb) matches of signatures (by
+    default, loadSignatures()) that have wildcards and fewer than
+    MIN_WILDCARD_SIGNATURE_LEN known bytes, unless the same name also
+    has a signature without that problem.
+    """
+    if signatures is None:
+        signatures = loadSignatures()
+    weak = set()
+    strong = set()
+    for name, _, pattern in signatures:
+        tokens = pattern.split()
+        if '??' in tokens and len(tokens) - tokens.count('??') < MIN_WILDCARD_SIGNATURE_LEN:
+            weak.add(name)
+        else:
+            strong.add(name)
+    weak -= strong
+    if not weak:
+        return list(names)
+    return [entry for entry in names if entry[1] not in weak]
+
+
+class SignatureMatcher:
+    """
+    Matches many function signatures against code at once. Each
+    signature is anchored on its first fully-known, even-aligned
+    halfword; one pass over the image (vectorized with NumPy, if it's
+    installed) finds every position where any anchor occurs, and only
+    the signatures with that anchor are then checked there. The cost
+    is one scan per image, plus a little per candidate, no matter how
+    many signatures there are.
+    """
+    def __init__(self, signatures=None):
+        if signatures is None:
+            signatures = loadSignatures()
+        self.signatures = list(signatures)
+
+        # anchor halfword -> [(offset of the anchor in the pattern,
+        # pattern length, name, thumb, regex)], longest patterns first
+        self._anchors = {}
+        # Signatures without an anchor (which start with wildcards on
+        # every even offset) are matched with a regex scan instead
+        self._unanchored = []
+
+        for name, mode, pattern in self.signatures:
+            tokens = pattern.split()
+            regex = re.compile(_patternRegex(pattern), re.DOTALL)
+            entry = (len(tokens), name, mode == 'thumb', regex)
+            for off in range(0, len(tokens) - 1, 2):
+                if '??' not in tokens[off : off+2]:
+                    anchor = int(tokens[off], 16) | int(tokens[off + 1], 16) << 8
+                    self._anchors.setdefault(anchor, []).append((off,) + entry)
+                    break
+            else:
+                self._unanchored.append(entry)
+
+        for entries in self._anchors.values():
+            entries.sort(key=lambda entry: -entry[1])
+
+
+    def _anchorPositions(self, data):
+        """
+        Yield (anchor, offset) for every even offset in data where one
+        of the anchors occurs.
+        """
+        if numpy is not None:
+            halfwords = numpy.frombuffer(data, dtype='<u2', count=len(data) // 2)
+            anchors = numpy.fromiter(self._anchors, dtype='<u2', count=len(self._anchors))
+            positions = numpy.flatnonzero(numpy.isin(halfwords, anchors))
+            return zip(halfwords[positions].tolist(), (positions * 2).tolist())
+
+        halfwords = array.array('H', data[:len(data) & ~1])
+        if sys.byteorder != 'little':
+            halfwords.byteswap()
+        anchors = self._anchors
+        return [(halfword, 2 * i) for i, halfword in enumerate(halfwords)
+                if halfword in anchors]
+
+
+    def match(self, data, baseAddress):
+        """
+        Find the signatures that match data (mapped at baseAddress,
+        which must be even) at exactly one properly aligned address;
+        ones that match at several are ambiguous and left out. Where
+        several signatures match at the same address, the longest
+        wins. Returns a sorted list of (address, name, thumb) tuples.
+        """
+        if not isinstance(data, bytes):
+            data = bytes(data)
+
+        # (position, thumb) -> (length, name) of the best match there
+        best = {}
+        def found(pos, length, name, thumb):
+            alignment = 2 if thumb else 4
+            if pos >= 0 and (baseAddress + pos) % alignment == 0:
+                if best.get((pos, thumb), (0,))[0] < length:
+                    best[pos, thumb] = (length, name)
+
+        for anchor, anchorPos in self._anchorPositions(data):
+            for off, length, name, thumb, regex in self._anchors[anchor]:
+                pos = anchorPos - off
+                if pos >= 0 and regex.match(data, pos):
+                    found(pos, length, name, thumb)
+        for length, name, thumb, regex in self._unanchored:
+            for m in re.finditer(b'(?=' + regex.pattern + b')', data, re.DOTALL):
+                found(m.start(), length, name, thumb)
+
+        addresses = {}
+        for (pos, thumb), (_, name) in best.items():
+            addresses.setdefault((name, thumb), []).append(baseAddress + pos)
+        return sorted((matches[0], name, thumb)
+                      for (name, thumb), matches in addresses.items()
+                      if len(matches) == 1)
+
+
+ANALYSIS_PLAN_VERSION = 2
+_ANALYSIS_PLAN_MAGIC = b'NDSP'
+
+
+def _packWords(values):
+    words = array.array('I', values)
+    if sys.byteorder != 'little':
+        words.byteswap()
+    return words.tobytes()
+
+
+def _unpackWords(data, offset, count):
+    words = array.array('I', data[offset : offset + 4 * count])
+    if sys.byteorder != 'little':
+        words.byteswap()
+    return words.tolist()
+
+
+def _packNames(names):
+    """
+    Pack a list of (address, name, thumb) functions as arrays of
+    addresses and thumb flags, then the names, NUL-separated.
+    """
+    encoded = '\0'.join(name for _, name, _ in names).encode('latin-1')
+    return (_packWords([address for address, _, _ in names])
+            + bytes(bool(thumb) for _, _, thumb in names)
+            + struct.pack('<I', len(encoded)) + encoded)
+
+
+def _unpackNames(data, offset, count):
+    """
+    Unpack count functions packed by _packNames() at offset. Returns
+    them, and the offset after them.
+    """
+    addresses = _unpackWords(data, offset, count)
+    offset += 4 * count
+    thumbs = data[offset : offset+count]
+    offset += count
+    namesLen, = struct.unpack_from('<I', data, offset)
+    names = data[offset + 4 : offset + 4 + namesLen].decode('latin-1').split('\0')
+    offset += 4 + namesLen
+    if not count:
+        return [], offset
+    return [(address, name, bool(thumb)) for address, name, thumb
+            in zip(addresses, names, thumbs)], offset
+
+
+def _overlayKey(ov):
+    """
+    Return a key identifying an Overlay's code, as stored in the ROM,
+    and where it's loaded: overlays with the same key have the same
+    functions at the same addresses.
+    """
+    h = hashlib.sha1(struct.pack('<3I', ov.ramAddress, ov.ramSize, ov.flags & 1))
+    h.update(ov.data)
+    return h.digest()
+
+
+class AnalysisPlan:
+    """
+    Everything worked out about a main code file before any of it is
+    put in a database: how it splits into sections (and, if it was
+    compressed, its decompressed bytes), the pointers and Thumb
+    functions to seed analysis with (see findSeeds()) and the
+    functions named by signatures. Working it out means decompressing
+    and scanning the code, so plans can be saved in a compact binary
+    form (see NintendoDSRom.analysisPlan()) and replayed later.
+
+    The functions signatures found in overlays are kept with the plan
+    too, by _overlayKey(), as each overlay is first matched (see
+    NintendoDSRom.overlayFunctionNames()).
+    """
+    def __init__(self):
+        self.compressed = False
+        self.data = None
+        # (name, ramAddress, fileOffset, size, bssSize)
+        self.sections = []
+        # (address, target)
+        self.refs = []
+        self.thumbFunctions = []
+        # (address, name, thumb)
+        self.names = []
+        # {overlay key: [(address, name, thumb)]}
+        self.overlayNames = {}
+
+
+    @classmethod
+    def fromCode(cls, codeFile, matcher=None):
+        """
+        Work out the plan for a MainCodeFile, matching signatures with
+        matcher (by default, a SignatureMatcher for loadSignatures()).
+        """
+        if matcher is None:
+            matcher = SignatureMatcher()
+        self = cls()
+        self.compressed = codeFile.compressed
+        if codeFile.compressed:
+            self.data = bytes(codeFile.data)
+        self.sections = [(s.name, s.ramAddress, s.fileOffset, len(s.data), s.bssSize)
+                         for s in codeFile.sections]
+        self.refs, self.thumbFunctions = findSeeds(codeFile.sections)
+        for section in codeFile.sections:
+            self.names.extend(matcher.match(section.data, section.ramAddress))
+        return self
+
+
+    def codeSections(self, code):
+        """
+        Return the plan's sections as CodeSections. code is the code
+        file as stored in the ROM; it's only used if it wasn't
+        compressed, since otherwise the plan has its decompressed
+        bytes.
+        """
+        view = memoryview(self.data if self.compressed else code)
+        return [CodeSection(name, ramAddress, view[off : off+size], bssSize, off)
+                for name, ramAddress, off, size, bssSize in self.sections]
+
+
+    @classmethod
+    def fromBytes(cls, data, key=b''):
+        """
+        Load a plan saved by toBytes(). Returns None if data isn't one,
+        was saved by a different version of this module, or (if key is
+        given) was saved with a different key.
+        """
+        headerLen = 8 + len(key)
+        if (data[:4] != _ANALYSIS_PLAN_MAGIC
+                or struct.unpack_from('<H', data, 4)[0] != ANALYSIS_PLAN_VERSION
+                or struct.unpack_from('<H', data, 6)[0] != len(key)
+                or data[8:headerLen] != key):
+            return None
+        try:
+            body = zlib.decompress(data[headerLen:])
+        except zlib.error:
+            return None
+
+        self = cls()
+        compressed, numSections, numRefs, numThumb, numNames = \
+            struct.unpack_from('<5I', body, 0)
+        self.compressed = bool(compressed)
+        off = 0x14
+        for i in range(numSections):
+            ramAddress, fileOffset, size, bssSize, nameLen = \
+                struct.unpack_from('<4IB', body, off)
+            name = body[off + 17 : off + 17 + nameLen].decode('latin-1')
+            self.sections.append((name, ramAddress, fileOffset, size, bssSize))
+            off += 17 + nameLen
+
+        addresses = _unpackWords(body, off, numRefs)
+        targets = _unpackWords(body, off + 4 * numRefs, numRefs)
+        self.refs = list(zip(addresses, targets))
+        off += 8 * numRefs
+        self.thumbFunctions = _unpackWords(body, off, numThumb)
+        off += 4 * numThumb
+
+        self.names, off = _unpackNames(body, off, numNames)
+
+        numOverlays, = struct.unpack_from('<I', body, off)
+        off += 4
+        for i in range(numOverlays):
+            ovKey = body[off : off+_FILE_HASH_LEN]
+            count, = struct.unpack_from('<I', body, off + _FILE_HASH_LEN)
+            self.overlayNames[ovKey], off = _unpackNames(body, off + _FILE_HASH_LEN + 4, count)
+
+        if self.compressed:
+            self.data = body[off:]
+        return self
+
+
+    def toBytes(self, key=b''):
+        """
+        Save the plan in a compact binary form: a small header
+        (including key, which fromBytes() checks), then the sections,
+        seeds, names, overlay names and decompressed code as
+        zlib-compressed arrays.
+        """
+        parts = [struct.pack('<5I', int(self.compressed), len(self.sections),
+                             len(self.refs), len(self.thumbFunctions), len(self.names))]
+        for name, ramAddress, fileOffset, size, bssSize in self.sections:
+            encoded = name.encode('latin-1')
+            parts.append(struct.pack('<4IB', ramAddress, fileOffset, size,
+                                     bssSize, len(encoded)) + encoded)
+
+        parts.append(_packWords([address for address, _ in self.refs]))
+        parts.append(_packWords([target for _, target in self.refs]))
+        parts.append(_packWords(self.thumbFunctions))
+
+        parts.append(_packNames(self.names))
+        parts.append(struct.pack('<I', len(self.overlayNames)))
+        for ovKey, names in self.overlayNames.items():
+            parts.append(ovKey + struct.pack('<I', len(names)) + _packNames(names))
+
+        if self.compressed:
+            parts.append(self.data)
+        return (_ANALYSIS_PLAN_MAGIC
+                + struct.pack('<2H', ANALYSIS_PLAN_VERSION, len(key)) + key
+                + zlib.compress(b''.join(parts)))
+
+
+class Overlay:
+    """
+    A single ARM9 or ARM7 overlay: a piece of code that the game loads
+    into RAM on demand.
+    """
+    def __init__(self, data, ramAddress, ramSize, bssSize,
+            staticInitStart, staticInitEnd, fileID, compressedSize, flags):
+        self.data = data
+        self.ramAddress = ramAddress
+        self.ramSize = ramSize
+        self.bssSize = bssSize
+        self.staticInitStart = staticInitStart
+        self.staticInitEnd = staticInitEnd
+        self.fileID = fileID
+        self.compressedSize = compressedSize
+        self.flags = flags
+
+
+    @property
+    def compressed(self):
+        return bool(self.flags & 1)
+
+
+    @property
+    def verifyHash(self):
+        return bool(self.flags & 2)
+
+
+    def __str__(self):
+        return ('<overlay (file ' + str(self.fileID) + ') at '
+                + hex(self.ramAddress) + '>')
+
+
+def loadOverlayTable(table, callback, idsToLoad=None):
+    """
+    Parse an ARM9 or ARM7 overlay table, and return a dict of Overlays
+    by overlay ID. callback(ovID, fileID) is called to get each
+    overlay's data. idsToLoad can be a set of overlay IDs to limit
+    which ones are loaded.
+    """
+    overlays = {}
+    for off in range(0, len(table) - 31, 32):
+        (ovID, ramAddress, ramSize, bssSize, staticInitStart, staticInitEnd,
+            fileID, compressedSizeAndFlags) = struct.unpack_from('<8I', table, off)
+        if idsToLoad is not None and ovID not in idsToLoad:
+            continue
+        overlays[ovID] = Overlay(callback(ovID, fileID), ramAddress, ramSize,
+            bssSize, staticInitStart, staticInitEnd, fileID,
+            compressedSizeAndFlags & 0xFFFFFF, compressedSizeAndFlags >> 24)
+    return overlays
+
+
+class Banner:
+    """
+    A ROM's icon/banner: the title shown in the DS menu, in up to
+    eight languages, and a 32x32 16-color icon. (The animated icons of
+    DSi banners aren't decoded.)
+    """
+    def __init__(self, data):
+        if len(data) < 0x240:
+            raise ValueError('Banner data is too short (' + hex(len(data)) + ' bytes)')
+        self.data = bytes(data)
+        self.version, = struct.unpack_from('<H', self.data, 0)
+        self.checksums = list(struct.unpack_from('<4H', self.data, 2))
+        self.bitmap = self.data[0x20:0x220]
+        self.palette = list(struct.unpack_from('<16H', self.data, 0x220))
+
+        numTitles = 6 + (self.version >= 2) + (self.version >= 3)
+        self.titles = {}
+        for i, language in enumerate(BANNER_LANGUAGES[:numTitles]):
+            off = 0x240 + 0x100 * i
+            if off + 0x100 > len(self.data):
+                break
+            title = self.data[off : off+0x100].decode('utf-16-le', 'replace')
+            self.titles[language] = title.split('\0', 1)[0]
+
+
+    def _checksumRanges(self):
+        """
+        Return (index, start, end) for each of the checksums this
+        banner's version has: each covers a range of the banner.
+        """
+        ranges = [(0, 0x20, 0x840)]
+        if self.version >= 2:
+            ranges.append((1, 0x20, 0x940))
+        if self.version >= 3:
+            ranges.append((2, 0x20, 0xA40))
+        if self.version >= 0x103:
+            ranges.append((3, 0x1240, 0x23C0))
+        return ranges
+
+
+    def checksumsAreValid(self):
+        """
+        Check all of the banner's checksums (CRC16s of the icon and
+        titles, and of the animated icon for DSi banners).
+        """
+        for index, start, end in self._checksumRanges():
+            if len(self.data) < end or crc16(self.data[start:end]) != self.checksums[index]:
+                return False
+        return True
+
+
+    def icon(self):
+        """
+        Decode the icon, as a 32x32x4 NumPy array of RGBA pixels (see
+        decodeIcons()).
+        """
+        return decodeIcons([self])[0]
+
+
+    def __str__(self):
+        title = self.titles.get('english', '').split('\n', 1)[0]
+        return '<banner v' + hex(self.version) + ' "' + title + '">'
+
+
+def decodeIcons(banners):
+    """
+    Decode the icons of many banners (Banners or raw banner data) at
+    once, into one stacked NumPy uint8 array of shape (N, 32, 32, 4):
+    RGBA pixels, with palette color 0 transparent. This needs NumPy;
+    every step is an array operation over all the icons together.
+    """
+    if numpy is None:
+        raise ImportError('Decoding icons needs NumPy')
+    raw = b''.join(bytes(memoryview(b.data if isinstance(b, Banner) else b)[0x20:0x240])
+                   for b in banners)
+    blocks = numpy.frombuffer(raw, dtype=numpy.uint8).reshape(-1, 0x220)
+    count = len(blocks)
+
+    # 4 bits per pixel, low nibble first, in 8x8 tiles; the icon is
+    # 4x4 tiles
+    bitmaps = blocks[:, :0x200]
+    indices = numpy.empty((count, 0x400), dtype=numpy.uint8)
+    indices[:, 0::2] = bitmaps & 0xF
+    indices[:, 1::2] = bitmaps >> 4
+    indices = indices.reshape(count, 4, 4, 8, 8).transpose(0, 1, 3, 2, 4).reshape(count, 32, 32)
+
+    # BGR555 palettes to RGBA
+    colors = blocks[:, 0x200::2].astype(numpy.uint16) | blocks[:, 0x201::2].astype(numpy.uint16) << 8
+    palettes = numpy.empty((count, 16, 4), dtype=numpy.uint8)
+    for channel, shift in enumerate((0, 5, 10)):
+        component = (colors >> shift) & 0x1F
+        palettes[:, :, channel] = (component << 3) | (component >> 2)
+    palettes[:, :, 3] = 0xFF
+    palettes[:, 0, 3] = 0
+
+    return palettes[numpy.arange(count)[:, None, None], indices]
+
+
+def iconSheet(icons, columns=16):
+    """
+    Lay out an (N, 32, 32, 4) array of icons (see decodeIcons()) in a
+    grid with the given number of columns, as one RGBA image array.
+    Unused spots at the end are transparent.
+    """
+    count = len(icons)
+    columns = max(1, min(columns, count))
+    rows = max(1, -(-count // columns))
+    grid = numpy.zeros((rows * columns, 32, 32, 4), dtype=numpy.uint8)
+    grid[:count] = icons
+    return grid.reshape(rows, columns, 32, 32, 4).transpose(0, 2, 1, 3, 4).reshape(
+        rows * 32, columns * 32, 4)
+
+
+def encodePng(image):
+    """
+    Encode an (height, width, 4) uint8 NumPy array of RGBA pixels as a
+    PNG file, and return its bytes.
+    """
+    height, width = image.shape[:2]
+    # Every row starts with a filter type byte (0: none)
+    rows = numpy.zeros((height, width * 4 + 1), dtype=numpy.uint8)
+    rows[:, 1:] = image.reshape(height, width * 4)
+
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data
+                + struct.pack('>I', zlib.crc32(kind + data)))
+
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>2I5B', width, height, 8, 6, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(rows.tobytes()))
+            + chunk(b'IEND', b''))
+
+
+class NintendoDSRom:
+    """
+    A Nintendo DS ROM file (.nds).
+    """
+
+    def __init__(self, data=None):
+
+        self.sourcePath = None
+        if data is None:
+            self._initAsNew()
+        else:
+            self._initFromData(data)
+
+
+    def _initAsNew(self):
+        """
+        Initialize this ROM with default values.
+        """
+
+        self.name = b''
+        self.idCode = b'####'
+        self.developerCode = b'\0\0'
+        self.unitCode = 0
+        self.encryptionSeedSelect = 0
+        self.deviceCapacity = 9
+        self.pad015 = 0
+        self.pad016 = 0
+        self.pad017 = 0
+        self.pad018 = 0
+        self.pad019 = 0
+        self.pad01A = 0
+        self.pad01B = 0
+        self.pad01C = 0
+        self.region = 0
+        self.version = 0
+        self.autostart = 0
+        self.arm7Len = 0
+        self.arm9Len = 0
+        self.arm7Offset = 0
+        self.arm9Offset = 0
+        self.arm9EntryAddress = 0x2000800
+        self.arm9RamAddress = 0x2000000
+        self.arm7EntryAddress = 0x2380000
+        self.arm7RamAddress = 0x2380000
+        self.normalCardControlRegisterSettings = 0x0416657
+        self.secureCardControlRegisterSettings = 0x81808f8
+        self.secureAreaChecksum = 0x0000
+        self.nintendoLogoChecksum = NINTENDO_LOGO_CHECKSUM
+        self.headerChecksum = 0x0000
+        self.secureTransferDelay = 0x0D7E
+        self.arm9CodeSettingsPointerAddress = 0
+        self.arm7CodeSettingsPointerAddress = 0
+        self.secureAreaDisable = b'\0' * 8
+        self.pad088 = b'\0' * 0x38
+        self.nintendoLogo = (b'$\xff\xaeQi\x9a\xa2!=\x84\x82\n\x84\xe4\t\xad'
+            b"\x11$\x8b\x98\xc0\x81\x7f!\xa3R\xbe\x19\x93\t\xce \x10FJJ\xf8'1"
+            b'\xecX\xc7\xe83\x82\xe3\xce\xbf\x85\xf4\xdf\x94\xceK\t\xc1\x94V'
+            b"\x8a\xc0\x13r\xa7\xfc\x9f\x84Ms\xa3\xca\x9aaX\x97\xa3'\xfc\3\x98"
+            b'v#\x1d\xc7a\3\4\xaeV\xbf8\x84\0@\xa7\x0e\xfd\xffR\xfe\3o\x950'
+            b'\xf1\x97\xfb\xc0\x85`\xd6\x80%\xa9c\xbe\3\1N8\xe2\xf9\xa24\xff'
+            b'\xbb>\3Dx\0\x90\xcb\x88\x11:\x94e\xc0|c\x87\xf0<\xaf\xd6%\xe4'
+            b'\x8b8\n\xacr!\xd4\xf8\7')
+        self.debugRomAddress = 0
+        self.pad16C = b'\0' * 0x94
+        self.pad200 = b'\0' * 0x3E00
+
+        self.rsaSignature = b''
+
+        self.arm9 = b''
+        self.arm9PostData = b''
+        self.arm7 = b''
+        self.arm9OverlayTable = b''
+        self.arm7OverlayTable = b''
+        self.iconBanner = b''
+        self.debugRom = b''
+        self.twlHeader = None
+        self._twlRegions = []
+        self.lazy = False
+
+        self.filenames = Folder()
+        self.files = []
+        self.sortedFileIds = []
+        self.romSizeOrRsaSigOffset = 0
+
+        self._fatIndex = FatIndex(array.array('I'), array.array('I'))
+        self._fatStarts = self._fatIndex.starts
+        self._fatEnds = self._fatIndex.ends
+        self._loadedHeader = None
+        self._loadedHeaderData = b''
+        self._loadedFileHashes = None
+        self._loadedFileTypes = None
+        self._narcCache = {}
+        self._analysisPlans = {}
+        self._loadedSecureArea = b''
+        self._loadedFiles = []
+        self._loadedParts = self._parts()
+        self._dirtyFiles = set()
+
+    
+    def _initFromData(self, data):
+        """
+        Initialize this ROM from existing data.
+        """
+        # I could read the header as one huge struct,
+        # but... no.
+        self.headerOffset = 0
+
+        # Memoryviews and mmaps are used as-is: everything below ends
+        # up as a view into them instead of a copy
+        self.lazy = isinstance(data, (memoryview, mmap.mmap))
+        if self.lazy:
+            data = memoryview(data)
+            header = bytes(data[:0x200])
+            if len(header) < 0x200:
+                header += b'\0' * (0x200 - len(header))
+        else:
+            data = bytearray(data)
+            if len(data) < 0x200:
+                data.extend(b'\0' * (0x200 - len(data)))
+                assert len(data) == 0x200, 'ROM data extension to length 0x200 failed (actual new length' + hex(len(data)) + ')'
+            header = data
+
+        def readRaw(length):
+            retVal = header[self.headerOffset : self.headerOffset+length]
+            self.headerOffset += length
+            return retVal
+        def read8():
+            
+            retVal = header[self.headerOffset]
+            self.headerOffset += 1
+            return retVal
+        def read16():
+            
+            retVal, = struct.unpack_from('<H', header, self.headerOffset)
+            self.headerOffset += 2
+            return retVal
+        def read32():
+            
+            retVal, = struct.unpack_from('<I', header, self.headerOffset)
+            self.headerOffset += 4
+            return retVal
+
+        assert self.headerOffset == 0, '(Load) Header offset check at 0x00: '+ hex(self.headerOffset)
+        self.name = readRaw(12).rstrip(b'\0')
+        self.idCode = readRaw(4)
+        self.developerCode = readRaw(2)
+        self.unitCode = read8()
+        self.encryptionSeedSelect = read8()
+        self.deviceCapacity = read8()
         assert self.headerOffset == 0x15, '(Load) Header offset check at 0x15: ' + hex(self.headerOffset)
         self.pad015 = read8()
         self.pad016 = read8()
@@ -523,8 +2662,7 @@ class NintendoDSRom:
         self.normalCardControlRegisterSettings = read32()
         self.secureCardControlRegisterSettings = read32()
         iconBannerOffset = read32()
-        self.secureAreaChecksum = read16() # TODO: Actually recalculate
-                                           # this upon saving.
+        self.secureAreaChecksum = read16()
         self.secureTransferDelay = read16()
         assert self.headerOffset == 0x70, '(Load) Header offset check at 0x70: ' + hex(self.headerOffset)
         self.arm9CodeSettingsPointerAddress = read32()
@@ -535,8 +2673,8 @@ class NintendoDSRom:
         headerSize = read32()
         self.pad088 = readRaw(0x38)
         self.nintendoLogo = readRaw(0x9C)
-        nintendoLogoChecksum = read16()
-        headerChecksum = read16()
+        self.nintendoLogoChecksum = read16()
+        self.headerChecksum = read16()
         assert self.headerOffset == 0x160, '(Load) Header offset check at 0x160: ' + hex(self.headerOffset)
         debugRomOffset = read32()
         debugRomSize = read32()
@@ -545,132 +2683,1154 @@ class NintendoDSRom:
         assert self.headerOffset == 0x200, '(Load) Header offset check at 0x200: ' + hex(self.headerOffset)
         self.pad200 = data[0x200 : min(self.arm9Offset, len(data))]
 
-        # Read the RSA signature file
-        realSigOffset = 0
-        if len(data) >= 0x1004:
-            realSigOffset, = struct.unpack_from('<I', data, 0x1000)
-        if not realSigOffset and len(data) > (self.romSizeOrRsaSigOffset):
-            realSigOffset = (self.romSizeOrRsaSigOffset)
-        self.rsaSignature = b''
-        if realSigOffset:
-            self.rsaSignature = data[realSigOffset : min(len(data), realSigOffset + 0x88)]
+        # DSi-enhanced ROMs have more header after that. Its raw bytes
+        # stay in pad16C and pad200. The ranges it points to (ARM9i,
+        # ARM7i, hash tables...) are kept as (offset, data) pairs:
+        # views into the ROM if it's lazy, or copies of just those
+        # ranges otherwise, so the rest of the image isn't kept alive
+        self.twlHeader = None
+        self._twlRegions = []
+        if self.unitCode & 2 and len(data) >= TWL_HEADER_LEN:
+            self.twlHeader = TwlHeader(bytes(data[:TWL_HEADER_LEN]))
+            view = memoryview(data)
+            for start, end in self.twlHeader.dsiRanges():
+                region = view[start:end]
+                if not self.lazy:
+                    region = memoryview(bytes(region))
+                self._twlRegions.append((start, region))
+
+        # Read the RSA signature file
+        realSigOffset = 0
+        if len(data) >= 0x1004:
+            realSigOffset, = struct.unpack_from('<I', data, 0x1000)
+        if not realSigOffset and len(data) > (self.romSizeOrRsaSigOffset):
+            realSigOffset = (self.romSizeOrRsaSigOffset)
+        self.rsaSignature = b''
+        if realSigOffset:
+            self.rsaSignature = bytes(data[realSigOffset : min(len(data), realSigOffset + 0x88)])
+
+        # Read arm9, arm7, FNT, FAT, overlay tables, icon banner
+        self.arm9 = data[self.arm9Offset : self.arm9Offset+self.arm9Len]
+        self.arm7 = data[self.arm7Offset : self.arm7Offset+self.arm7Len]
+        # The FNT and FAT are always parsed in full, so copying them
+        # is fine even in lazy mode
+        fnt = bytes(data[fntOffset : fntOffset+fntLen])
+        fat = bytes(data[fatOffset : fatOffset+fatLen])
+        self.arm9OverlayTable = data[
+            arm9OvTOffset : arm9OvTOffset + arm9OvTLen]
+        self.arm7OverlayTable = data[
+            arm7OvTOffset : arm7OvTOffset + arm7OvTLen]
+        if iconBannerOffset:
+            # Newer banner versions are longer
+            bannerLen = ICON_BANNER_LEN
+            if iconBannerOffset + 2 <= len(data):
+                version, = struct.unpack_from('<H', data, iconBannerOffset)
+                bannerLen = BANNER_LENGTHS.get(version, ICON_BANNER_LEN)
+            self.iconBanner = \
+                data[iconBannerOffset : iconBannerOffset + bannerLen]
+        else:
+            self.iconBanner = b''
+        if debugRomOffset:
+            self.debugRom = \
+                data[debugRomOffset : debugRomOffset + debugRomSize]
+        else:
+            self.debugRom = b''
+
+        # Read the small amount of data immediately following arm9
+        # No idea what this is, though...
+        # Probably related to the "code settings" stuff in code.py.
+        arm9PostData = bytearray()
+        arm9PostDataOffset = self.arm9Offset+self.arm9Len
+        while (data[arm9PostDataOffset:arm9PostDataOffset+4]
+                == b'\x21\x06\xC0\xDE'):
+            arm9PostData.extend(data[arm9PostDataOffset:arm9PostDataOffset+12])
+            arm9PostDataOffset += 12
+        self.arm9PostData = arm9PostData
+
+        # Read the filename table
+        if fnt:
+            self.filenames = load(fnt)
+        else:
+            self.filenames = Folder()
+
+        # Read files
+        self._fatIndex = FatIndex.fromFat(fat)
+        self._fatStarts = self._fatIndex.starts
+        self._fatEnds = self._fatIndex.ends
+        self.sortedFileIds = list(self._fatIndex.order)
+        if self.lazy:
+            self.files = LazyFileList(data, self._fatStarts, self._fatEnds)
+        else:
+            self.files = [data[startOffset:endOffset] for startOffset, endOffset
+                          in zip(self._fatStarts, self._fatEnds)]
+
+        # Remember what was loaded, so saveIncremental() can tell what
+        # changed
+        self._loadedHeader = NintendoDSHeader(header)
+        self._loadedHeaderData = bytes(header[:HEADER_LEN])
+        self._loadedFileHashes = None
+        self._loadedFileTypes = None
+        self._narcCache = {}
+        self._analysisPlans = {}
+        self._loadedSecureArea = data[SECURE_AREA_OFFSET : SECURE_AREA_OFFSET+SECURE_AREA_LEN]
+        self._loadedFiles = self.files if self.lazy else list(self.files)
+        self._loadedParts = self._parts()
+        self._dirtyFiles = set()
+
+
+    def _parts(self):
+        """
+        Return the parts of this ROM that aren't files, by name.
+        """
+        return {name: getattr(self, name) for name in ('arm9',
+            'arm9PostData', 'arm7', 'arm9OverlayTable', 'arm7OverlayTable',
+            'iconBanner', 'debugRom', 'filenames')}
+
+
+    @classmethod
+    def fromFile(cls, filePath, lazy=False):
+        """
+        Load a ROM from a filesystem file. If lazy is True, the file
+        is memory-mapped instead of read, and the ROM's data
+        attributes (files, arm9, arm7...) are read-only views into it.
+        """
+        if not lazy:
+            with open(filePath, 'rb') as f:
+                rom = cls(f.read())
+            rom.sourcePath = filePath
+            return rom
+
+        f = open(filePath, 'rb')
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            rom = cls(mm)
+        except Exception:
+            f.close()
+            raise
+        rom.sourcePath = filePath
+        rom._sourceFile = f
+        return rom
+
+
+    def close(self):
+        """
+        Close the file backing a ROM that was opened with
+        fromFile(lazy=True). Views into it that are still alive keep
+        the mapping itself open until they're released.
+        """
+        f = getattr(self, '_sourceFile', None)
+        if f is not None:
+            f.close()
+            self._sourceFile = None
+
+    def loadArm9(self):
+        """
+        Create a MainCodeFile object representing the main ARM9 code
+        file in this ROM, including its autoload (ITCM/DTCM) layout.
+        """
+        return MainCodeFile(self.arm9,
+                            self.arm9RamAddress,
+                            self.arm9CodeSettingsPointerAddress)
+
+
+    def loadArm7(self):
+        """
+        Create a MainCodeFile object representing the main ARM7 code
+        file in this ROM, including its autoload layout.
+        """
+        return MainCodeFile(self.arm7,
+                            self.arm7RamAddress,
+                            self.arm7CodeSettingsPointerAddress)
+
+
+    def decompressedArm9(self):
+        """
+        Return the ARM9 binary, decompressed if it's compressed.
+        """
+        return decompressCode(self.arm9, self.arm9RamAddress,
+                              self.arm9CodeSettingsPointerAddress)
+
+
+    def decompressedArm7(self):
+        """
+        Return the ARM7 binary, decompressed if it's compressed.
+        """
+        return decompressCode(self.arm7, self.arm7RamAddress,
+                              self.arm7CodeSettingsPointerAddress)
+
+
+    def _twlRange(self, offset, length):
+        """
+        Return a read-only view of a range of the ROM inside one of the
+        DSi regions it was loaded with, or b'' if it's empty.
+        """
+        if not length:
+            return b''
+        for start, region in self._twlRegions:
+            if start <= offset < start + len(region):
+                return region[offset - start : offset - start + length].toreadonly()
+        return b''
+
+
+    @property
+    def arm9i(self):
+        """
+        The DSi-only ARM9i binary of a DSi-enhanced ROM, as a read-only
+        view; b'' if there isn't one.
+        """
+        twl = self.twlHeader
+        if twl is None:
+            return b''
+        return self._twlRange(twl.arm9iOffset, twl.arm9iLen)
+
+
+    @property
+    def arm7i(self):
+        """
+        The DSi-only ARM7i binary of a DSi-enhanced ROM, as a read-only
+        view; b'' if there isn't one.
+        """
+        twl = self.twlHeader
+        if twl is None:
+            return b''
+        return self._twlRange(twl.arm7iOffset, twl.arm7iLen)
+
+
+    def _mainCode(self, cpu):
+        """
+        Return (code, RAM address, code settings pointer address) for
+        the main code file of cpu: 'ARM9', 'ARM7', or 'ARM9i' or 'ARM7i'
+        for the DSi-only ones (which don't have module params).
+        """
+        if cpu == 'ARM9i':
+            return self.arm9i, self.twlHeader.arm9iRamAddress, 0
+        if cpu == 'ARM7i':
+            return self.arm7i, self.twlHeader.arm7iRamAddress, 0
+        if cpu == 'ARM7':
+            return self.arm7, self.arm7RamAddress, self.arm7CodeSettingsPointerAddress
+        return self.arm9, self.arm9RamAddress, self.arm9CodeSettingsPointerAddress
+
+
+    def loadBanner(self):
+        """
+        Create a Banner object representing this ROM's icon/banner, or
+        return None if it doesn't have one.
+        """
+        if len(self.iconBanner) < 0x240:
+            return None
+        return Banner(self.iconBanner)
+
+
+    def loadArm9Overlays(self, idsToLoad=None):
+        """
+        Create a dictionary of this ROM's ARM9 overlays.
+        """
+        def callback(ovID, fileID):
+            return self.files[fileID]
+        return loadOverlayTable(self.arm9OverlayTable, callback, idsToLoad)
+
+
+    def loadArm7Overlays(self, idsToLoad=None):
+        """
+        Create a dictionary of this ROM's ARM7 overlays.
+        """
+        def callback(ovID, fileID):
+            return self.files[fileID]
+        return loadOverlayTable(self.arm7OverlayTable, callback, idsToLoad)
+
+
+    def fileRange(self, fid):
+        """
+        Return the (start, end) offsets of file fid in the ROM as it
+        was loaded.
+        """
+        return self._fatStarts[fid], self._fatEnds[fid]
+
+
+    def getFileByName(self, filename):
+        """
+        Return the data for the file with the given filename (path).
+        This is a convenience function.
+        """
+        fid = self.filenames.idOf(filename)
+        if fid is None:
+            raise ValueError('Cannot find file ID of "' + filename + '"')
+        return self.files[fid]
+
+
+    def setFileByName(self, filename, data):
+        """
+        Replace the data for the file with the given filename (path)
+        with the given data. This is a convenience function.
+        """
+        fid = self.filenames.idOf(filename)
+        if fid is None:
+            raise ValueError('Cannot find file ID of "' + filename + '"')
+        self.files[fid] = data
+
+
+    def extractTo(self, directory, threads=None):
+        """
+        Write every file in the filesystem into directory, under its
+        path in the filename table, along with a manifest of their
+        sizes, modification times and hashes (see
+        EXTRACT_MANIFEST_NAME) for importFrom(). Returns the number of
+        files written.
+
+        Files are written by a pool of threads (threads of them; by
+        default, as many as ThreadPoolExecutor would use) straight from
+        views into the ROM, with a bounded number of writes in flight,
+        so memory use doesn't grow with the size of the ROM. Unchanged
+        files of a ROM opened with fromFile(lazy=True) are copied by
+        the OS without passing through Python at all if their hashes
+        are cached (see fileHashes()); otherwise each file is hashed
+        as it's copied, so the ROM is only read once.
+        """
+        folders, paths = self.filenames.walk()
+        os.makedirs(directory, exist_ok=True)
+        for folder in folders:
+            os.makedirs(_extractPath(directory, folder), exist_ok=True)
+
+        files = self.files
+        sourceFile = getattr(self, '_sourceFile', None)
+        hashes = self._cachedFileHashes()
+
+        def write(fid, filePath):
+            data = files[fid]
+            digest = hashes[fid]
+            hasher = hashlib.sha1() if digest is None else None
+            with open(filePath, 'wb') as f:
+                copied = 0
+                if sourceFile is not None and files.isOriginal(fid):
+                    copied = _copyFileRange(sourceFile.fileno(),
+                        files.sourceRange(fid)[0], f, len(data), hasher)
+                rest = memoryview(data)[copied:]
+                if hasher is not None:
+                    hasher.update(rest)
+                    digest = hasher.digest()
+                f.write(rest)
+            st = os.stat(filePath)
+            return st.st_size, st.st_mtime_ns, digest
+
+        manifest = {}
+        def written(key, result):
+            path, fid = key
+            size, mtime, hashes[fid] = result
+            manifest[path] = [size, mtime, hashes[fid].hex()]
+
+        _runBounded((((path, fid), write, (fid, _extractPath(directory, path)))
+                     for path, fid in paths), threads, written)
+        _writeManifest(directory, manifest)
+        if None not in hashes:
+            self._rememberFileHashes(hashes)
+        return len(manifest)
+
+
+    def importFrom(self, directory, threads=None):
+        """
+        Replace files in the filesystem with the ones in directory (as
+        laid out by extractTo()) that differ from them. Files that are
+        missing from the directory, or that aren't in the filename
+        table, are left alone. Returns a sorted list of the IDs of the
+        files that were replaced.
+
+        Files whose size and modification time match the manifest
+        aren't read at all; others are read and hashed by a pool of
+        threads, with a bounded number of reads in flight, and only
+        kept if their hash differs from the ROM's file. The manifest is
+        updated afterwards, so importing again skips them.
+        """
+        manifest = _readManifest(directory)
+        _, paths = self.filenames.walk()
+        hashes = self.fileHashes(threads)
+
+        def check(fid, filePath, entry):
+            try:
+                st = os.stat(filePath)
+            except OSError:
+                return None
+            digest = hashes[fid].hex()
+            if entry == [st.st_size, st.st_mtime_ns, digest]:
+                return st, digest, None
+            with open(filePath, 'rb') as f:
+                data = f.read()
+            newDigest = hashlib.sha1(data).hexdigest()
+            return st, newDigest, (data if newDigest != digest else None)
+
+        changed = []
+        def checked(key, result):
+            if result is None:
+                return
+            path, fid = key
+            st, digest, data = result
+            manifest[path] = [st.st_size, st.st_mtime_ns, digest]
+            if data is not None:
+                self.files[fid] = data
+                changed.append(fid)
+
+        _runBounded((((path, fid), check,
+                      (fid, _extractPath(directory, path), manifest.get(path)))
+                     for path, fid in paths), threads, checked)
+        _writeManifest(directory, manifest)
+        return sorted(changed)
+
+
+    def findFunctionNames(self, cpu='ARM9', matcher=None, main=True, idsToLoad=None):
+        """
+        Match function signatures (by default, loadSignatures()) against
+        a CPU's main code (including autoloads; left out if main is
+        False) and its overlays (all of them, or the set of overlay IDs
+        idsToLoad), decompressing them as needed. Returns a list of
+        (overlay ID, address, name, thumb) tuples; the overlay ID is
+        None for the main code. Works without IDA, so names can be
+        precomputed.
+        """
+        if matcher is None:
+            matcher = SignatureMatcher()
+        if cpu == 'ARM7':
+            overlays = self.loadArm7Overlays(idsToLoad)
+        else:
+            overlays = self.loadArm9Overlays(idsToLoad)
+
+        names = []
+        if main:
+            codeFile = self.loadArm7() if cpu == 'ARM7' else self.loadArm9()
+            for section in codeFile.sections:
+                names.extend((None,) + match for match in
+                             matcher.match(section.data, section.ramAddress))
+        for ovID, ov in sorted(overlays.items()):
+            data = decompressBlz(ov.data) if ov.compressed else ov.data
+            names.extend((ovID,) + match for match in
+                         matcher.match(memoryview(data)[:ov.ramSize], ov.ramAddress))
+        return names
+
+
+    def _analysisPlanKey(self, cpu, matcher):
+        """
+        Return the key a CPU's analysis plan is cached under: a hash of
+        its main code file and where it's loaded, and of the signatures
+        used to name functions in it. ROMs with identical code share
+        plans.
+        """
+        code, ramAddress, settingsAddress = self._mainCode(cpu)
+        h = hashlib.sha1(struct.pack('<2I', ramAddress, settingsAddress))
+        h.update(code)
+        h.update(repr(matcher.signatures).encode('utf-8'))
+        return h.digest()
+
+
+    def analysisPlan(self, cpu='ARM9', cacheDir=None, matcher=None):
+        """
+        Return the AnalysisPlan for a CPU's main code file ('ARM9',
+        'ARM7', 'ARM9i' or 'ARM7i'; see _mainCode()), matching
+        signatures with matcher (by default, loadSignatures()).
+
+        Plans are cached in memory and on disk: in cacheDir, if given,
+        under a name derived from the code itself, so every ROM with
+        the same code file shares one; otherwise in a sidecar file
+        next to the ROM (see ANALYSIS_PLAN_SUFFIX), if it was loaded
+        from one. Failing to write the cache isn't an error.
+        """
+        if matcher is None:
+            matcher = SignatureMatcher()
+        key = self._analysisPlanKey(cpu, matcher)
+        plan = self._analysisPlans.get(key)
+        if plan is not None:
+            return plan
+
+        cachePath = self._analysisPlanPath(cpu, key, cacheDir)
+        if cachePath is not None:
+            try:
+                with open(cachePath, 'rb') as f:
+                    plan = AnalysisPlan.fromBytes(f.read(), key)
+            except OSError:
+                pass
+
+        if plan is None:
+            codeFile = MainCodeFile(*self._mainCode(cpu))
+            plan = AnalysisPlan.fromCode(codeFile, matcher)
+            self._saveAnalysisPlan(plan, key, cachePath)
+
+        self._analysisPlans[key] = plan
+        return plan
+
+
+    def _analysisPlanPath(self, cpu, key, cacheDir):
+        """
+        Return the path a CPU's analysis plan is cached at (see
+        analysisPlan()), or None if it isn't cached on disk.
+        """
+        if cacheDir is not None:
+            return os.path.join(cacheDir, key.hex() + '.plan')
+        if self.sourcePath is not None:
+            return self.sourcePath + ANALYSIS_PLAN_SUFFIX.format(cpu.lower())
+        return None
+
+
+    def _saveAnalysisPlan(self, plan, key, cachePath):
+        """
+        Write an analysis plan to its cache file, if it has one.
+        Failing to isn't an error.
+        """
+        if cachePath is None:
+            return
+        tempPath = cachePath + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(cachePath) or '.', exist_ok=True)
+            with open(tempPath, 'wb') as f:
+                f.write(plan.toBytes(key))
+            os.replace(tempPath, cachePath)
+        except OSError:
+            pass
+
+
+    def overlayFunctionNames(self, cpu='ARM9', idsToLoad=None, cacheDir=None, matcher=None):
+        """
+        Like findFunctionNames(cpu, matcher, main=False, idsToLoad), but
+        remembering what was found in each overlay in the CPU's
+        analysis plan (see analysisPlan(); cacheDir is used the same
+        way), so that overlays are only decompressed and matched the
+        first time they're seen. The plan's cache file is updated if
+        any new overlays were matched.
+        """
+        if matcher is None:
+            matcher = SignatureMatcher()
+        plan = self.analysisPlan(cpu, cacheDir, matcher)
+        if cpu == 'ARM7':
+            overlays = self.loadArm7Overlays(idsToLoad)
+        else:
+            overlays = self.loadArm9Overlays(idsToLoad)
+
+        names = []
+        changed = False
+        for ovID, ov in sorted(overlays.items()):
+            ovKey = _overlayKey(ov)
+            found = plan.overlayNames.get(ovKey)
+            if found is None:
+                data = decompressBlz(ov.data) if ov.compressed else ov.data
+                found = plan.overlayNames[ovKey] = matcher.match(
+                    memoryview(data)[:ov.ramSize], ov.ramAddress)
+                changed = True
+            names.extend((ovID,) + match for match in found)
+
+        if changed:
+            key = self._analysisPlanKey(cpu, matcher)
+            self._saveAnalysisPlan(plan, key, self._analysisPlanPath(cpu, key, cacheDir))
+        return names
+
+
+    def resolvePath(self, path):
+        """
+        Return the data for the file at path, which can continue into
+        NARC archives: "a/0/1/2.narc/15" is file 15 of the archive at
+        a/0/1/2.narc, and archives can be nested. Archives are opened
+        lazily (their files are views, not copies) and cached by path,
+        so repeated lookups don't reparse them.
+        """
+        return _resolvePath(self.filenames, self.files, path, self._narcCache)
+
+
+    def fileAtOffset(self, offset):
+        """
+        Return the ID of the file containing ROM offset offset, as of
+        when the ROM was loaded (or last saved with saveIncremental()),
+        or None if no file contains it. filenames.filenameOf() turns
+        the ID into a path.
+        """
+        return self._fatIndex.ownerOf(offset)
+
+
+    def validateFat(self, romSize=None):
+        """
+        Check the FAT this ROM was loaded with for overlapping,
+        duplicate and out-of-bounds files, and unused gaps. romSize
+        defaults to the ROM size in the header. Returns a FatReport.
+        """
+        if romSize is None and self._loadedHeader is not None:
+            romSize = self._loadedHeader.romSizeOrRsaSigOffset
+        return self._fatIndex.validate(romSize)
+
+
+    def romIdentity(self):
+        """
+        Return a hash that cheaply identifies the ROM this was loaded
+        from, without reading its files: a hash of its header, its FAT
+        and (if it was loaded from a file) the size and modification
+        time of that file. Used to key caches of per-ROM data.
+        """
+        h = hashlib.sha1(self._loadedHeaderData)
+        h.update(self._fatStarts.tobytes())
+        h.update(self._fatEnds.tobytes())
+        if self.sourcePath is not None:
+            st = os.stat(self.sourcePath)
+            h.update(struct.pack('<2Q', st.st_size, st.st_mtime_ns))
+        return h.digest()
+
+
+    def fileHashes(self, threads=None):
+        """
+        Return a list of the SHA-1 digests of all files, by file ID.
+        threads is the number of hashing threads (1 to hash without
+        any).
+
+        Hashes of unchanged files are cached, in memory and, for ROMs
+        loaded from a file, in a sidecar file next to it (see
+        FILE_HASH_CACHE_SUFFIX), so reopening the same ROM doesn't
+        rehash it. As with saveIncremental(), files modified in place
+        have to be marked with markFileDirty().
+        """
+        hashes = self._cachedFileHashes()
+        todo = [fid for fid, digest in enumerate(hashes) if digest is None]
+        for fid, digest in zip(todo, _hashFiles(self.files, todo, threads)):
+            hashes[fid] = digest
+        self._rememberFileHashes(hashes)
+        return hashes
+
+
+    def _fileHashCachePath(self):
+        """
+        Return the path of fileHashes()'s sidecar cache file, or None
+        if this ROM wasn't loaded from a file.
+        """
+        if self.sourcePath is None or self._loadedHeader is None:
+            return None
+        return self.sourcePath + FILE_HASH_CACHE_SUFFIX
+
+
+    def _cachedFileHashes(self):
+        """
+        Return the hashes fileHashes() would, but with None for every
+        file whose hash isn't cached, without hashing anything.
+        """
+        numLoaded = len(self._fatStarts)
+        loadedHashes = self._loadedFileHashes
+        cachePath = self._fileHashCachePath()
+        if loadedHashes is None and cachePath is not None:
+            loadedHashes = _readHashCache(cachePath, self.romIdentity(), numLoaded)
+            self._loadedFileHashes = loadedHashes
+
+        changed = set(self.dirtyFileIds())
+        hashes = [None] * len(self.files)
+        if loadedHashes is not None:
+            for fid in range(min(len(hashes), numLoaded)):
+                if fid not in changed:
+                    hashes[fid] = loadedHashes[fid]
+        return hashes
+
+
+    def _rememberFileHashes(self, hashes):
+        """
+        If hashes (a full list, by file ID) are the hashes of exactly
+        the files that were loaded, cache them.
+        """
+        if (self._loadedFileHashes is not None
+                or len(hashes) != len(self._fatStarts)
+                or self.dirtyFileIds()):
+            return
+        self._loadedFileHashes = list(hashes)
+        cachePath = self._fileHashCachePath()
+        if cachePath is not None:
+            _writeHashCache(cachePath, self.romIdentity(), hashes)
+
+
+    def duplicateFiles(self, threads=None):
+        """
+        Group the IDs of byte-identical (non-empty) files together.
+        Returns a list of lists of two or more file IDs each, ordered
+        by their lowest IDs.
+        """
+        groups = {}
+        for fid, digest in enumerate(self.fileHashes(threads)):
+            size = len(self.files[fid])
+            if size:
+                groups.setdefault((size, digest), []).append(fid)
+        return [group for group in groups.values() if len(group) > 1]
+
+
+    def fileTypes(self):
+        """
+        Sniff the types of all files (see sniffFile()), and return a
+        FileTypeIndex of them. Only the first few bytes of each file
+        are read. Results for unchanged files are cached, so after the
+        first call this is nearly free; as with saveIncremental(),
+        files modified in place have to be marked with
+        markFileDirty().
+        """
+        numLoaded = len(self._fatStarts)
+        loadedTypes = self._loadedFileTypes
+        changed = set(self.dirtyFileIds())
+        files = self.files
+
+        sniffed = []
+        for fid in range(len(files)):
+            if loadedTypes is not None and fid < numLoaded and fid not in changed:
+                sniffed.append(loadedTypes[fid])
+            else:
+                sniffed.append(sniffFile(files[fid]))
+
+        if loadedTypes is None and not changed and len(sniffed) == numLoaded:
+            self._loadedFileTypes = sniffed
+        return FileTypeIndex(sniffed)
+
 
-        # Read arm9, arm7, FNT, FAT, overlay tables, icon banner
-        self.arm9 = data[self.arm9Offset : self.arm9Offset+self.arm9Len]
-        self.arm7 = data[self.arm7Offset : self.arm7Offset+self.arm7Len]
-        fnt = data[fntOffset : fntOffset+fntLen]
-        fat = data[fatOffset : fatOffset+fatLen]
-        self.arm9OverlayTable = data[
-            arm9OvTOffset : arm9OvTOffset + arm9OvTLen]
-        self.arm7OverlayTable = data[
-            arm7OvTOffset : arm7OvTOffset + arm7OvTLen]
-        if iconBannerOffset:
-            self.iconBanner = \
-                data[iconBannerOffset : iconBannerOffset + ICON_BANNER_LEN]
-        else:
-            self.iconBanner = b''
-        if debugRomOffset:
-            self.debugRom = \
-                data[debugRomOffset : debugRomOffset + debugRomSize]
-        else:
-            self.debugRom = b''
+    def verifyChecksums(self):
+        """
+        Check the Nintendo logo, header and secure area checksums
+        stored in the ROM as it was loaded. Returns a dict mapping
+        'nintendoLogo', 'header' and 'secureArea' to True or False, or
+        None for a checksum that can't be checked (a decrypted secure
+        area).
+        """
+        loaded = self._loadedHeader
+        if loaded is None:
+            return {'nintendoLogo': None, 'header': None, 'secureArea': None}
 
-        # Read the small amount of data immediately following arm9
-        # No idea what this is, though...
-        # Probably related to the "code settings" stuff in code.py.
-        arm9PostData = bytearray()
-        arm9PostDataOffset = self.arm9Offset+self.arm9Len
-        while (data[arm9PostDataOffset:arm9PostDataOffset+4]
-                == b'\x21\x06\xC0\xDE'):
-            arm9PostData.extend(data[arm9PostDataOffset:arm9PostDataOffset+12])
-            arm9PostDataOffset += 12
-        self.arm9PostData = arm9PostData
+        secureArea = None
+        if len(self._loadedSecureArea) == SECURE_AREA_LEN:
+            crc = secureAreaChecksum(self._loadedSecureArea)
+            if crc is not None:
+                secureArea = (crc == loaded.secureAreaChecksum)
 
-        # Read the filename table
-        if fnt:
-            self.filenames = load(fnt)
-        else:
-            self.filenames = Folder()
+        return {
+            'nintendoLogo': loaded.logoIsValid(),
+            'header': loaded.checksumIsValid(),
+            'secureArea': secureArea,
+        }
 
-        # Read files
-        self.files = []
-        self.sortedFileIds = []
-        if fat:
-            offset2Id = {}
-            for i in range(len(fat) // 8):
-                startOffset, endOffset = struct.unpack_from('<II', fat, 8 * i)
-                self.files.append(data[startOffset:endOffset])
-                offset2Id[startOffset] = i
-            for off in sorted(offset2Id):
-                self.sortedFileIds.append(offset2Id[off])
 
+    def calculateChecksums(self, dedupe=False):
+        """
+        Calculate the Nintendo logo, header and secure area checksums
+        this ROM will have when saved (with the same dedupe setting),
+        as a dict with the same keys as verifyChecksums(). save()
+        writes these values; the ones in this ROM's attributes are
+        left as they were loaded.
+        """
+        header = self._saveLayout(dedupe)[0]
+        logo, headerCrc = struct.unpack_from('<2H', header, 0x15C)
+        secureArea, = struct.unpack_from('<H', header, 0x6C)
+        return {'nintendoLogo': logo, 'header': headerCrc, 'secureArea': secureArea}
 
-    @classmethod
-    def fromFile(cls, filePath):
+
+    def markFileDirty(self, fid):
         """
-        Load a ROM from a filesystem file.
+        Tell saveIncremental() that file fid was modified in place
+        (rather than replaced, which is noticed automatically).
         """
-        with open(filePath, 'rb') as f:
-            return cls(f.read())
+        self._dirtyFiles.add(fid)
 
-    def loadArm9(self):
+
+    def dirtyFileIds(self):
         """
-        Create a MainCodeFile object representing the main ARM9 code
-        file in this ROM.
+        Return a sorted list of the IDs of files that changed since
+        this ROM was loaded (or last saved incrementally).
         """
-        return code.MainCodeFile(self.arm9,
-                                 self.arm9RamAddress,
-                                 self.arm9CodeSettingsPointerAddress)
+        dirty = set(self._dirtyFiles)
+        if isinstance(self.files, LazyFileList):
+            dirty.update(i for i in self.files._replaced)
+        else:
+            for i, (data, loaded) in enumerate(zip(self.files, self._loadedFiles)):
+                if data is not loaded:
+                    dirty.add(i)
+        return sorted(dirty)
 
 
-    def loadArm7(self):
+    def saveIncremental(self, filePath=None):
         """
-        Create a MainCodeFile object representing the main ARM7 code
-        file in this ROM.
+        Write only the files that changed since this ROM was loaded
+        back to the ROM file it was loaded from (or to filePath, which
+        must have the same layout), then patch its FAT and header in
+        place. A file that still fits where it was (including the
+        padding after it) is rewritten there; otherwise it's moved to
+        the first free gap big enough for it, or to the end of the
+        ROM. The I/O done is proportional to the size of the changes.
+
+        Only file contents can be saved this way: changes to anything
+        else (filenames, arm9, arm7, the number of files...) need
+        saveToFile(). Returns the IDs of the files that were written.
         """
-        return code.MainCodeFile(self.arm7,
-                                 self.arm7RamAddress,
-                                 self.arm7CodeSettingsPointerAddress)
+        if filePath is None:
+            filePath = self.sourcePath
+        loaded = self._loadedHeader
+        if filePath is None or loaded is None:
+            raise ValueError('This ROM was not loaded from a file')
+        if len(self.files) != len(self._fatStarts):
+            raise ValueError('Files were added or removed; use saveToFile()')
+        if any(getattr(self, name) is not part
+               for name, part in self._loadedParts.items()):
+            raise ValueError('Not just file contents changed; use saveToFile()')
+
+        dirty = self.dirtyFileIds()
+        if not dirty:
+            return []
+        dirtySet = set(dirty)
+        starts, ends = self._fatStarts, self._fatEnds
+        fileSize = os.path.getsize(filePath)
+        isTwl = bool(self.unitCode & 2)
+
+        # Relocated files can only go into space that's known to be
+        # unused: gaps between things the header and FAT point to,
+        # before the end of the (NTR) ROM
+        romSize = loaded.romSizeOrRsaSigOffset
+        if isTwl or not 0 < romSize <= fileSize:
+            romSize = fileSize
+        occupied = [
+            (0, max(HEADER_LEN, loaded.arm9Offset)),
+            (loaded.arm9Offset, loaded.arm9Offset + loaded.arm9Len + len(self.arm9PostData)),
+            (loaded.arm7Offset, loaded.arm7Offset + loaded.arm7Len),
+            (loaded.fntOffset, loaded.fntOffset + loaded.fntLen),
+            (loaded.fatOffset, loaded.fatOffset + loaded.fatLen),
+            (loaded.arm9OverlayTableOffset, loaded.arm9OverlayTableOffset + loaded.arm9OverlayTableLen),
+            (loaded.arm7OverlayTableOffset, loaded.arm7OverlayTableOffset + loaded.arm7OverlayTableLen),
+            (loaded.iconBannerOffset, loaded.iconBannerOffset + len(self.iconBanner)),
+            (loaded.debugRomOffset, loaded.debugRomOffset + loaded.debugRomSize),
+            (romSize, fileSize),
+        ]
+        # A DSi-enhanced ROM also has the rest of its header, the
+        # ARM9i and ARM7i binaries, hash tables and so on, none of
+        # which the FAT knows about
+        twl = self.twlHeader
+        if isTwl and twl is not None:
+            occupied.append((0, TWL_HEADER_LEN))
+            for offset, length in ((twl.arm9iOffset, twl.arm9iLen),
+                                   (twl.arm7iOffset, twl.arm7iLen),
+                                   (twl.ntrDigestOffset, twl.ntrDigestLen),
+                                   (twl.twlDigestOffset, twl.twlDigestLen),
+                                   (twl.sectorHashTableOffset, twl.sectorHashTableLen),
+                                   (twl.blockHashTableOffset, twl.blockHashTableLen),
+                                   (twl.modcrypt1Offset, twl.modcrypt1Len),
+                                   (twl.modcrypt2Offset, twl.modcrypt2Len)):
+                if offset and length:
+                    occupied.append((offset, offset + length))
+        occupied.extend((starts[i], ends[i]) for i in range(len(starts))
+                        if i not in dirtySet)
+        occupied.sort()
+
+        gaps = []
+        end = 0
+        for s, e in occupied:
+            if s >= e:
+                continue
+            if s > end:
+                gaps.append([end, s])
+            end = max(end, e)
+
+        def takeFrom(gapIndex, start, length):
+            gapStart, gapEnd = gaps[gapIndex]
+            del gaps[gapIndex]
+            if start + length < gapEnd:
+                gaps.insert(gapIndex, [start + length, gapEnd])
+            if gapStart < start:
+                gaps.insert(gapIndex, [gapStart, start])
+
+        # First, let every file that still fits in its old slot stay
+        # there; then find new homes for the rest
+        newOffsets = {}
+        for fid in dirty:
+            start, length = starts[fid], len(self.files[fid])
+            for gi, (gapStart, gapEnd) in enumerate(gaps):
+                if gapStart <= start and start + length <= gapEnd:
+                    takeFrom(gi, start, length)
+                    newOffsets[fid] = start
+                    break
+
+        appendAt = (romSize + ROM_ALIGNMENT - 1) & ~(ROM_ALIGNMENT - 1)
+        for fid in dirty:
+            if fid in newOffsets:
+                continue
+            length = len(self.files[fid])
+            for gi, (gapStart, gapEnd) in enumerate(gaps):
+                start = (gapStart + ROM_ALIGNMENT - 1) & ~(ROM_ALIGNMENT - 1)
+                if start + length <= gapEnd:
+                    takeFrom(gi, start, length)
+                    newOffsets[fid] = start
+                    break
+            else:
+                newOffsets[fid] = appendAt
+                appendAt = (appendAt + length + ROM_ALIGNMENT - 1) & ~(ROM_ALIGNMENT - 1)
+
+        with open(filePath, 'r+b') as f:
+            f.seek(loaded.fntOffset)
+            if f.read(loaded.fntLen) != save(self.filenames):
+                raise ValueError('Filenames changed; use saveToFile()')
+
+            for fid in dirty:
+                f.seek(newOffsets[fid])
+                f.write(self.files[fid])
+                starts[fid] = newOffsets[fid]
+                ends[fid] = newOffsets[fid] + len(self.files[fid])
+                f.seek(loaded.fatOffset + 8 * fid)
+                f.write(struct.pack('<II', starts[fid], ends[fid]))
+
+            # If files were appended, the ROM got bigger: move the RSA
+            # signature after them, and update the size and capacity
+            # fields in the header
+            newRomSize = max(ends[fid] for fid in dirty)
+            if newRomSize > romSize and not isTwl:
+                newRomSize = (newRomSize + 3) & ~3
+                if self.rsaSignature:
+                    f.seek(newRomSize)
+                    f.write(self.rsaSignature)
+                while (0x20000 << self.deviceCapacity) < newRomSize + len(self.rsaSignature):
+                    self.deviceCapacity += 1
+                self.romSizeOrRsaSigOffset = loaded.romSizeOrRsaSigOffset = newRomSize
+
+                f.seek(0)
+                header = bytearray(f.read(HEADER_LEN))
+                header[0x14] = self.deviceCapacity
+                struct.pack_into('<I', header, 0x80, newRomSize)
+                struct.pack_into('<H', header, 0x15E, crc16(header[:0x15E]))
+                f.seek(0)
+                f.write(header)
+
+        # What's on disk is now the baseline for the next save
+        if isinstance(self.files, LazyFileList):
+            mapped = len(self.files._data)
+            for fid in dirty:
+                if ends[fid] <= mapped:
+                    self.files._replaced.pop(fid, None)
+        else:
+            self._loadedFiles = list(self.files)
+        self._dirtyFiles.clear()
+        self._fatIndex = FatIndex(starts, ends)
+        self._loadedFileHashes = None
+        self._loadedFileTypes = None
+        self._narcCache = {}
+        self.sortedFileIds = list(self._fatIndex.order)
+        return dirty
 
 
-    def loadArm9Overlays(self, idsToLoad=None):
+    def _overlayFileIds(self, table):
         """
-        Create a dictionary of this ROM's ARM9 overlays.
+        Return the file IDs of the overlays listed in an overlay
+        table.
         """
-        def callback(ovID, fileID):
-            return self.files[fileID]
-        return code.loadOverlayTable(self.arm9OverlayTable, callback, idsToLoad)
+        return [struct.unpack_from('<I', table, off + 0x18)[0]
+                for off in range(0, len(table) - 31, 32)]
 
 
-    def loadArm7Overlays(self, idsToLoad=None):
+    def _saveLayout(self, dedupe=False):
         """
-        Create a dictionary of this ROM's ARM7 overlays.
+        Decide where everything goes in a saved ROM, without touching
+        any file data. Returns (header, fat, pieces, romEnd): the new
+        header and FAT, a list of (offset, data) pairs in the order
+        they should be written (data is either a bytes-like object or
+        a file ID), and the end offset of the ROM. If dedupe is True,
+        identical files share a single copy.
         """
-        def callback(ovID, fileID):
-            return self.files[fileID]
-        return code.loadOverlayTable(self.arm7OverlayTable, callback, idsToLoad)
+        fntData = save(self.filenames)
+        pieces = []
+        fileOffsets = [None] * len(self.files)
+        pos = 0
+
+        # For deduplicated files: the first ID in each file's group of
+        # identical files, and where each group's copy was placed
+        groupOf = {}
+        groupOffsets = {}
+        if dedupe:
+            for group in self.duplicateFiles():
+                for fid in group:
+                    groupOf[fid] = group[0]
+
+        def align(alignment=ROM_ALIGNMENT):
+            nonlocal pos
+            pos = (pos + alignment - 1) & ~(alignment - 1)
+
+        def place(data):
+            nonlocal pos
+            offset = pos
+            if len(data):
+                pieces.append((offset, data))
+            pos += len(data)
+            align()
+            return offset
+
+        def placeFiles(fileIds):
+            nonlocal pos
+            for fid in fileIds:
+                if 0 <= fid < len(fileOffsets) and fileOffsets[fid] is None:
+                    group = groupOf.get(fid)
+                    if group in groupOffsets:
+                        fileOffsets[fid] = groupOffsets[group]
+                        continue
+                    if group is not None:
+                        groupOffsets[group] = pos
+                    fileOffsets[fid] = pos
+                    pieces.append((pos, fid))
+                    pos += len(self.files[fid])
+                    align()
+
+        # Header, and everything between it and arm9
+        pos = 0x200 + len(self.pad200)
+        align()
+
+        # ARM9 and its overlays
+        arm9Offset = pos
+        pieces.append((pos, self.arm9))
+        pos += len(self.arm9)
+        place(self.arm9PostData)
+        arm9OvTOffset = place(self.arm9OverlayTable) if self.arm9OverlayTable else 0
+        placeFiles(self._overlayFileIds(self.arm9OverlayTable))
+
+        # ARM7 and its overlays
+        arm7Offset = place(self.arm7)
+        arm7OvTOffset = place(self.arm7OverlayTable) if self.arm7OverlayTable else 0
+        placeFiles(self._overlayFileIds(self.arm7OverlayTable))
+
+        # Filename table, FAT (filled in below) and icon banner
+        fntOffset = place(fntData)
+        fatOffset = pos
+        fat = bytearray(8 * len(self.files))
+        pieces.append((pos, fat))
+        pos += len(fat)
+        align()
+        iconBannerOffset = place(self.iconBanner) if self.iconBanner else 0
+
+        # All other files, in the order they were in originally; files
+        # that weren't in the original ROM go last
+        placeFiles(self.sortedFileIds)
+        placeFiles(range(len(self.files)))
+        debugRomOffset = place(self.debugRom) if self.debugRom else 0
+
+        # The RSA signature goes right after the end of the ROM proper
+        romSize = pos
+        if self.rsaSignature:
+            pieces.append((pos, self.rsaSignature))
+            pos += len(self.rsaSignature)
+
+        # A DSi-enhanced ROM's DSi regions stay where they are, since
+        # the DSi part of the header (which is kept as it is) points to
+        # them, so everything above has to fit in before them
+        for start, region in self._twlRegions:
+            if start < pos:
+                raise ValueError('The DS part of the ROM has grown into its DSi'
+                                 ' regions (at ' + hex(start) + ')')
+            pieces.append((start, region))
+            pos = start + len(region)
+        romEnd = pos
+
+        for fid, offset in enumerate(fileOffsets):
+            struct.pack_into('<II', fat, 8 * fid, offset, offset + len(self.files[fid]))
+
+        # Make sure the ROM still fits the device capacity it claims
+        deviceCapacity = self.deviceCapacity
+        while (0x20000 << deviceCapacity) < romEnd:
+            deviceCapacity += 1
+
+        header = bytearray(HEADER_LEN)
+        struct.pack_into('<12s4s2s14B', header, 0,
+            bytes(self.name), bytes(self.idCode), bytes(self.developerCode),
+            self.unitCode, self.encryptionSeedSelect, deviceCapacity,
+            self.pad015, self.pad016, self.pad017, self.pad018,
+            self.pad019, self.pad01A, self.pad01B, self.pad01C,
+            self.region, self.version, self.autostart)
+        struct.pack_into('<16I3I2H2I8s2I', header, 0x20,
+            arm9Offset, self.arm9EntryAddress, self.arm9RamAddress, len(self.arm9),
+            arm7Offset, self.arm7EntryAddress, self.arm7RamAddress, len(self.arm7),
+            fntOffset, len(fntData), fatOffset, len(fat),
+            arm9OvTOffset, len(self.arm9OverlayTable),
+            arm7OvTOffset, len(self.arm7OverlayTable),
+            self.normalCardControlRegisterSettings,
+            self.secureCardControlRegisterSettings, iconBannerOffset,
+            self.secureAreaChecksum, self.secureTransferDelay,
+            self.arm9CodeSettingsPointerAddress,
+            self.arm7CodeSettingsPointerAddress, bytes(self.secureAreaDisable),
+            romSize, 0x4000)
+        header[0x88:0xC0] = self.pad088
+        header[0xC0:0x15C] = self.nintendoLogo
+        struct.pack_into('<H', header, 0x15C, crc16(self.nintendoLogo))
+        struct.pack_into('<3I', header, 0x160,
+            debugRomOffset, len(self.debugRom), self.debugRomAddress)
+        header[0x16C:0x200] = self.pad16C
+
+        pieces.insert(0, (0, header))
+        if self.pad200:
+            pieces.insert(1, (0x200, self.pad200))
+
+        # The header checksum covers the secure area checksum, so that
+        # has to be filled in first
+        crc = secureAreaChecksum(self._readPieces(pieces,
+            SECURE_AREA_OFFSET, SECURE_AREA_OFFSET + SECURE_AREA_LEN))
+        if crc is not None:
+            struct.pack_into('<H', header, 0x6C, crc)
+        struct.pack_into('<H', header, 0x15E, crc16(header[:0x15E]))
+
+        return header, fat, pieces, romEnd
+
+
+    def _readPieces(self, pieces, start, end):
+        """
+        Assemble the bytes from start to end of a ROM laid out by
+        _saveLayout(), with 0xFF padding in between pieces, like
+        _writeTo() writes it.
+        """
+        out = bytearray(b'\xFF' * (end - start))
+        for offset, data in pieces:
+            if isinstance(data, int):
+                data = self.files[data]
+            if offset >= end or offset + len(data) <= start:
+                continue
+            lo = max(offset, start)
+            hi = min(offset + len(data), end)
+            out[lo-start : hi-start] = memoryview(data)[lo-offset : hi-offset]
+        return out
+
+
+    def _writeTo(self, f, dedupe=False):
+        """
+        Write this ROM to a file object, piece by piece, so that the
+        whole image never has to be in memory at once.
+        """
+        _, _, pieces, romEnd = self._saveLayout(dedupe)
 
+        sourceFile = getattr(self, '_sourceFile', None)
+        pos = 0
+        for offset, data in pieces:
+            if offset > pos:
+                f.write(b'\xFF' * (offset - pos))
+                pos = offset
 
-    def getFileByName(self, filename):
+            if isinstance(data, int):
+                fid = data
+                data = self.files[fid]
+
+                # Unchanged files can be copied straight from the source
+                # file, without going through Python at all
+                if sourceFile is not None and self.files.isOriginal(fid):
+                    copied = _copyFileRange(sourceFile.fileno(),
+                        self.files.sourceRange(fid)[0], f, len(data))
+                    data = memoryview(data)[copied:]
+                    pos += copied
+
+            f.write(data)
+            pos += len(data)
+
+        if romEnd > pos:
+            f.write(b'\xFF' * (romEnd - pos))
+
+
+    def save(self, dedupe=False):
         """
-        Return the data for the file with the given filename (path).
-        This is a convenience function.
+        Generate a bytes object representing this ROM. If dedupe is
+        True, only one copy of each set of identical files is written,
+        and all of their FAT entries point to it.
         """
-        fid = self.filenames.idOf(filename)
-        if fid is None:
-            raise ValueError('Cannot find file ID of "' + filename + '"')
-        return self.files[fid]
+        f = io.BytesIO()
+        self._writeTo(f, dedupe)
+        return f.getvalue()
 
 
-    def setFileByName(self, filename, data):
+    def saveToFile(self, filePath, dedupe=False):
         """
-        Replace the data for the file with the given filename (path)
-        with the given data. This is a convenience function.
+        Save this ROM to a filesystem file. The ROM is streamed to a
+        temporary file next to it, which then replaces it, so this is
+        also safe to use on the file a lazy ROM was loaded from. See
+        save() for dedupe.
         """
-        fid = self.filenames.idOf(filename)
-        if fid is None:
-            raise ValueError('Cannot find file ID of "' + filename + '"')
-        self.files[fid] = data
+        tempPath = filePath + '.tmp'
+        with open(tempPath, 'wb') as f:
+            self._writeTo(f, dedupe)
+        os.replace(tempPath, filePath)
 
 
     def __str__(self):
@@ -684,10 +3844,19 @@ class NintendoDSRom:
         return type(self).__name__
 
 
+def FillRange(startEA, endEA, value=0):
+    """
+    Fill [startEA, endEA) with a byte value in a single database call,
+    rather than one call per byte.
+    """
+    if endEA > startEA:
+        ida_bytes.put_bytes(startEA, bytes([value]) * (endEA - startEA))
+
+
 def MakeReg(name, offset, size, count=0):
     idc.MakeNameEx(offset, name, idc.SN_NOCHECK | idc.SN_NOWARN)
     if (size == 1):
-	    idc.MakeByte(offset)
+        idc.MakeByte(offset)
     elif size == 2:
         idc.MakeWord(offset)
     elif size == 4:
@@ -709,188 +3878,1304 @@ def MakeReg(name, offset, size, count=0):
 #define		CART		((u16 *) 0x08000000)
 """
 
-def MakeVideoRegs():
+# The I/O register map, as groups of (name, address, width, count, cpu)
+# tuples sorted by address. width is the register size in bytes, count
+# is an array length (0 for a plain register), and cpu is the CPU that
+# can access the register ('ARM9' or 'ARM7'), or None if both can. The
+# 2D engines, VRAM control and palettes are only wired to the ARM9.
+IO_REGISTERS = {
+    'Video': (
+        ('REG_DisplayCnt', 0x04000000, 4, 0, 'ARM9'),
+        ('REG_DisplayStatus', 0x04000004, 2, 0, None),
+        ('REG_VCount', 0x04000006, 2, 0, None),
+        ('REG_BG0CNT', 0x4000008, 2, 0, 'ARM9'),
+        ('REG_BG1CNT', 0x400000a, 2, 0, 'ARM9'),
+        ('REG_BG2CNT', 0x400000c, 2, 0, 'ARM9'),
+        ('REG_BG3CNT', 0x400000e, 2, 0, 'ARM9'),
+        ('REG_BG0HOFS', 0x4000010, 2, 0, 'ARM9'),
+        ('REG_BG0VOFS', 0x4000012, 2, 0, 'ARM9'),
+        ('REG_BG1HOFS', 0x4000014, 2, 0, 'ARM9'),
+        ('REG_BG1VOFS', 0x4000016, 2, 0, 'ARM9'),
+        ('REG_BG2HOFS', 0x4000018, 2, 0, 'ARM9'),
+        ('REG_BG2VOFS', 0x400001a, 2, 0, 'ARM9'),
+        ('REG_BG3HOFS', 0x400001c, 2, 0, 'ARM9'),
+        ('REG_BG3VOFS', 0x400001e, 2, 0, 'ARM9'),
+        ('REG_BG2PA', 0x4000020, 2, 0, 'ARM9'),
+        ('REG_BG2PB', 0x4000022, 2, 0, 'ARM9'),
+        ('REG_BG2PC', 0x4000024, 2, 0, 'ARM9'),
+        ('REG_BG2PD', 0x4000026, 2, 0, 'ARM9'),
+        ('REG_BG2X', 0x4000028, 4, 0, 'ARM9'),
+        ('REG_BG2Y', 0x400002c, 4, 0, 'ARM9'),
+        ('REG_BG3PA', 0x4000030, 2, 0, 'ARM9'),
+        ('REG_BG3PB', 0x4000032, 2, 0, 'ARM9'),
+        ('REG_BG3PC', 0x4000034, 2, 0, 'ARM9'),
+        ('REG_BG3PD', 0x4000036, 2, 0, 'ARM9'),
+        ('REG_BG3X', 0x4000038, 4, 0, 'ARM9'),
+        ('REG_BG3Y', 0x400003c, 4, 0, 'ARM9'),
+        ('REG_WIN0H', 0x4000040, 2, 0, 'ARM9'),
+        ('REG_WIN1H', 0x4000042, 2, 0, 'ARM9'),
+        ('REG_WIN0V', 0x4000044, 2, 0, 'ARM9'),
+        ('REG_WIN1V', 0x4000046, 2, 0, 'ARM9'),
+        ('REG_WININ', 0x4000048, 2, 0, 'ARM9'),
+        ('REG_WINOUT', 0x400004a, 2, 0, 'ARM9'),
+        ('REG_MOSAIC', 0x400004c, 2, 0, 'ARM9'),
+        ('REG_BLDCNT', 0x4000050, 2, 0, 'ARM9'),
+        ('REG_BLDALPHA', 0x4000052, 2, 0, 'ARM9'),
+        ('REG_BLDY', 0x4000054, 2, 0, 'ARM9'),
+        ('REG_DISP3DCNT', 0x4000060, 2, 0, 'ARM9'),
+        ('REG_DISPCAPCNT', 0x4000064, 4, 0, 'ARM9'),
+        ('REG_DISP_MMEM_FIFO', 0x4000068, 4, 0, 'ARM9'),
+        ('REG_MASTER_BRIGHT', 0x400006c, 2, 0, 'ARM9'),
+        ('REG_DISPCNT2', 0x4001000, 4, 0, 'ARM9'),
+        ('REG_VCOUNT2', 0x4001006, 2, 0, 'ARM9'),
+        ('REG_BG0CNT2', 0x4001008, 2, 0, 'ARM9'),
+        ('REG_BG1CNT2', 0x400100a, 2, 0, 'ARM9'),
+        ('REG_BG2CNT2', 0x400100c, 2, 0, 'ARM9'),
+        ('REG_BG3CNT2', 0x400100e, 2, 0, 'ARM9'),
+        ('REG_BG0HOFS2', 0x4001010, 2, 0, 'ARM9'),
+        ('REG_BG0VOFS2', 0x4001012, 2, 0, 'ARM9'),
+        ('REG_BG1HOFS2', 0x4001014, 2, 0, 'ARM9'),
+        ('REG_BG1VOFS2', 0x4001016, 2, 0, 'ARM9'),
+        ('REG_BG2HOFS2', 0x4001018, 2, 0, 'ARM9'),
+        ('REG_BG2VOFS2', 0x400101a, 2, 0, 'ARM9'),
+        ('REG_BG3HOFS2', 0x400101c, 2, 0, 'ARM9'),
+        ('REG_BG3VOFS2', 0x400101e, 2, 0, 'ARM9'),
+        ('REG_BG2PA2', 0x4001020, 2, 0, 'ARM9'),
+        ('REG_BG2PB2', 0x4001022, 2, 0, 'ARM9'),
+        ('REG_BG2PC2', 0x4001024, 2, 0, 'ARM9'),
+        ('REG_BG2PD2', 0x4001026, 2, 0, 'ARM9'),
+        ('REG_BG2X2', 0x4001028, 4, 0, 'ARM9'),
+        ('REG_BG2Y2', 0x400102c, 4, 0, 'ARM9'),
+        ('REG_BG3PA2', 0x4001030, 2, 0, 'ARM9'),
+        ('REG_BG3PB2', 0x4001032, 2, 0, 'ARM9'),
+        ('REG_BG3PC2', 0x4001034, 2, 0, 'ARM9'),
+        ('REG_BG3PD2', 0x4001036, 2, 0, 'ARM9'),
+        ('REG_BG3X2', 0x4001038, 4, 0, 'ARM9'),
+        ('REG_BG3Y2', 0x400103c, 4, 0, 'ARM9'),
+        ('REG_WIN0H2', 0x4001040, 2, 0, 'ARM9'),
+        ('REG_WIN1H2', 0x4001042, 2, 0, 'ARM9'),
+        ('REG_WIN0V2', 0x4001044, 2, 0, 'ARM9'),
+        ('REG_WIN1V2', 0x4001046, 2, 0, 'ARM9'),
+        ('REG_WININ2', 0x4001048, 2, 0, 'ARM9'),
+        ('REG_WINOUT2', 0x400104a, 2, 0, 'ARM9'),
+        ('REG_MOSAIC2', 0x400104c, 2, 0, 'ARM9'),
+        ('REG_BLDCNT2', 0x4001050, 2, 0, 'ARM9'),
+        ('REG_BLDALPHA2', 0x4001052, 2, 0, 'ARM9'),
+        ('REG_BLDY2', 0x4001054, 2, 0, 'ARM9'),
+    ),
+    'DMA': (
+        ('REG_DMA0SAD', 0x40000b0, 4, 0, None),
+        ('REG_DMA0DAD', 0x40000b4, 4, 0, None),
+        ('REG_DMA0CNT', 0x40000b8, 4, 0, None),
+        ('REG_DMA1SAD', 0x40000bc, 4, 0, None),
+        ('REG_DMA1DAD', 0x40000c0, 4, 0, None),
+        ('REG_DMA1CNT', 0x40000c4, 4, 0, None),
+        ('REG_DMA2SAD', 0x40000c8, 4, 0, None),
+        ('REG_DMA2DAD', 0x40000cc, 4, 0, None),
+        ('REG_DMA2CNT', 0x40000d0, 4, 0, None),
+        ('REG_DMA3SAD', 0x40000d4, 4, 0, None),
+        ('REG_DMA3DAD', 0x40000d8, 4, 0, None),
+        ('REG_DMA3CNT', 0x40000dc, 4, 0, None),
+        ('REG_DMA0FILL', 0x40000e0, 4, 0, 'ARM9'),
+        ('REG_DMA1FILL', 0x40000e4, 4, 0, 'ARM9'),
+        ('REG_DMA2FILL', 0x40000e8, 4, 0, 'ARM9'),
+        ('REG_DMA3FILL', 0x40000ec, 4, 0, 'ARM9'),
+    ),
+    'Timer': (
+        ('REG_TM0CNT_L', 0x4000100, 2, 0, None),
+        ('REG_TM0CNT_H', 0x4000102, 2, 0, None),
+        ('REG_TM1CNT_L', 0x4000104, 2, 0, None),
+        ('REG_TM1CNT_H', 0x4000106, 2, 0, None),
+        ('REG_TM2CNT_L', 0x4000108, 2, 0, None),
+        ('REG_TM2CNT_H', 0x400010a, 2, 0, None),
+        ('REG_TM3CNT_L', 0x400010c, 2, 0, None),
+        ('REG_TM3CNT_H', 0x400010e, 2, 0, None),
+    ),
+    'Joypad': (
+        ('REG_JP_KeyInput', 0x04000130, 2, 0, None),
+        ('REG_JP_KeyCnt', 0x04000132, 2, 0, None),
+        ('REG_RCNT', 0x04000134, 2, 0, 'ARM7'),
+        ('REG_JP_ExtKeyIn', 0x04000136, 2, 0, 'ARM7'),
+        ('REG_RTC', 0x04000138, 2, 0, 'ARM7'),
+    ),
+    'IPC': (
+        ('REG_IPCSYNC', 0x4000180, 2, 0, None),
+        ('REG_IPCFIFOCNT', 0x4000184, 2, 0, None),
+        ('REG_IPCFIFOSEND', 0x4000188, 4, 0, None),
+        ('REG_IPCFIFORECV', 0x4100000, 4, 0, None),
+    ),
+    'Card': (
+        ('REG_AUXSPICNT', 0x40001a0, 2, 0, None),
+        ('REG_AUXSPIDATA', 0x40001a2, 2, 0, None),
+        ('REG_ROMCTRL', 0x40001a4, 4, 0, None),
+        ('REG_CARD_COMMAND', 0x40001a8, 1, 8, None),
+        ('REG_CARD_DATA_RD', 0x4100010, 4, 0, None),
+    ),
+    'System': (
+        ('REG_Sys_WaitCnt', 0x04000204, 2, 0, None),
+        ('REG_Sys_IME', 0x04000208, 2, 0, None),
+        ('REG_Sys_IE', 0x04000210, 4, 0, None),
+        ('REG_Sys_IF', 0x04000214, 4, 0, None),
+        ('REG_POSTFLG', 0x04000300, 1, 0, None),
+        ('REG_HALTCNT', 0x04000301, 1, 0, 'ARM7'),
+    ),
+    'VMem': (
+        ('REG_VMEM_BankCnt', 0x04000240, 2, 0, 'ARM9'),
+        ('REG_VRAMCNT_C', 0x04000242, 1, 0, 'ARM9'),
+        ('REG_VRAMCNT_D', 0x04000243, 1, 0, 'ARM9'),
+        ('REG_VRAMCNT_E', 0x04000244, 1, 0, 'ARM9'),
+        ('REG_VRAMCNT_F', 0x04000245, 1, 0, 'ARM9'),
+        ('REG_VRAMCNT_G', 0x04000246, 1, 0, 'ARM9'),
+        ('REG_WRAMCNT', 0x04000247, 1, 0, 'ARM9'),
+        ('REG_VRAMCNT_H', 0x04000248, 1, 0, 'ARM9'),
+        ('REG_VRAMCNT_I', 0x04000249, 1, 0, 'ARM9'),
+        ('REG_VMEM_PAL_BG_FB1', 0x05000000, 2, 0x100, 'ARM9'),
+        ('REG_VMEM_PAL_FG_FB1', 0x05000200, 2, 0x100, 'ARM9'),
+        ('REG_VMEM_PAL_BG_FB2', 0x05000400, 2, 0x100, 'ARM9'),
+        ('REG_VMEM_PAL_FG_FB2', 0x05000600, 2, 0x100, 'ARM9'),
+    ),
+    'Math': (
+        ('REG_DIVCNT', 0x4000280, 2, 0, 'ARM9'),
+        ('REG_DIV_NUMER', 0x4000290, 4, 2, 'ARM9'),
+        ('REG_DIV_DENOM', 0x4000298, 4, 2, 'ARM9'),
+        ('REG_DIV_RESULT', 0x40002a0, 4, 2, 'ARM9'),
+        ('REG_DIVREM_RESULT', 0x40002a8, 4, 2, 'ARM9'),
+        ('REG_SQRTCNT', 0x40002b0, 2, 0, 'ARM9'),
+        ('REG_SQRT_RESULT', 0x40002b4, 4, 0, 'ARM9'),
+        ('REG_SQRT_PARAM', 0x40002b8, 4, 2, 'ARM9'),
+    ),
+    'ARM9': (
+        ('REG_POWCNT1', 0x04000304, 2, 0, 'ARM9'),
+    ),
+    'ARM7': (
+        ('REG_ARM7_SPI_CR', 0x040001C0, 2, 0, 'ARM7'),
+        ('REG_ARM7_SPI_Data', 0x040001C2, 2, 0, 'ARM7'),
+        ('REG_ARM7_PowerCnt', 0x04000304, 2, 0, 'ARM7'),
+        ('REG_BIOSPROT', 0x04000308, 4, 0, 'ARM7'),
+    ),
+    '3D': (
+        ('REG_RDLINES_COUNT', 0x4000320, 1, 0, 'ARM9'),
+        ('REG_EDGE_COLOR', 0x4000330, 2, 8, 'ARM9'),
+        ('REG_ALPHA_TEST_REF', 0x4000340, 1, 0, 'ARM9'),
+        ('REG_CLEAR_COLOR', 0x4000350, 4, 0, 'ARM9'),
+        ('REG_CLEAR_DEPTH', 0x4000354, 2, 0, 'ARM9'),
+        ('REG_CLRIMAGE_OFFSET', 0x4000356, 2, 0, 'ARM9'),
+        ('REG_FOG_COLOR', 0x4000358, 4, 0, 'ARM9'),
+        ('REG_FOG_OFFSET', 0x400035c, 2, 0, 'ARM9'),
+        ('REG_FOG_TABLE', 0x4000360, 1, 32, 'ARM9'),
+        ('REG_TOON_TABLE', 0x4000380, 2, 32, 'ARM9'),
+        ('REG_GXFIFO', 0x4000400, 4, 16, 'ARM9'),
+        ('REG_MTX_MODE', 0x4000440, 4, 0, 'ARM9'),
+        ('REG_MTX_PUSH', 0x4000444, 4, 0, 'ARM9'),
+        ('REG_MTX_POP', 0x4000448, 4, 0, 'ARM9'),
+        ('REG_MTX_STORE', 0x400044c, 4, 0, 'ARM9'),
+        ('REG_MTX_RESTORE', 0x4000450, 4, 0, 'ARM9'),
+        ('REG_MTX_IDENTITY', 0x4000454, 4, 0, 'ARM9'),
+        ('REG_MTX_LOAD_4x4', 0x4000458, 4, 0, 'ARM9'),
+        ('REG_MTX_LOAD_4x3', 0x400045c, 4, 0, 'ARM9'),
+        ('REG_MTX_MULT_4x4', 0x4000460, 4, 0, 'ARM9'),
+        ('REG_MTX_MULT_4x3', 0x4000464, 4, 0, 'ARM9'),
+        ('REG_MTX_MULT_3x3', 0x4000468, 4, 0, 'ARM9'),
+        ('REG_MTX_SCALE', 0x400046c, 4, 0, 'ARM9'),
+        ('REG_MTX_TRANS', 0x4000470, 4, 0, 'ARM9'),
+        ('REG_COLOR', 0x4000480, 4, 0, 'ARM9'),
+        ('REG_NORMAL', 0x4000484, 4, 0, 'ARM9'),
+        ('REG_TEXCOORD', 0x4000488, 4, 0, 'ARM9'),
+        ('REG_VTX_16', 0x400048c, 4, 0, 'ARM9'),
+        ('REG_VTX_10', 0x4000490, 4, 0, 'ARM9'),
+        ('REG_VTX_XY', 0x4000494, 4, 0, 'ARM9'),
+        ('REG_VTX_XZ', 0x4000498, 4, 0, 'ARM9'),
+        ('REG_VTX_YZ', 0x400049c, 4, 0, 'ARM9'),
+        ('REG_VTX_DIFF', 0x40004a0, 4, 0, 'ARM9'),
+        ('REG_POLYGON_ATTR', 0x40004a4, 4, 0, 'ARM9'),
+        ('REG_TEXIMAGE_PARAM', 0x40004a8, 4, 0, 'ARM9'),
+        ('REG_PLTT_BASE', 0x40004ac, 4, 0, 'ARM9'),
+        ('REG_DIF_AMB', 0x40004c0, 4, 0, 'ARM9'),
+        ('REG_SPE_EMI', 0x40004c4, 4, 0, 'ARM9'),
+        ('REG_LIGHT_VECTOR', 0x40004c8, 4, 0, 'ARM9'),
+        ('REG_LIGHT_COLOR', 0x40004cc, 4, 0, 'ARM9'),
+        ('REG_SHININESS', 0x40004d0, 4, 0, 'ARM9'),
+        ('REG_BEGIN_VTXS', 0x4000500, 4, 0, 'ARM9'),
+        ('REG_END_VTXS', 0x4000504, 4, 0, 'ARM9'),
+        ('REG_SWAP_BUFFERS', 0x4000540, 4, 0, 'ARM9'),
+        ('REG_VIEWPORT', 0x4000580, 4, 0, 'ARM9'),
+        ('REG_BOX_TEST', 0x40005c0, 4, 0, 'ARM9'),
+        ('REG_POS_TEST', 0x40005c4, 4, 0, 'ARM9'),
+        ('REG_VEC_TEST', 0x40005c8, 4, 0, 'ARM9'),
+        ('REG_GXSTAT', 0x4000600, 4, 0, 'ARM9'),
+        ('REG_RAM_COUNT', 0x4000604, 4, 0, 'ARM9'),
+        ('REG_DISP_1DOT_DEPTH', 0x4000610, 2, 0, 'ARM9'),
+        ('REG_POS_RESULT', 0x4000620, 4, 4, 'ARM9'),
+        ('REG_VEC_RESULT', 0x4000630, 2, 3, 'ARM9'),
+        ('REG_CLIPMTX_RESULT', 0x4000640, 4, 16, 'ARM9'),
+        ('REG_VECMTX_RESULT', 0x4000680, 4, 9, 'ARM9'),
+    ),
+    'Sound': tuple(
+        ('REG_SOUND' + str(ch) + field, 0x4000400 + 0x10 * ch + offset, width, 0, 'ARM7')
+            for ch in range(16)
+            for field, offset, width in (('CNT', 0, 4), ('SAD', 4, 4),
+                ('TMR', 8, 2), ('PNT', 0xA, 2), ('LEN', 0xC, 4))
+    ) + (
+        ('REG_SOUNDCNT', 0x4000500, 2, 0, 'ARM7'),
+        ('REG_SOUNDBIAS', 0x4000504, 2, 0, 'ARM7'),
+        ('REG_SNDCAP0CNT', 0x4000508, 1, 0, 'ARM7'),
+        ('REG_SNDCAP1CNT', 0x4000509, 1, 0, 'ARM7'),
+        ('REG_SNDCAP0DAD', 0x4000510, 4, 0, 'ARM7'),
+        ('REG_SNDCAP0LEN', 0x4000514, 2, 0, 'ARM7'),
+        ('REG_SNDCAP1DAD', 0x4000518, 4, 0, 'ARM7'),
+        ('REG_SNDCAP1LEN', 0x400051c, 2, 0, 'ARM7'),
+    ),
+    # Only on the DSi, so only for DSi-enhanced ROMs (see TWL_REG_GROUPS)
+    'DSi': (
+        ('REG_SCFG_A9ROM', 0x4004000, 2, 0, 'ARM9'),
+        ('REG_SCFG_ROM', 0x4004000, 2, 0, 'ARM7'),
+        ('REG_SCFG_CLK', 0x4004004, 2, 0, None),
+        ('REG_SCFG_RST', 0x4004006, 2, 0, 'ARM9'),
+        ('REG_SCFG_JTAG', 0x4004006, 2, 0, 'ARM7'),
+        ('REG_SCFG_EXT', 0x4004008, 4, 0, None),
+        ('REG_SCFG_MC', 0x4004010, 2, 0, None),
+        ('REG_SCFG_WL', 0x4004020, 2, 0, 'ARM7'),
+        ('REG_SCFG_OP', 0x4004024, 2, 0, 'ARM7'),
+        ('REG_MBK1', 0x4004040, 1, 4, None),
+        ('REG_MBK2', 0x4004044, 1, 4, None),
+        ('REG_MBK3', 0x4004048, 1, 4, None),
+        ('REG_MBK4', 0x400404c, 1, 4, None),
+        ('REG_MBK5', 0x4004050, 1, 4, None),
+        ('REG_MBK6', 0x4004054, 4, 0, None),
+        ('REG_MBK7', 0x4004058, 4, 0, None),
+        ('REG_MBK8', 0x400405c, 4, 0, None),
+        ('REG_MBK9', 0x4004060, 4, 0, None),
+        ('REG_NDMAGCNT', 0x4004100, 4, 0, None),
+    ) + tuple(
+        ('REG_NDMA' + str(ch) + field, 0x4004104 + 0x1C * ch + offset, 4, 0, None)
+            for ch in range(4)
+            for field, offset in (('SAD', 0), ('DAD', 4), ('TCNT', 8),
+                ('WCNT', 0xC), ('BCNT', 0x10), ('FDATA', 0x14), ('CNT', 0x18))
+    ) + (
+        ('REG_CAM_MCNT', 0x4004200, 2, 0, 'ARM9'),
+        ('REG_CAM_CNT', 0x4004202, 2, 0, 'ARM9'),
+        ('REG_CAM_DAT', 0x4004204, 4, 0, 'ARM9'),
+        ('REG_CAM_SOFS', 0x4004210, 4, 0, 'ARM9'),
+        ('REG_CAM_EOFS', 0x4004214, 4, 0, 'ARM9'),
+        ('REG_DSP_PDATA', 0x4004300, 2, 0, 'ARM9'),
+        ('REG_DSP_PADR', 0x4004304, 2, 0, 'ARM9'),
+        ('REG_DSP_PCFG', 0x4004308, 2, 0, 'ARM9'),
+        ('REG_DSP_PSTS', 0x400430c, 2, 0, 'ARM9'),
+        ('REG_DSP_PSEM', 0x4004310, 2, 0, 'ARM9'),
+        ('REG_DSP_PMASK', 0x4004314, 2, 0, 'ARM9'),
+        ('REG_DSP_PCLEAR', 0x4004318, 2, 0, 'ARM9'),
+        ('REG_DSP_SEM', 0x400431c, 2, 0, 'ARM9'),
+        ('REG_DSP_CMD0', 0x4004320, 2, 0, 'ARM9'),
+        ('REG_DSP_REP0', 0x4004324, 2, 0, 'ARM9'),
+        ('REG_DSP_CMD1', 0x4004328, 2, 0, 'ARM9'),
+        ('REG_DSP_REP1', 0x400432c, 2, 0, 'ARM9'),
+        ('REG_DSP_CMD2', 0x4004330, 2, 0, 'ARM9'),
+        ('REG_DSP_REP2', 0x4004334, 2, 0, 'ARM9'),
+        ('REG_AES_CNT', 0x4004400, 4, 0, 'ARM7'),
+        ('REG_AES_BLKCNT', 0x4004404, 4, 0, 'ARM7'),
+        ('REG_AES_WRFIFO', 0x4004408, 4, 0, 'ARM7'),
+        ('REG_AES_RDFIFO', 0x400440c, 4, 0, 'ARM7'),
+        ('REG_AES_IV', 0x4004420, 1, 16, 'ARM7'),
+        ('REG_AES_MAC', 0x4004430, 1, 16, 'ARM7'),
+        ('REG_AES_KEYSLOTS', 0x4004440, 1, 0xC0, 'ARM7'),
+        ('REG_SNDEXCNT', 0x4004700, 2, 0, 'ARM7'),
+        ('REG_SD_CMD', 0x4004800, 2, 0, 'ARM7'),
+        ('REG_SD_PORTSEL', 0x4004802, 2, 0, 'ARM7'),
+        ('REG_SD_CMDARG', 0x4004804, 4, 0, 'ARM7'),
+        ('REG_SD_STOP', 0x4004808, 2, 0, 'ARM7'),
+        ('REG_SD_BLKCOUNT', 0x400480a, 2, 0, 'ARM7'),
+        ('REG_SD_RESP', 0x400480c, 4, 4, 'ARM7'),
+        ('REG_SD_IRQ_STAT', 0x400481c, 4, 0, 'ARM7'),
+        ('REG_SD_IRQ_MASK', 0x4004820, 4, 0, 'ARM7'),
+        ('REG_SD_CLK_CTRL', 0x4004824, 2, 0, 'ARM7'),
+        ('REG_SD_BLKLEN', 0x4004826, 2, 0, 'ARM7'),
+        ('REG_SD_OPT', 0x4004828, 2, 0, 'ARM7'),
+        ('REG_SD_FIFO', 0x4004830, 2, 0, 'ARM7'),
+        ('REG_SD_DATA_CTL', 0x40048d8, 2, 0, 'ARM7'),
+        ('REG_SD_SOFT_RESET', 0x40048e0, 2, 0, 'ARM7'),
+        ('REG_SD_DATA32_IRQ', 0x4004900, 2, 0, 'ARM7'),
+        ('REG_SD_BLKLEN32', 0x4004904, 2, 0, 'ARM7'),
+        ('REG_SD_BLKCOUNT32', 0x4004908, 2, 0, 'ARM7'),
+        ('REG_SD_FIFO32', 0x400490c, 4, 0, 'ARM7'),
+        ('REG_GPIO_DATA', 0x4004c00, 1, 0, 'ARM7'),
+        ('REG_GPIO_DIR', 0x4004c01, 1, 0, 'ARM7'),
+        ('REG_GPIO_EDGE', 0x4004c02, 1, 0, 'ARM7'),
+        ('REG_GPIO_IE', 0x4004c03, 1, 0, 'ARM7'),
+        ('REG_GPIO_WIFI', 0x4004c04, 2, 0, 'ARM7'),
+    ),
+}
+
+# Register groups that only exist on the DSi
+TWL_REG_GROUPS = ('DSi',)
+NTR_REG_GROUPS = tuple(group for group in IO_REGISTERS if group not in TWL_REG_GROUPS)
+
+# Merged, address-sorted register lists, per (cpu, groups)
+_regTableCache = {}
+
+
+def RegsFor(cpu=None, groups=None):
+    """
+    Return the registers from the given groups (default: all of them)
+    that apply to the given CPU ('ARM9' or 'ARM7'; None for all), as
+    one list sorted by address.
+    """
+    key = (cpu, groups)
+    regs = _regTableCache.get(key)
+    if regs is None:
+        regs = []
+        for group, entries in IO_REGISTERS.items():
+            if groups is not None and group not in groups:
+                continue
+            for entry in entries:
+                if cpu is None or entry[4] is None or entry[4] == cpu:
+                    regs.append(entry)
+        regs.sort(key=lambda entry: entry[1])
+        _regTableCache[key] = regs
+    return regs
+
+
+def _regIsApplied(name, offset, size, count):
+    """
+    Check whether MakeReg() has already been done for a register: it
+    has its name, and is a data item of the right type and size.
+    """
+    if idc.Name(offset) != name:
+        return False
+    flags = idc.GetFlags(offset)
+    dataType = {1: idc.FF_BYTE, 2: idc.FF_WORD, 4: idc.FF_DWRD}.get(size)
+    return (idc.isData(flags) and (flags & idc.DT_TYPE) == dataType
+            and idc.ItemSize(offset) == size * max(count, 1))
 
-    MakeReg("REG_DisplayCnt", 0x04000000, 4)
-    MakeReg("REG_DisplayStatus", 0x04000004, 2)
-    MakeReg("REG_VCount", 0x04000006, 2)
-    MakeReg("REG_BG0CNT", 0x4000008, 2)
-    MakeReg("REG_BG1CNT", 0x400000a, 2)
-    MakeReg("REG_BG2CNT", 0x400000c, 2)
-    MakeReg("REG_BG3CNT", 0x400000e, 2)
-    MakeReg("REG_BG0HOFS", 0x4000010, 2)
-    MakeReg("REG_BG0VOFS", 0x4000012, 2)
-    MakeReg("REG_BG1HOFS", 0x4000014, 2)
-    MakeReg("REG_BG1VOFS", 0x4000016, 2)
-    MakeReg("REG_BG2HOFS", 0x4000018, 2)
-    MakeReg("REG_BG2VOFS", 0x400001a, 2)
-    MakeReg("REG_BG3HOFS", 0x400001c, 2)
-    MakeReg("REG_BG3VOFS", 0x400001e, 2)
-    MakeReg("REG_BG2PA", 0x4000020, 2)
-    MakeReg("REG_BG2PB", 0x4000022, 2)
-    MakeReg("REG_BG2PC", 0x4000024, 2)
-    MakeReg("REG_BG2PD", 0x4000026, 2)
-    MakeReg("REG_BG2X", 0x4000028, 4)
-    MakeReg("REG_BG2Y", 0x400002c, 4)
-    MakeReg("REG_BG3PA", 0x4000030, 2)
-    MakeReg("REG_BG3PB", 0x4000032, 2)
-    MakeReg("REG_BG3PC", 0x4000034, 2)
-    MakeReg("REG_BG3PD", 0x4000036, 2)
-    MakeReg("REG_BG3X", 0x4000038, 4)
-    MakeReg("REG_BG3Y", 0x400003c, 4)
-    MakeReg("REG_WIN0H", 0x4000040, 2)
-    MakeReg("REG_WIN1H", 0x4000042, 2)
-    MakeReg("REG_WIN0V", 0x4000044, 2)
-    MakeReg("REG_WIN1V", 0x4000046, 2)
-    MakeReg("REG_WININ", 0x4000048, 2)
-    MakeReg("REG_WINOUT", 0x400004a, 2)
-    MakeReg("REG_MOSAIC", 0x400004c, 2)
-    MakeReg("REG_BLDCNT", 0x4000050, 2)
-    MakeReg("REG_BLDY", 0x4000054, 2)
-    MakeReg("REG_VCOUNT2", 0x4001006, 2)
-    MakeReg("REG_BG0CNT2", 0x4001008, 2)
-    MakeReg("REG_BG1CNT2", 0x400100a, 2)
-    MakeReg("REG_BG2CNT2", 0x400100c, 2)
-    MakeReg("REG_BG3CNT2", 0x400100e, 2)
-    MakeReg("REG_BG2PA2", 0x4001020, 2)
-    MakeReg("REG_BG2PB2", 0x4001022, 2)
-    MakeReg("REG_BG2PC2", 0x4001024, 2)
-    MakeReg("REG_BG2PD2", 0x4001026, 2)
-    MakeReg("REG_BG2X2", 0x4001028, 4)
-    MakeReg("REG_BG2Y2", 0x400102c, 4)
-    MakeReg("REG_BG3PA2", 0x4001030, 2)
-    MakeReg("REG_BG3PB2", 0x4001032, 2)
-    MakeReg("REG_BG3PC2", 0x4001034, 2)
-    MakeReg("REG_BG3PD2", 0x4001036, 2)
-    MakeReg("REG_BG3X2", 0x4001038, 4)
-    MakeReg("REG_BG3Y2", 0x400103c, 4)
-    MakeReg("REG_WIN0H2", 0x4001040, 2)
-    MakeReg("REG_WIN1H2", 0x4001042, 2)
-    MakeReg("REG_WIN0V2", 0x4001044, 2)
-    MakeReg("REG_WIN1V2", 0x4001046, 2)
-    MakeReg("REG_WININ2", 0x4001048, 2)
-    MakeReg("REG_WINOUT2", 0x400104a, 2)
-    MakeReg("REG_MOSAIC2", 0x400104c, 2)
-    MakeReg("REG_BLDCNT2", 0x4001050, 2)
-    MakeReg("REG_BLDY2", 0x4001054, 2)
+
+def ApplyRegs(cpu=None, groups=None):
+    """
+    Name and type all registers from RegsFor(cpu, groups) in a single
+    pass. Registers that are already named and typed are skipped, so
+    running this again on an existing database only redoes what's
+    missing.
+    """
+    for name, offset, size, count, _ in RegsFor(cpu, groups):
+        if not _regIsApplied(name, offset, size, count):
+            MakeReg(name, offset, size, count)
+
+
+def MakeVideoRegs():
+    ApplyRegs(groups=('Video',))
 
 def MakeVMemRegs():
-    MakeReg("REG_VMEM_PAL_BG_FB1", 0x05000000, 2, 0x200)
-    MakeReg("REG_VMEM_PAL_FG_FB1", 0x05000200, 2, 0x200)
-    MakeReg("REG_VMEM_PAL_BG_FB2", 0x05000400, 2, 0x200)
-    MakeReg("REG_VMEM_PAL_FG_FB2", 0x05000600, 2, 0x200)
-    MakeReg("REG_VMEM_BankCnt", 0x04000240, 2)
+    ApplyRegs(groups=('VMem',))
 
 def MakeJoypadRegs():
-    MakeReg("REG_JP_KeyInput", 0x04000130, 2)
-    MakeReg("REG_JP_KeyCnt", 0x04000132, 2)    
+    ApplyRegs(groups=('Joypad',))
 
 def MakeSystemRegs():
-    MakeReg("REG_Sys_WaitCnt", 0x04000204, 2)
-    MakeReg("REG_Sys_IME", 0x04000208, 2)
-    MakeReg("REG_Sys_IE", 0x04000210, 4)
-    MakeReg("REG_Sys_IF", 0x04000214, 4)
-    MakeReg("REG_Sys_HaltCnt", 0x04000230, 2)
+    ApplyRegs(groups=('System',))
 
 def MakeARM7Regs():
-    MakeReg("REG_ARM7_PowerCnt", 0x04000304, 2)
-    MakeReg("REG_ARM7_SPI_CR", 0x040001C0, 2)
-    MakeReg("REG_ARM7_SPI_Data", 0x040001C2, 2)
+    ApplyRegs(groups=('ARM7',))
 
 def MakeARM9Regs():
-    MakeReg("REG_ARM9_PowerCnt", 0x04000308, 2)
+    ApplyRegs(groups=('ARM9',))
+
+
+def _loaderOption(name, default):
+    """
+    Return the value of a loader option, given either as an NDS_<NAME>
+    environment variable or on the IDA command line as
+    -Onds:name=value[:name2=value2...].
+    """
+    value = os.environ.get('NDS_' + name.upper())
+    if value is not None:
+        return value
+    try:
+        options = idaapi.get_plugin_options('nds') or ''
+    except Exception:
+        options = ''
+    for option in options.split(':'):
+        key, _, value = option.partition('=')
+        if key.strip().lower() == name.lower():
+            return value.strip()
+    return default
+
+
+# Overlays usually share RAM addresses with each other, and only one of
+# them can be mapped at its real address. The others are mapped one
+# after another from here.
+OVERLAY_BANK_BASE = 0x20000000
+
+# If there are more overlays than this, they aren't loaded up front
+# unless asked for (see MapOverlays)
+OVERLAY_EAGER_LIMIT = 32
+
+OVERLAY_NETNODE = "$ nds overlays"
+
+
+def _rangeIsFree(startEA, endEA):
+    if ida_segment.getseg(startEA) is not None:
+        return False
+    seg = ida_segment.get_next_seg(startEA)
+    return seg is None or seg.start_ea >= endEA
+
+
+def _overlayEA(ramAddress, size):
+    """
+    Find an address to map an overlay at: its RAM address if that's
+    still free, or else the end of the overlay bank.
+    """
+    if _rangeIsFree(ramAddress, ramAddress + size):
+        return ramAddress
+    ea = OVERLAY_BANK_BASE
+    seg = ida_segment.getseg(ea) or ida_segment.get_next_seg(ea)
+    while seg is not None:
+        ea = max(ea, seg.end_ea)
+        seg = ida_segment.get_next_seg(seg.start_ea)
+    return (ea + 0xFFF) & ~0xFFF
+
+
+def MapAutoloads(autoloads):
+    """
+    Create segments for a main code file's autoload blocks (ITCM,
+    DTCM...; CodeSections) in one pass, with their bytes copied from
+    the already decompressed code file. Returns the sections that were
+    mapped.
+    """
+    mapped = []
+    for section in autoloads:
+        startEA = section.ramAddress
+        endEA = startEA + len(section.data) + section.bssSize
+        if endEA <= startEA:
+            continue
+        if not _rangeIsFree(startEA, endEA):
+            print("Autoload block at " + hex(startEA) + " overlaps another segment; skipping it")
+            continue
+        idc.AddSeg(startEA, endEA, 0, 1, idaapi.saRelPara, idaapi.scPub)
+        idc.RenameSeg(startEA, section.name)
+        if len(section.data):
+            idaapi.mem2base(bytes(section.data), startEA)
+        mapped.append(section)
+    return mapped
+
+
+def SeedAnalysis(plan, sections):
+    """
+    Queue the pointers and Thumb functions an AnalysisPlan found for
+    auto-analysis, in one batch: a data reference for every pointer,
+    and a function for every Thumb function. Only seeds inside the
+    given (mapped) CodeSections are used. This gives IDA most function
+    entry points up front, instead of it having to find them by
+    following code from the entry point. Turned off with the
+    "pointers=off" loader option.
+    """
+    if _loaderOption('pointers', 'on') == 'off':
+        return
+
+    ranges = sorted((s.ramAddress, s.ramAddress + len(s.data) + s.bssSize)
+                    for s in sections)
+    starts = [start for start, _ in ranges]
+    def isMapped(ea):
+        i = bisect.bisect_right(starts, ea) - 1
+        return i >= 0 and ea < ranges[i][1]
+
+    count = 0
+    for ea, target in plan.refs:
+        if isMapped(ea) and isMapped(target):
+            idc.add_dref(ea, target, idc.dr_O)
+            count += 1
+
+    thumbFunctions = [ea for ea in plan.thumbFunctions if isMapped(ea)]
+    for ea in thumbFunctions:
+        idc.SetReg(ea, "T", 1)
+        idc.AutoMark(ea, idc.AU_PROC)
+
+    print("Queued " + str(count) + " pointers and "
+          + str(len(thumbFunctions)) + " Thumb functions for analysis")
+
+
+def MapOverlay(li, cpu, ovID, ramAddress, ramSize, bssSize, fileStart, fileEnd, flags):
+    """
+    Create a segment for one overlay and load its bytes straight from
+    the input file. Returns the address it was mapped at.
+    """
+    size = ramSize + bssSize
+    ea = _overlayEA(ramAddress, max(size, 1))
+    name = "overlay" + cpu[-1] + "_" + str(ovID)
+
+    idc.AddSeg(ea, ea + size, 0, 1, idaapi.saRelPara, idaapi.scPub)
+    idc.RenameSeg(ea, name)
+    seg = ida_segment.getseg(ea)
+    if seg is not None:
+        ida_segment.set_segment_cmt(seg, cpu + " overlay " + str(ovID)
+            + ", RAM address " + hex(ramAddress), 0)
+
+    if flags & 1:
+        li.seek(fileStart)
+        data = decompressBlz(li.read(fileEnd - fileStart))
+        idaapi.mem2base(bytes(data[:ramSize]), ea)
+    else:
+        li.file2base(fileStart, ea, ea + min(fileEnd - fileStart, ramSize), 1)
+    return ea
+
+
+def MapOverlays(li, ndsRom, cpu):
+    """
+    Record all of a CPU's overlays in the database, and map the ones
+    selected by the "overlays" loader option: "all", "none", or a
+    comma-separated list of overlay IDs. By default all of them are
+    mapped, unless there are more than OVERLAY_EAGER_LIMIT. Overlays
+    that aren't mapped now can be mapped later with LoadOverlay().
+    Returns a dict of how far each mapped overlay was moved from its
+    RAM address (mapped address - RAM address), by overlay ID.
+    """
+    table = ndsRom.arm7OverlayTable if cpu == 'ARM7' else ndsRom.arm9OverlayTable
+    overlays = loadOverlayTable(table, lambda ovID, fileID: None)
+    if not overlays:
+        return {}
+
+    which = _loaderOption('overlays', 'auto').lower()
+    if which == 'auto':
+        which = 'all' if len(overlays) <= OVERLAY_EAGER_LIMIT else 'none'
+    if which == 'all':
+        wanted = set(overlays)
+    elif which == 'none':
+        wanted = set()
+    else:
+        wanted = {int(ovID, 0) for ovID in which.split(',') if ovID.strip()}
+
+    node = ida_netnode.netnode(OVERLAY_NETNODE, 0, True)
+    cpuIndex = 7 if cpu == 'ARM7' else 9
+    deltas = {}
+    for ovID, ov in sorted(overlays.items()):
+        fileStart, fileEnd = ndsRom.fileRange(ov.fileID)
+        mappedEA = 0
+        if ovID in wanted:
+            mappedEA = MapOverlay(li, cpu, ovID, ov.ramAddress, ov.ramSize,
+                ov.bssSize, fileStart, fileEnd, ov.flags)
+            deltas[ovID] = mappedEA - ov.ramAddress
+        node.supset((cpuIndex << 16) | ovID, struct.pack('<7I', ov.ramAddress,
+            ov.ramSize, ov.bssSize, fileStart, fileEnd, ov.flags, mappedEA))
+
+    print("Mapped " + str(len(wanted & set(overlays))) + " of "
+          + str(len(overlays)) + " " + cpu + " overlays")
+    return deltas
+
+
+def ApplySignatures(ndsRom, cpu, overlayDeltas, suffix=""):
+    """
+    Name the functions found by signatures in a CPU's main code (see
+    NintendoDSRom.analysisPlan()) and mapped overlays (see
+    NintendoDSRom.overlayFunctionNames()), all in one batch. suffix is
+    added to every name (to keep the two CPUs' copies of the same SDK
+    function apart). Matches of short wildcard signatures are left
+    out (see trustedNames()). Turned off with the "signatures=off"
+    loader option.
+    """
+    if _loaderOption('signatures', 'on') == 'off':
+        return
+
+    # Names come from the main code's (possibly cached) analysis plan,
+    # which also remembers the names in each overlay already matched.
+    # Only mapped overlays are decompressed and matched.
+    plan = ndsRom.analysisPlan(cpu, _loaderOption('cache_dir', None))
+    names = list(plan.names)
+    names.extend(OverlayNames(ndsRom, cpu, overlayDeltas))
+    names = trustedNames(names)
+
+    ApplyNames(names, suffix)
+    print("Named " + str(len(names)) + " " + cpu + " functions from signatures")
+
+
+def OverlayNames(ndsRom, cpu, overlayDeltas):
+    """
+    Return the (address, name, thumb) functions found by signatures in
+    the overlays in overlayDeltas (a dict of how far each one was
+    moved when it was mapped, by overlay ID), at their mapped
+    addresses.
+    """
+    if not overlayDeltas:
+        return []
+    return [(address + overlayDeltas[ovID], name, thumb)
+            for ovID, address, name, thumb
+            in ndsRom.overlayFunctionNames(cpu, set(overlayDeltas),
+                                           _loaderOption('cache_dir', None))]
+
+
+def ApplyNames(names, suffix=""):
+    """
+    Name and queue for analysis a list of (address, name, thumb)
+    functions, adding suffix to every name.
+    """
+    for address, name, thumb in names:
+        idc.MakeNameEx(address, name + suffix, idc.SN_NOCHECK | idc.SN_NOWARN)
+        if thumb:
+            idc.SetReg(address, "T", 1)
+        idc.AutoMark(address, idc.AU_PROC)
+
+
+def LoadOverlay(ovID, cpu='ARM9'):
+    """
+    Map an overlay that wasn't mapped when the ROM was loaded, and
+    name the functions signatures find in it. Meant to be called from
+    the IDA console after loading. Returns the address it was mapped
+    at.
+    """
+    node = ida_netnode.netnode(OVERLAY_NETNODE, 0, False)
+    cpuIndex = 7 if cpu == 'ARM7' else 9
+    entry = node.supval((cpuIndex << 16) | ovID)
+    if entry is None:
+        raise ValueError(cpu + ' overlay ' + str(ovID) + ' does not exist')
+    ramAddress, ramSize, bssSize, fileStart, fileEnd, flags, mappedEA = \
+        struct.unpack('<7I', entry)
+    if mappedEA:
+        return mappedEA
+
+    li = idaapi.loader_input_t()
+    if not li.open(idaapi.get_input_file_path()):
+        raise IOError('Cannot open the input file again')
+    try:
+        mappedEA = MapOverlay(li, cpu, ovID, ramAddress, ramSize, bssSize,
+            fileStart, fileEnd, flags)
+        names = None
+        if _loaderOption('signatures', 'on') != 'off':
+            ndsRom = _romFromInput(li)
+            try:
+                names = trustedNames(OverlayNames(ndsRom, cpu, {ovID: mappedEA - ramAddress}))
+            finally:
+                _releaseRom(ndsRom)
+    finally:
+        li.close()
+    node.supset((cpuIndex << 16) | ovID, struct.pack('<7I', ramAddress,
+        ramSize, bssSize, fileStart, fileEnd, flags, mappedEA))
+
+    if names is not None:
+        # ARM7 names get a suffix if both CPUs share the database (see
+        # LoadCode())
+        both = ida_segment.get_segm_by_name("ARM7_RAM") is not None
+        suffix = "_arm7" if both and cpu == 'ARM7' else ""
+        ApplyNames(names, suffix)
+        print("Named " + str(len(names)) + " functions in " + cpu
+              + " overlay " + str(ovID) + " from signatures")
+    return mappedEA
+
+
+# Parsed ROMs, keyed by input identity, so that a ROM is only parsed
+# once while it's being loaded. A ROM that's a real file is
+# memory-mapped, which keeps it open (and on Windows, stops it from
+# being overwritten or deleted), so entries only last until
+# _releaseRom() at the end of load_file() or LoadOverlay(). Oldest
+# entries are evicted first if that's ever skipped.
+ROM_CACHE_SIZE = 4
+_romCache = collections.OrderedDict()
+
+
+def _inputPath(li):
+    """
+    Return the filesystem path of a loader input, or None if IDA
+    won't tell us.
+    """
+    try:
+        path = li.filename()
+    except Exception:
+        try:
+            path = idaapi.get_input_file_path()
+        except Exception:
+            path = None
+    if path and os.path.isfile(path):
+        return path
+    return None
+
+
+def _inputKey(li):
+    """
+    Return a key identifying the ROM behind a loader input: its size,
+    its modification time (if it's a real file) and a hash of its
+    header.
+    """
+    path = _inputPath(li)
+    mtime = os.stat(path).st_mtime_ns if path is not None else None
+    li.seek(0)
+    headerHash = hashlib.sha1(li.read(HEADER_LEN)).digest()
+    return (li.size(), mtime, headerHash)
+
+
+def _romFromInput(li):
+    """
+    Return a NintendoDSRom for a loader input, reusing a previously
+    parsed one if possible. If the input is a real file, it's
+    memory-mapped rather than read.
+    """
+    key = _inputKey(li)
+    ndsRom = _romCache.get(key)
+    if ndsRom is not None:
+        _romCache.move_to_end(key)
+        return ndsRom
+
+    path = _inputPath(li)
+    if path is not None and os.path.getsize(path) == li.size():
+        ndsRom = NintendoDSRom.fromFile(path, lazy=True)
+    else:
+        li.seek(0)
+        ndsRom = NintendoDSRom(li.read(li.size()))
+
+    _romCache[key] = ndsRom
+    while len(_romCache) > ROM_CACHE_SIZE:
+        _, evicted = _romCache.popitem(last=False)
+        evicted.close()
+    return ndsRom
+
+
+def _releaseRom(ndsRom):
+    """
+    Drop a ROM returned by _romFromInput() from the cache and close
+    it, so the input file isn't kept open once loading is done.
+    """
+    for key, cached in list(_romCache.items()):
+        if cached is ndsRom:
+            del _romCache[key]
+    ndsRom.close()
+
 
 def accept_file(li, n):
-    ndsRom = NintendoDSRom(li.read(li.size()))
-    if ((ndsRom.name != b'')):
-        return "Nintendo DS (" + str(ndsRom.name) + ")"
+    # Only the header (and the file size, to reject truncated dumps) is
+    # needed to recognize a ROM, so don't read (or parse) the rest of
+    # it here
+    li.seek(0)
+    header = probeHeader(li.read(HEADER_LEN), li.size())
+    if header is not None and header.name != b'':
+        return "Nintendo DS (" + header.name.decode('latin-1') + ")"
     return 0
 
-def load_file(li, neflags, format):
+# I/O register segments shared by both CPUs
+IO_SEGMENTS = [
+    (0x04000000, 0x04001056, "General_Regs"),
+    (0x05000000, 0x05000800, "VMEM_Regs"),
+    (0x04100000, 0x04100014, "IPC_Regs"),
+]
+
+# And the ones only DSi-enhanced ROMs get
+TWL_IO_SEGMENTS = [
+    (0x04004000, 0x04004D00, "TWL_Regs"),
+]
+
+
+def _isBatchMode():
+    try:
+        return bool(idaapi.cvar.batch)
+    except Exception:
+        return False
+
+
+def _cpusToLoad():
+    """
+    Decide which CPUs' code to load, from the "cpu" loader option:
+    "arm9", "arm7", "both", or "ask" (the default), which asks, except
+    in batch mode (idat -B / -A), where it loads both.
+    """
+    which = _loaderOption('cpu', 'ask').lower()
+    if which == 'ask' and _isBatchMode():
+        which = 'both'
+    if which == 'ask':
+        answer = idaapi.ask_yn(1, "This ROM contains both ARM9 and ARM7 code\n"
+            "Do you want to load the ARM9 binary? (Set the \"cpu=both\" "
+            "loader option to load both into one database.)")
+        which = 'arm9' if answer == 1 else 'arm7'
+    if which == 'both':
+        return ['ARM9', 'ARM7']
+    if which == 'arm7':
+        return ['ARM7']
+    return ['ARM9']
+
+
+def LoadCode(li, ndsRom, cpu, both=False):
+    """
+    Map one CPU's main code file: its static module (and BSS) in a RAM
+    segment, and its autoload blocks in their own segments, then seed
+    analysis of it. When both CPUs go into one database (both=True),
+    the segment is named after the CPU, and if the RAM range is
+    already taken by the other CPU, the code is mapped after the
+    overlays instead, with a comment saying where it really belongs.
+    Returns (segment start address, entry point address).
+
+    The layout, decompressed bytes and seeds all come from the code's
+    AnalysisPlan, which is cached (in the directory given by the
+    "cache_dir" loader option, or next to the ROM), so loading the
+    same code again just replays it.
+    """
+    if cpu == 'ARM7':
+        code, entryAddr, offset = ndsRom.arm7, ndsRom.arm7EntryAddress, ndsRom.arm7Offset
+    else:
+        code, entryAddr, offset = ndsRom.arm9, ndsRom.arm9EntryAddress, ndsRom.arm9Offset
+    plan = ndsRom.analysisPlan(cpu, _loaderOption('cache_dir', None))
+    sections = plan.codeSections(code)
+
+    # Compressed binaries are decompressed before they're mapped, and
+    # only the static module goes in the RAM segment; autoload blocks
+    # get their own segments
+    static = sections[0]
+    ramAddress = static.ramAddress
+    size = len(static.data) + static.bssSize
+    if plan.compressed:
+        print(cpu + " ROM is compressed; decompressed to " + hex(len(plan.data)) + " bytes")
+
+    startEA = _overlayEA(ramAddress, max(size, 1)) if both else ramAddress
+    idc.AddSeg(startEA, startEA + size, 0, 1, idaapi.saRelPara, idaapi.scPub)
+    idc.RenameSeg(startEA, cpu + "_RAM" if both else "RAM")
+    if startEA != ramAddress:
+        print(cpu + " code overlaps the other CPU's; mapped at " + hex(startEA))
+        seg = ida_segment.getseg(startEA)
+        if seg is not None:
+            ida_segment.set_segment_cmt(seg, cpu + " static module, RAM address "
+                + hex(ramAddress) + " (moved: overlaps other code)", 0)
+        if ramAddress <= entryAddr < ramAddress + size:
+            entryAddr += startEA - ramAddress
+
     li.seek(0)
-    ndsRom = NintendoDSRom(li.read(li.size()))
-    retval = 1
+    if plan.compressed:
+        idaapi.mem2base(bytes(static.data), startEA)
+    else:
+        li.file2base(offset, startEA, startEA + len(static.data), 1)
 
-    useArm9 = ask_yn(1, "This ROM potentially contains both ARM9 and ARM7 code\nDo you want to load the ARM9 binary?")
-    if (useArm9 == -1):
-        useArm9 = 0
-    
-    useArm9 = bool(useArm9)
-
-    proc = ""
-    startEA = 0
-    endEA = 0
-    offset = 0
-    entryAddr = 0
-    size = 0
-    name = ""
-    rom = ""
-    if (useArm9):
-        name = "ARM9 ROM"
-        proc = "ARM"
-        entryAddr = ndsRom.arm9EntryAddress
-        startEA = ndsRom.arm9RamAddress
-        endEA = ndsRom.arm9RamAddress + ndsRom.arm9Len
-        offset = ndsRom.arm9Offset
-        size = ndsRom.arm9Len
-        rom = ndsRom.arm9
+    autoloads = MapAutoloads(sections[1:])
+    if startEA == ramAddress:
+        SeedAnalysis(plan, [static] + autoloads)
+    else:
+        # Pointers in moved code don't point into where it's mapped
+        SeedAnalysis(plan, autoloads)
+
+    return startEA, entryAddr
+
+
+def LoadTwlCode(li, ndsRom, cpu, both=False):
+    """
+    Map a CPU's DSi-only code from a DSi-enhanced ROM: its ARM9i or
+    ARM7i binary, in a segment at its RAM address (or, if that's
+    taken, after the overlays, like LoadCode() does), and the new
+    shared WRAM windows the header sets up for it, as empty segments.
+    The code is seeded and named from its analysis plan, like the main
+    code. Code still encrypted with modcrypt isn't mapped, since it
+    would just be noise.
+    """
+    twl = ndsRom.twlHeader
+    name = cpu + 'i'
+    if cpu == 'ARM7':
+        offset, ramAddress, length = twl.arm7iOffset, twl.arm7iRamAddress, twl.arm7iLen
     else:
-        name = "ARM7 ROM"
-        proc = "ARM710A"
-        entryAddr = ndsRom.arm7EntryAddress
-        startEA = ndsRom.arm7RamAddress
-        endEA = ndsRom.arm7RamAddress + ndsRom.arm7Len
-        offset = ndsRom.arm7Offset
-        size = ndsRom.arm7Len
-        rom = ndsRom.arm7
+        offset, ramAddress, length = twl.arm9iOffset, twl.arm9iRamAddress, twl.arm9iLen
+
+    if length and twl.isEncrypted(offset, length):
+        print(name + " binary is encrypted with modcrypt; not mapping it")
+    elif length:
+        startEA = _overlayEA(ramAddress, length)
+        idc.AddSeg(startEA, startEA + length, 0, 1, idaapi.saRelPara, idaapi.scPub)
+        idc.RenameSeg(startEA, name)
+        li.seek(0)
+        li.file2base(offset, startEA, startEA + length, 1)
+        if startEA != ramAddress:
+            print(name + " code overlaps other code; mapped at " + hex(startEA))
+            seg = ida_segment.getseg(startEA)
+            if seg is not None:
+                ida_segment.set_segment_cmt(seg, name + " binary, RAM address "
+                    + hex(ramAddress) + " (moved: overlaps other code)", 0)
+        else:
+            # Pointers in moved code don't point into where it's
+            # mapped, so only code at its real address is seeded
+            plan = ndsRom.analysisPlan(name, _loaderOption('cache_dir', None))
+            SeedAnalysis(plan, plan.codeSections(ndsRom.arm7i if cpu == 'ARM7' else ndsRom.arm9i))
+            if _loaderOption('signatures', 'on') != 'off':
+                ApplyNames(trustedNames(plan.names), "_arm7" if both and cpu == 'ARM7' else "")
+
+    for wramName, startEA, endEA in twl.wramWindows(cpu):
+        if _rangeIsFree(startEA, endEA):
+            idc.AddSeg(startEA, endEA, 0, 1, idaapi.saRelPara, idaapi.scPub)
+            idc.RenameSeg(startEA, wramName)
+
+
+def ApplyDualRegs(groups=None):
+    """
+    Name I/O registers (from the given groups; default: all of them)
+    for a database with both CPUs' code: ARM9 and shared registers get
+    names, as do ARM7-only registers at free addresses. ARM7 registers
+    that overlap an ARM9 register or array (e.g. the sound registers
+    inside REG_GXFIFO) get a repeatable comment on the ARM9 item
+    instead, since an address can only have one name and belong to one
+    item.
+    """
+    ApplyRegs('ARM9', groups)
+
+    # The address ranges the ARM9 registers take up, by start address
+    arm9Regs = RegsFor('ARM9', groups)
+    starts = [offset for _, offset, _, _, _ in arm9Regs]
+    ends = [offset + size * max(count, 1) for _, offset, size, count, _ in arm9Regs]
+
+    comments = collections.defaultdict(list)
+    for name, offset, size, count, cpu in RegsFor('ARM7', groups):
+        if cpu is None:
+            # Shared, so already named along with the ARM9 ones
+            continue
+        end = offset + size * max(count, 1)
+        # The ARM9 register containing offset, or else the first one
+        # starting inside this register
+        i = bisect.bisect_right(starts, offset) - 1
+        if i < 0 or ends[i] <= offset:
+            i += 1
+        if i < len(starts) and starts[i] < end:
+            comments[starts[i]].append("ARM7: " + name)
+        elif not _regIsApplied(name, offset, size, count):
+            MakeReg(name, offset, size, count)
+
+    for head, lines in comments.items():
+        idc.MakeRptCmt(head, "\n".join(lines))
+
 
+def load_file(li, neflags, format):
+    ndsRom = _romFromInput(li)
+    try:
+        return LoadRom(li, ndsRom)
+    finally:
+        _releaseRom(ndsRom)
+
+
+def LoadRom(li, ndsRom):
+    """
+    Load a parsed ROM into the database: its code for the CPUs picked
+    by _cpusToLoad(), I/O register segments, and names.
+    """
+    cpus = _cpusToLoad()
+    both = len(cpus) == 2
+
+    # A database has one processor type; plain ARM (ARMv5TE) covers
+    # the ARM7TDMI's instructions too
+    proc = "ARM710A" if cpus == ['ARM7'] else "ARM"
     idaapi.set_processor_type(proc, idaapi.SETPROC_LOADER_NON_FATAL|idaapi.SETPROC_LOADER)
-    
-    memory =  \
-    [
-        [ startEA, endEA, "RAM" ],
-        [ 0x04000000, 0x04001056, "General_Regs" ],
-        [ 0x05000000, 0x05000600, "VMEM_Regs" ],
-    ]
-
-    if ((startEA < memory[0][0] or endEA > memory[0][1]) and (startEA < memory[1][0] or endEA > memory[1][1]) and (startEA < memory[2][0] or endEA > memory[2][1])):
-        raise Exception("ROM not mapped into valid mem!")
-
-    for segment in memory:
-        idc.AddSeg(segment[0], segment[1], 0, 1, idaapi.saRelPara, idaapi.scPub)
-        idc.RenameSeg(segment[0], segment[2])
-
-        if "RAM" not in segment[2]:
-            for i in xrange(segment[0], segment[1]):
-		        idc.PatchByte(i, 0)
-    
-    idaapi.add_entry(entryAddr, entryAddr, "start", 1)
-    idc.MakeNameEx(entryAddr, "start", idc.SN_NOCHECK | idc.SN_NOWARN)
-    idaapi.cvar.inf.startIP = entryAddr
-    idaapi.cvar.inf.beginEA = entryAddr
+
     ida_segment.set_selector(1, 0)
     idaapi.cvar.inf.startCS = 1
-    
 
-    li.seek(0)
-    li.file2base(offset, startEA, endEA, 1)
+    loaded = [(cpu,) + LoadCode(li, ndsRom, cpu, both) for cpu in cpus]
+
+    # DSi-enhanced ROMs also have DSi-only code and registers
+    isTwl = ndsRom.twlHeader is not None
+    ioSegments = IO_SEGMENTS
+    if isTwl:
+        for cpu in cpus:
+            LoadTwlCode(li, ndsRom, cpu, both)
+        ioSegments = IO_SEGMENTS + TWL_IO_SEGMENTS
+
+    for startEA, endEA, name in ioSegments:
+        idc.AddSeg(startEA, endEA, 0, 1, idaapi.saRelPara, idaapi.scPub)
+        idc.RenameSeg(startEA, name)
+        FillRange(startEA, endEA, 0)
+
+    for cpu, _, entryAddr in loaded:
+        entryName = "start_arm7" if both and cpu == 'ARM7' else "start"
+        idaapi.add_entry(entryAddr, entryAddr, entryName, 1)
+        idc.MakeNameEx(entryAddr, entryName, idc.SN_NOCHECK | idc.SN_NOWARN)
 
+    _, startEA, entryAddr = loaded[0]
     idaapi.cvar.inf.startCS = 0
     idaapi.cvar.inf.startIP = entryAddr
-    
+    idaapi.cvar.inf.beginEA = entryAddr
+
     idc.ExtLinA(startEA, 1,  "; Title : " + str(ndsRom.name))
     idc.ExtLinA(startEA, 1,  "; Software Version: " + str(ndsRom.version))
 
-    # Add TwlHdr
-    MakeVideoRegs()
-    MakeVMemRegs()
-    MakeJoypadRegs()
-    MakeSystemRegs()
-    if name == "ARM7 ROM":
-        MakeARM7Regs()
+    groups = None if isTwl else NTR_REG_GROUPS
+    if both:
+        ApplyDualRegs(groups)
     else:
-        MakeARM9Regs()
-
+        ApplyRegs(cpus[0], groups)
+    for cpu in cpus:
+        suffix = "_arm7" if both and cpu == 'ARM7' else ""
+        ApplySignatures(ndsRom, cpu, MapOverlays(li, ndsRom, cpu), suffix)
 
     print("Done! Entry point @ " + hex(entryAddr))
     return 1
+
+
+# ---------------------------------------------------------------------
+# Headless batch analysis (python -m nds)
+
+ROM_EXTENSIONS = ('.nds', '.srl', '.dsi')
+
+# Recycle worker processes after this many batches of ROMs, so a handful of huge
+# or pathological ones can't keep a worker's memory high for the rest
+# of the run
+WORKER_MAX_TASKS = 16
+
+SUMMARY_FIELDS = [
+    'path', 'size', 'title', 'gameCode', 'makerCode', 'unitCode',
+    'version', 'deviceCapacity', 'logoValid', 'headerChecksumValid',
+    'secureAreaChecksumValid',
+    'arm9Offset', 'arm9RamAddress', 'arm9EntryAddress', 'arm9Len',
+    'arm9Compressed', 'arm7Offset', 'arm7RamAddress', 'arm7EntryAddress',
+    'arm7Len', 'arm7Compressed', 'files', 'folders', 'arm9Overlays',
+    'arm7Overlays', 'compressedOverlays', 'fatOverlaps', 'fatDuplicates',
+    'fatGaps', 'fatOutOfBounds', 'bannerVersion', 'bannerTitle',
+    'bannerChecksumValid', 'error',
+]
+
+
+def findRoms(paths, probe=False):
+    """
+    Yield the paths of all ROMs in the given files and directory trees.
+    Directories are walked without following symlinks; files in them
+    are picked by extension, or by their header if probe is True.
+    """
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for fn in sorted(filenames):
+                full = os.path.join(dirpath, fn)
+                if fn.lower().endswith(ROM_EXTENSIONS):
+                    yield full
+                elif probe:
+                    try:
+                        with open(full, 'rb') as f:
+                            if probeHeader(f.read(HEADER_LEN)) is not None:
+                                yield full
+                    except OSError:
+                        pass
+
+
+def _codeIsCompressed(code, ramAddress, paramsAddress):
+    params = ModuleParams.fromCode(code, ramAddress, paramsAddress)
+    return params is not None and params.compressedStaticEnd != 0
+
+
+def summarizeRom(path):
+    """
+    Parse a ROM (header, FNT, FAT and overlay tables) and return a
+    flat dict summarizing it, with the keys in SUMMARY_FIELDS. The ROM
+    is memory-mapped, so only the parts that are looked at are read.
+    """
+    summary = dict.fromkeys(SUMMARY_FIELDS)
+    summary['path'] = path
+    summary['size'] = os.path.getsize(path)
+
+    rom = NintendoDSRom.fromFile(path, lazy=True)
+    try:
+        header = rom._loadedHeader
+        summary['title'] = str(bytes(rom.name), 'latin-1').rstrip(' ')
+        summary['gameCode'] = str(bytes(rom.idCode), 'latin-1')
+        summary['makerCode'] = str(bytes(rom.developerCode), 'latin-1')
+        summary['unitCode'] = rom.unitCode
+        summary['version'] = rom.version
+        summary['deviceCapacity'] = rom.deviceCapacity
+        summary['logoValid'] = header.logoIsValid()
+        summary['headerChecksumValid'] = header.checksumIsValid()
+        summary['secureAreaChecksumValid'] = rom.verifyChecksums()['secureArea']
+
+        for cpu in ('arm9', 'arm7'):
+            for field in ('Offset', 'RamAddress', 'EntryAddress', 'Len'):
+                summary[cpu + field] = getattr(rom, cpu + field)
+            summary[cpu + 'Compressed'] = _codeIsCompressed(
+                getattr(rom, cpu), getattr(rom, cpu + 'RamAddress'),
+                getattr(rom, cpu + 'CodeSettingsPointerAddress'))
+
+        # Walk the whole filename table, so broken ones are noticed
+        numFiles = numFolders = 0
+        stack = [rom.filenames]
+        while stack:
+            folder = stack.pop()
+            numFiles += len(folder.files)
+            numFolders += 1
+            stack.extend(sub for _, sub in folder.folders)
+        summary['files'] = numFiles
+        summary['folders'] = numFolders
+
+        ov9 = rom.loadArm9Overlays()
+        ov7 = rom.loadArm7Overlays()
+        summary['arm9Overlays'] = len(ov9)
+        summary['arm7Overlays'] = len(ov7)
+        summary['compressedOverlays'] = sum(ov.compressed for ovs in (ov9, ov7)
+                                            for ov in ovs.values())
+
+        report = rom.validateFat(summary['size'])
+        summary['fatOverlaps'] = len(report.overlaps)
+        summary['fatDuplicates'] = len(report.duplicates)
+        summary['fatGaps'] = len(report.gaps)
+        summary['fatOutOfBounds'] = len(report.outOfBounds)
+
+        banner = rom.loadBanner()
+        if banner is not None:
+            summary['bannerVersion'] = banner.version
+            summary['bannerTitle'] = banner.titles.get('english')
+            summary['bannerChecksumValid'] = banner.checksumsAreValid()
+    finally:
+        rom.close()
+    return summary
+
+
+def readBanner(path):
+    """
+    Read just the icon/banner of a ROM file (which is all that
+    exporting icons needs), without parsing the rest of the ROM.
+    Returns a Banner, or None if the ROM doesn't have one.
+    """
+    with open(path, 'rb') as f:
+        header = NintendoDSHeader(f.read(HEADER_LEN))
+        if not header.iconBannerOffset:
+            return None
+        f.seek(header.iconBannerOffset)
+        data = f.read(max(BANNER_LENGTHS.values()))
+    if len(data) < 0x240:
+        return None
+    version, = struct.unpack_from('<H', data, 0)
+    return Banner(data[:BANNER_LENGTHS.get(version, ICON_BANNER_LEN)])
+
+
+def exportIcons(paths, outPath, columns=16):
+    """
+    Decode the icons of many ROMs in one batch, and save them as a PNG
+    sprite sheet (see iconSheet()), or as a stacked (N, 32, 32, 4)
+    NumPy array if outPath ends with ".npy". ROMs without a readable
+    banner are left out. Returns (number of icons, decoding time in
+    seconds).
+    """
+    import time
+
+    banners = []
+    for path in paths:
+        try:
+            banner = readBanner(path)
+        except (OSError, ValueError):
+            banner = None
+        if banner is not None:
+            banners.append(banner)
+
+    start = time.perf_counter()
+    icons = decodeIcons(banners)
+    elapsed = time.perf_counter() - start
+
+    if outPath.lower().endswith('.npy'):
+        numpy.save(outPath, icons)
+    else:
+        with open(outPath, 'wb') as f:
+            f.write(encodePng(iconSheet(icons, columns)))
+    return len(icons), elapsed
+
+
+def _summarizeOne(path):
+    """
+    summarizeRom(), but with errors reported in the summary instead of
+    being raised, so one bad ROM can't stop a run.
+    """
+    try:
+        return summarizeRom(path)
+    except Exception as e:
+        summary = dict.fromkeys(SUMMARY_FIELDS)
+        summary['path'] = path
+        summary['error'] = type(e).__name__ + ': ' + str(e)
+        return summary
+
+
+def _summarizeBatch(paths):
+    return [_summarizeOne(path) for path in paths]
+
+
+def _batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def summarizeRoms(paths, jobs=None, batchSize=16):
+    """
+    Summarize many ROMs in parallel, yielding their summaries in the
+    same order as paths. jobs is the number of worker processes (by
+    default, one per CPU); with jobs=1, everything runs in-process.
+    ROMs are sent to workers batchSize at a time, since most of them
+    take less time to summarize than a round trip to a worker.
+    """
+    if jobs == 1:
+        for path in paths:
+            yield _summarizeOne(path)
+        return
+
+    import concurrent.futures
+    kwargs = {}
+    if sys.version_info >= (3, 11):
+        kwargs['max_tasks_per_child'] = WORKER_MAX_TASKS
+    with concurrent.futures.ProcessPoolExecutor(jobs, **kwargs) as executor:
+        # Keep a bounded number of batches in flight, instead of
+        # submitting an entire corpus up front
+        window = 2 * (jobs or os.cpu_count() or 1)
+        pending = collections.deque()
+        for batch in _batches(paths, batchSize):
+            pending.append(executor.submit(_summarizeBatch, batch))
+            if len(pending) >= window:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def main(argv=None):
+    """
+    Command-line entry point: summarize every ROM in a set of files
+    and directory trees as JSON lines or CSV, and optionally export
+    all their icons.
+    """
+    import argparse
+    import csv
+    import json
+    import time
+
+    parser = argparse.ArgumentParser(prog='python -m nds',
+        description='Summarize Nintendo DS ROMs without IDA.')
+    parser.add_argument('paths', nargs='+', help='ROM files or directories to scan')
+    parser.add_argument('-f', '--format', choices=('json', 'csv'), default='json',
+        help='output format (default: one JSON object per line)')
+    parser.add_argument('-o', '--output', help='output file (default: stdout)')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+        help='number of worker processes (default: one per CPU)')
+    parser.add_argument('--probe', action='store_true',
+        help='also check the headers of files without a ROM extension')
+    parser.add_argument('--icons', metavar='PATH',
+        help='also save all icons as a PNG sprite sheet (or, for a .npy path, a'
+             ' stacked NumPy array)')
+    args = parser.parse_args(argv)
+
+    out = open(args.output, 'w', newline='') if args.output else sys.stdout
+    try:
+        if args.format == 'csv':
+            writer = csv.DictWriter(out, SUMMARY_FIELDS)
+            writer.writeheader()
+            write = writer.writerow
+        else:
+            write = lambda summary: out.write(json.dumps(summary) + '\n')
+
+        count = errors = 0
+        paths = []
+        start = time.perf_counter()
+        for summary in summarizeRoms(findRoms(args.paths, args.probe), args.jobs):
+            write(summary)
+            count += 1
+            errors += summary['error'] is not None
+            if summary['error'] is None:
+                paths.append(summary['path'])
+        elapsed = time.perf_counter() - start
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    rate = count / elapsed if elapsed else 0
+    print(str(count) + ' ROMs (' + str(errors) + ' failed) in ' + format(elapsed, '.2f')
+          + 's: ' + format(rate, '.1f') + ' ROMs/s', file=sys.stderr)
+
+    if args.icons:
+        numIcons, elapsed = exportIcons(paths, args.icons)
+        rate = numIcons / elapsed if elapsed else 0
+        print(str(numIcons) + ' icons decoded in ' + format(elapsed, '.3f') + 's: '
+              + format(rate, '.0f') + ' banners/s', file=sys.stderr)
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,10 @@
+import pytest
+
+from tests.synthetic import makeRom
+
+
+@pytest.fixture
+def romPath(tmp_path):
+    path = tmp_path / 'test.nds'
+    makeRom().saveToFile(str(path))
+    return str(path)
@@ -0,0 +1,145 @@
+"""
+Slow but obviously correct reference implementations, for checking
+the optimized code in nds.py against: a bit-at-a-time CRC16 and
+greedy LZ10, LZ11 and BLZ compressors.
+"""
+import random
+import struct
+
+
+def crc16Bitwise(data, crc=0xFFFF):
+    """
+    CRC16 (polynomial 0xA001, reflected), one bit at a time.
+    """
+    for b in data:
+        crc ^= b
+        for _ in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0xA001
+            else:
+                crc >>= 1
+    return crc
+
+
+def _lzTokens(data, minDisp, maxDisp, maxLen):
+    """
+    Split data into literal bytes (ints) and (length, disp)
+    back-references of at least 3 bytes, greedily, checking the last
+    few earlier positions with the same 3-byte prefix. Matches may
+    overlap the bytes they produce.
+    """
+    tokens = []
+    positions = {}
+    i = 0
+    while i < len(data):
+        bestLen = bestDisp = 0
+        key = data[i : i+3]
+        for j in reversed(positions.get(key, ())[-8:]):
+            disp = i - j
+            if disp < minDisp:
+                continue
+            if disp > maxDisp:
+                break
+            length = 0
+            while (length < maxLen and i + length < len(data)
+                   and data[j + length] == data[i + length]):
+                length += 1
+            if length > bestLen:
+                bestLen, bestDisp = length, disp
+
+        step = bestLen if bestLen >= 3 else 1
+        for k in range(i, min(i + step, len(data) - 2)):
+            positions.setdefault(data[k : k+3], []).append(k)
+        if bestLen >= 3:
+            tokens.append((bestLen, bestDisp))
+        else:
+            tokens.append(data[i])
+        i += step
+    return tokens
+
+
+def _packTokens(tokens, encodeRef):
+    """
+    Pack tokens in groups of eight behind a flags byte, most
+    significant bit first, with 1 meaning a back-reference.
+    """
+    out = bytearray()
+    for k in range(0, len(tokens), 8):
+        flags = 0
+        body = bytearray()
+        for bit, token in enumerate(tokens[k : k+8]):
+            if isinstance(token, tuple):
+                flags |= 0x80 >> bit
+                body += encodeRef(*token)
+            else:
+                body.append(token)
+        out.append(flags)
+        out += body
+    return out
+
+
+def compressLz10(data):
+    """
+    Compress data to LZ10.
+    """
+    def encodeRef(length, disp):
+        return bytes([(length - 3) << 4 | (disp - 1) >> 8, (disp - 1) & 0xFF])
+
+    tokens = _lzTokens(bytes(data), 1, 0x1000, 0x12)
+    return bytes(struct.pack('<I', 0x10 | len(data) << 8) + _packTokens(tokens, encodeRef))
+
+
+def compressLz11(data):
+    """
+    Compress data to LZ11, using all three back-reference sizes.
+    """
+    def encodeRef(length, disp):
+        disp -= 1
+        if length <= 0x10:
+            return bytes([(length - 1) << 4 | disp >> 8, disp & 0xFF])
+        if length <= 0x110:
+            length -= 0x11
+            return bytes([length >> 4, (length & 0xF) << 4 | disp >> 8, disp & 0xFF])
+        length -= 0x111
+        return bytes([0x10 | length >> 12, (length >> 4) & 0xFF,
+                      (length & 0xF) << 4 | disp >> 8, disp & 0xFF])
+
+    tokens = _lzTokens(bytes(data), 1, 0x1000, 0x10110)
+    return bytes(struct.pack('<I', 0x11 | len(data) << 8) + _packTokens(tokens, encodeRef))
+
+
+def compressBlz(data, uncompressedLen=0):
+    """
+    Compress data to bottom-up LZ, leaving the first uncompressedLen
+    bytes stored as they are.
+    """
+    def encodeRef(length, disp):
+        info = (length - 3) << 12 | (disp - 3)
+        return bytes([info >> 8, info & 0xFF])
+
+    data = bytes(data)
+    head, tail = data[:uncompressedLen], data[uncompressedLen:]
+    # Compressed back to front, so compress the reversed data and
+    # reverse the result
+    tokens = _lzTokens(tail[::-1], 3, 0x1002, 0x12)
+    body = bytes(_packTokens(tokens, encodeRef)[::-1])
+    padding = -len(body) % 4
+    headerLen = 8 + padding
+    encLen = len(body) + headerLen
+    footer = struct.pack('<II', encLen | headerLen << 24, len(tail) - encLen)
+    return head + body + b'\xFF' * padding + footer
+
+
+def sampleData(size, seed=0):
+    """
+    Make size bytes of compressible, code-like data: a shuffle of a
+    few hundred short random "words", with some runs of zeroes.
+    """
+    rng = random.Random(seed)
+    words = [bytes(rng.getrandbits(8) for _ in range(rng.randint(2, 12)))
+             for _ in range(300)]
+    words += [b'\0' * 64, b'\0' * 0x300]
+    out = bytearray()
+    while len(out) < size:
+        out += rng.choice(words)
+    return bytes(out[:size])
@@ -0,0 +1,86 @@
+"""
+Synthetic ROMs and filename tables for the tests and benchmarks.
+"""
+import random
+import struct
+
+import nds
+
+
+def makeFilenames(fileCount, perFolder=7):
+    """
+    Build a filename table for files 0..fileCount-1, spread over
+    nested folders of at most perFolder files each.
+    """
+    root = nds.Folder(firstID=0)
+    folder = root
+    fid = 0
+    depth = 0
+    while fid < fileCount:
+        count = min(perFolder, fileCount - fid)
+        folder.files = ['file{:04d}.bin'.format(fid + i) for i in range(count)]
+        fid += count
+        if fid < fileCount:
+            child = nds.Folder(firstID=fid)
+            depth += 1
+            folder.folders = [('dir{}'.format(depth), child)]
+            folder = child
+    return root
+
+
+def makeRom(fileCount=40, seed=0, arm9=None):
+    """
+    Make a small ROM with ARM9 and ARM7 code and fileCount files of
+    random sizes in a nested folder tree. The ARM9 code is random
+    unless given.
+    """
+    rng = random.Random(seed)
+    rom = nds.NintendoDSRom()
+    rom.name = b'TESTROM'
+    rom.idCode = b'TEST'
+    # Big enough to fill the secure area, as it does in real ROMs
+    if arm9 is None:
+        arm9 = bytes(rng.getrandbits(8) for _ in range(0x4000))
+    rom.arm9 = arm9
+    rom.arm7 = bytes(rng.getrandbits(8) for _ in range(0x800))
+    rom.arm9EntryAddress = rom.arm9RamAddress
+    rom.arm7EntryAddress = rom.arm7RamAddress
+    rom.filenames = makeFilenames(fileCount)
+    rom.files = [bytes(rng.getrandbits(8) for _ in range(rng.randint(0, 0x300)))
+                 for _ in range(fileCount)]
+    return rom
+
+
+def makeTwlRom(fileCount=40, seed=0):
+    """
+    Make the bytes of a DSi-enhanced version of makeRom(): after the
+    DS part, aligned to 0x10000, come an ARM9i and an ARM7i binary
+    (which together are the TWL digest region) and a sector hash
+    table, all pointed to by the DSi part of the header. Returns
+    (data, {name: (offset, bytes)}) for the DSi regions.
+    """
+    rng = random.Random(seed + 1)
+    data = bytearray(makeRom(fileCount, seed).save())
+    data[0x12] = 2
+
+    pos = (len(data) + 0xFFFF) & ~0xFFFF
+    regions = {}
+    for name, size in (('arm9i', 0x1800), ('arm7i', 0x800), ('sectorHashTable', 0x140)):
+        regions[name] = (pos, bytes(rng.getrandbits(8) for _ in range(size)))
+        pos += (size + 0x3FF) & ~0x3FF
+    hashOffset, hashes = regions['sectorHashTable']
+    data.extend(b'\xFF' * (hashOffset + len(hashes) - len(data)))
+    for offset, region in regions.values():
+        data[offset : offset+len(region)] = region
+
+    arm9iOffset, arm9i = regions['arm9i']
+    arm7iOffset, arm7i = regions['arm7i']
+    struct.pack_into('<3I', data, 0x1C0, arm9iOffset, 0, 0x02400000)
+    struct.pack_into('<I', data, 0x1CC, len(arm9i))
+    struct.pack_into('<3I', data, 0x1D0, arm7iOffset, 0, 0x02E80000)
+    struct.pack_into('<I', data, 0x1DC, len(arm7i))
+    struct.pack_into('<6I', data, 0x1E0, 0x4000, arm9iOffset - 0x4000,
+                     arm9iOffset, arm7iOffset + len(arm7i) - arm9iOffset,
+                     hashOffset, len(hashes))
+    struct.pack_into('<H', data, 0x15E, nds.crc16(data[:0x15E]))
+    return bytes(data), regions
@@ -0,0 +1,80 @@
+import os
+
+import pytest
+
+import nds
+from tests.reference import (compressBlz, compressLz10, compressLz11,
+                             crc16Bitwise, sampleData)
+
+
+@pytest.mark.parametrize('size', [0, 1, 2, 0xFF, 0x400, 0x4000, 0x10001])
+def test_crc16MatchesBitwise(size):
+    data = os.urandom(size)
+    assert nds.crc16(data) == crc16Bitwise(data)
+    assert nds.crc16(memoryview(data)) == crc16Bitwise(data)
+
+
+def test_crc16OddStartAndChaining():
+    data = os.urandom(0x1001)
+    assert nds.crc16(memoryview(data)[1:]) == crc16Bitwise(data[1:])
+    first = nds.crc16(data[:0x801])
+    assert nds.crc16(data[0x801:], first) == crc16Bitwise(data)
+
+
+def test_crc16KnownValues():
+    assert nds.crc16(b'123456789') == 0x4B37
+    assert nds.crc16(nds.NintendoDSRom().nintendoLogo) == nds.NINTENDO_LOGO_CHECKSUM
+
+
+CODEC_INPUTS = {
+    'text': sampleData(0x8000, seed=1),
+    'runs': b'\0' * 0x300 + b'ab' * 0x2000 + b'\xFF' * 0x11000 + b'xyz',
+    'random': os.urandom(0x400),
+    'tiny': b'abcabcabc',
+}
+
+
+@pytest.mark.parametrize('name', sorted(CODEC_INPUTS))
+def test_lz10(name):
+    data = CODEC_INPUTS[name]
+    compressed = compressLz10(data)
+    assert nds.decompressLz10(compressed) == data
+    assert nds.decompressLz(compressed) == data
+    assert nds.decompressLz10(compressed, limit=100) == data[:100]
+
+
+@pytest.mark.parametrize('name', sorted(CODEC_INPUTS))
+def test_lz11(name):
+    data = CODEC_INPUTS[name]
+    compressed = compressLz11(data)
+    assert nds.decompressLz11(compressed) == data
+    assert nds.decompressLz(compressed) == data
+    assert nds.decompressLz11(compressed, limit=100) == data[:100]
+
+
+def test_lz11UsesEveryReferenceSize():
+    # 0x11-0x110 and 0x111+ byte references have their own encodings
+    data = b'q' + b'\x55' * 0x20 + b'r' + b'\x66' * 0x200 + b's' + b'\x77' * 0x3000
+    compressed = compressLz11(data)
+    assert len(compressed) < 40
+    assert nds.decompressLz11(compressed) == data
+
+
+def test_lzWrongType():
+    with pytest.raises(TypeError):
+        nds.decompressLz10(compressLz11(b'abc'))
+
+
+@pytest.mark.parametrize('name', ['text', 'runs'])
+@pytest.mark.parametrize('uncompressedLen', [0, 0x100])
+def test_blz(name, uncompressedLen):
+    data = CODEC_INPUTS[name]
+    compressed = compressBlz(data, uncompressedLen)
+    assert len(compressed) < len(data)
+    assert nds.decompressBlz(compressed) == data
+    assert nds.decompressBlz(memoryview(compressed)) == data
+
+
+def test_blzUncompressed():
+    data = os.urandom(0x40) + b'\0' * 8
+    assert nds.decompressBlz(data) == data
@@ -0,0 +1,67 @@
+import pytest
+
+import nds
+from tests.synthetic import makeFilenames
+
+
+def wideTree(folderCount=50, filesPerFolder=20):
+    """
+    A root folder with folderCount subfolders, some with their own
+    subfolders, filesPerFolder files each.
+    """
+    fid = 0
+    root = nds.Folder(files=['root{}.dat'.format(i) for i in range(filesPerFolder)])
+    fid += filesPerFolder
+    for i in range(folderCount):
+        folder = nds.Folder(firstID=fid,
+                            files=['f{}_{}'.format(i, j) for j in range(filesPerFolder)])
+        fid += filesPerFolder
+        if i % 5 == 0:
+            sub = nds.Folder(firstID=fid, files=['x.bin', 'y.bin'])
+            fid += 2
+            folder.folders = [('sub', sub)]
+        root.folders.append(('folder{:02d}'.format(i), folder))
+    return root
+
+
+@pytest.mark.parametrize('root', [
+    nds.Folder(),
+    makeFilenames(100),
+    wideTree(),
+], ids=['empty', 'nested', 'wide'])
+def test_roundTrip(root):
+    data = nds.save(root)
+    loaded = nds.load(data)
+    assert loaded.walk() == root.walk()
+    assert bytes(nds.save(loaded)) == bytes(data)
+
+
+def test_lookupsAfterLoad():
+    loaded = nds.load(nds.save(wideTree()))
+    assert loaded.idOf('folder10/sub/y.bin') == loaded.subfolder('folder10/sub').firstID + 1
+    assert loaded.filenameOf(loaded.idOf('folder03/f3_7')) == 'folder03/f3_7'
+    assert loaded.idOf('folder03/missing') is None
+
+
+def test_deepTree():
+    # Deeper than the recursion limit, which load() and save() must
+    # not depend on
+    root = makeFilenames(4000, perFolder=1)
+    data = nds.save(root)
+    loaded = nds.load(data)
+    assert loaded.walk() == root.walk()
+    assert bytes(nds.save(loaded)) == bytes(data)
+
+
+def test_renameAfterLoad():
+    loaded = nds.load(nds.save(wideTree()))
+    loaded.folders[0][1].files[0] = 'renamed'
+    assert nds.load(nds.save(loaded)).idOf('folder00/renamed') == loaded.folders[0][1].firstID
+
+
+def test_invalidSubfolderID():
+    data = bytearray(nds.save(makeFilenames(20)))
+    # Point the root's subfolder entry back at the root
+    data[data.index(b'\x84dir1') + 5 : data.index(b'\x84dir1') + 7] = b'\0\xF0'
+    with pytest.raises(ValueError):
+        nds.load(data)
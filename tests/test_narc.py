@@ -0,0 +1,61 @@
+import struct
+
+import pytest
+
+import nds
+from tests.synthetic import makeRom
+
+
+def makeNarc(files, filenames=None):
+    """
+    Build a NARC archive of the given files, with a filename table if
+    filenames (a Folder) is given.
+    """
+    gmif = bytearray()
+    fat = bytearray()
+    for data in files:
+        fat += struct.pack('<II', len(gmif), len(gmif) + len(data))
+        gmif += data
+        gmif += b'\xFF' * (-len(gmif) % 4)
+    if filenames is not None:
+        fnt = bytes(nds.save(filenames))
+    else:
+        fnt = struct.pack('<IHH', 4, 0, 1)
+    fnt += b'\xFF' * (-len(fnt) % 4)
+
+    body = (b'BTAF' + struct.pack('<IHH', 12 + len(fat), len(files), 0) + fat
+            + b'BTNF' + struct.pack('<I', 8 + len(fnt)) + fnt
+            + b'GMIF' + struct.pack('<I', 8 + len(gmif)) + gmif)
+    return b'NARC' + struct.pack('<HHIHH', 0xFFFE, 0x100, 16 + len(body), 16, 3) + body
+
+
+@pytest.fixture
+def narcRomPath(tmp_path):
+    inner = makeNarc([b'inner0', b'inner1'])
+    outer = makeNarc([b'zero', inner, b'two'],
+                     nds.Folder(files=['zero.bin', 'inner.narc', 'two.bin']))
+    rom = makeRom(fileCount=4)
+    rom.files[2] = outer
+    path = str(tmp_path / 'narc.nds')
+    rom.saveToFile(path)
+    return path
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_resolvePath(narcRomPath, lazy):
+    rom = nds.NintendoDSRom.fromFile(narcRomPath, lazy=lazy)
+    assert rom.resolvePath('file0002.bin/two.bin') == b'two'
+    assert rom.resolvePath('file0002.bin/inner.narc/1') == b'inner1'
+    assert rom.resolvePath('2/1/0') == b'inner0'
+    with pytest.raises(ValueError):
+        rom.resolvePath('file0002.bin/missing.bin')
+    rom.close()
+
+
+def test_eagerFileCanBeResized(narcRomPath):
+    rom = nds.NintendoDSRom.fromFile(narcRomPath)
+    narc = nds.NARC(rom.files[2])
+    assert narc.files[0] == b'zero'
+    # The archive must not keep a view of the ROM's bytearray alive
+    rom.files[2].extend(b'\0' * 0x10)
+    assert narc.files[0] == b'zero'
@@ -0,0 +1,237 @@
+import hashlib
+import json
+import os
+import struct
+
+import pytest
+
+import nds
+from tests.synthetic import makeRom, makeTwlRom
+
+
+def assertSameFiles(rom, other):
+    assert len(rom.files) == len(other.files)
+    for a, b in zip(rom.files, other.files):
+        assert bytes(a) == bytes(b)
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_saveLoadRoundTrip(romPath, lazy):
+    original = makeRom()
+    rom = nds.NintendoDSRom.fromFile(romPath, lazy=lazy)
+    try:
+        assert rom.lazy == lazy
+        assert bytes(rom.arm9) == original.arm9
+        assert bytes(rom.arm7) == original.arm7
+        assertSameFiles(rom, original)
+        assert rom.filenames.walk() == original.filenames.walk()
+        assert all(rom.verifyChecksums().values())
+        assert rom.validateFat().isValid()
+
+        # Saving an unchanged ROM reproduces the file exactly
+        with open(romPath, 'rb') as f:
+            assert bytes(rom.save()) == f.read()
+    finally:
+        rom.close()
+
+
+def test_saveToFileLazyMatchesSave(romPath, tmp_path):
+    rom = nds.NintendoDSRom.fromFile(romPath, lazy=True)
+    rom.files[3] = b'replaced'
+    out = str(tmp_path / 'out.nds')
+    rom.saveToFile(out)
+    with open(out, 'rb') as f:
+        assert f.read() == bytes(rom.save())
+    rom.close()
+
+    saved = nds.NintendoDSRom.fromFile(out)
+    assert saved.files[3] == b'replaced'
+    assert all(saved.verifyChecksums().values())
+
+
+def test_newRomIsNotLazy():
+    assert nds.NintendoDSRom().lazy is False
+
+
+def test_lazyFilesAreViews(romPath):
+    rom = nds.NintendoDSRom.fromFile(romPath, lazy=True)
+    assert isinstance(rom.files, nds.LazyFileList)
+    assert isinstance(rom.files[0], memoryview)
+    assert rom.files.isOriginal(0)
+    rom.files[0] = b'new'
+    assert not rom.files.isOriginal(0)
+    assert rom.files[0] == b'new'
+    rom.files.append(b'appended')
+    assert len(rom.files) == 41 and rom.files[40] == b'appended'
+    with pytest.raises(IndexError):
+        rom.files[41]
+    rom.close()
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_saveIncremental(romPath, lazy):
+    size = os.path.getsize(romPath)
+    rom = nds.NintendoDSRom.fromFile(romPath, lazy=lazy)
+    smaller = b'small'
+    larger = os.urandom(0x2000)
+    rom.files[5] = smaller
+    rom.files[20] = larger
+    assert rom.saveIncremental() == [5, 20]
+    rom.close()
+
+    saved = nds.NintendoDSRom.fromFile(romPath)
+    assert saved.files[5] == smaller
+    assert saved.files[20] == larger
+    expected = makeRom()
+    for fid in range(len(expected.files)):
+        if fid not in (5, 20):
+            assert saved.files[fid] == expected.files[fid]
+    assert all(saved.verifyChecksums().values())
+    assert saved.validateFat(os.path.getsize(romPath)).isValid()
+    # The larger file didn't fit where it was or in any gap
+    assert os.path.getsize(romPath) > size
+
+    # Nothing changed since, so nothing is written
+    assert saved.saveIncremental() == []
+
+
+def test_saveIncrementalRejectsOtherChanges(romPath):
+    rom = nds.NintendoDSRom.fromFile(romPath)
+    rom.arm9 = b'\0' * 0x4000
+    with pytest.raises(ValueError):
+        rom.saveIncremental()
+
+
+def test_saveIncrementalKeepsOutOfDsiRegions(tmp_path):
+    # Leave a 0x1000-byte hole between files 9 and 11 by emptying
+    # file 10, and put an ARM9i binary in the middle of it
+    path = str(tmp_path / 'twl.nds')
+    rom = makeRom()
+    rom.files[10] = bytes(0x1000)
+    rom.saveToFile(path)
+    with open(path, 'rb') as f:
+        data = bytearray(f.read())
+    fatOffset, = struct.unpack_from('<I', data, 0x48)
+    start10, = struct.unpack_from('<I', data, fatOffset + 8 * 10)
+    struct.pack_into('<II', data, fatOffset + 8 * 10, start10, start10)
+    arm9i = os.urandom(0x400)
+    arm9iOffset = start10 + 0x400
+    data[arm9iOffset : arm9iOffset+len(arm9i)] = arm9i
+    data[0x12] = 2
+    struct.pack_into('<I', data, 0x1C0, arm9iOffset)
+    struct.pack_into('<I', data, 0x1CC, len(arm9i))
+    with open(path, 'wb') as f:
+        f.write(data)
+
+    # Too big for its own slot or for either side of the ARM9i
+    rom = nds.NintendoDSRom.fromFile(path)
+    assert bytes(rom.arm9i) == arm9i
+    rom.files[20] = os.urandom(0x900)
+    assert rom.saveIncremental() == [20]
+
+    saved = nds.NintendoDSRom.fromFile(path)
+    assert bytes(saved.files[20]) == bytes(rom.files[20])
+    assert bytes(saved.arm9i) == arm9i
+
+
+@pytest.fixture
+def twlRomPath(tmp_path):
+    data, regions = makeTwlRom()
+    path = str(tmp_path / 'twl.nds')
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path, regions
+
+
+def test_eagerTwlRomCopiesOnlyItsDsiRegions(twlRomPath):
+    path, regions = twlRomPath
+    rom = nds.NintendoDSRom.fromFile(path)
+    assert bytes(rom.arm9i) == regions['arm9i'][1]
+    assert bytes(rom.arm7i) == regions['arm7i'][1]
+    assert rom.arm9i.readonly and rom.arm7i.readonly
+    # Each region is its own copy, not a view into the whole image
+    size = os.path.getsize(path)
+    for _, region in rom._twlRegions:
+        assert len(region.obj) == len(region) < size
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_saveTwlRom(twlRomPath, tmp_path, lazy):
+    path, regions = twlRomPath
+    rom = nds.NintendoDSRom.fromFile(path, lazy=lazy)
+    with open(path, 'rb') as f:
+        assert bytes(rom.save()) == f.read()
+
+    # Files can change; the DSi regions stay where the header says
+    rom.files[3] = b'replaced'
+    out = str(tmp_path / 'out.nds')
+    rom.saveToFile(out)
+    rom.close()
+    saved = nds.NintendoDSRom.fromFile(out)
+    assert saved.files[3] == b'replaced'
+    assert bytes(saved.arm9i) == regions['arm9i'][1]
+    assert bytes(saved.arm7i) == regions['arm7i'][1]
+    with open(out, 'rb') as f:
+        data = f.read()
+    for offset, region in regions.values():
+        assert data[offset : offset+len(region)] == region
+
+
+def test_saveTwlRomThatOutgrowsItsDsPart(twlRomPath):
+    path, _ = twlRomPath
+    rom = nds.NintendoDSRom.fromFile(path)
+    rom.files[3] = bytes(0x20000)
+    with pytest.raises(ValueError):
+        rom.save()
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_extractImportRoundTrip(romPath, tmp_path, lazy):
+    out = str(tmp_path / 'files')
+    rom = nds.NintendoDSRom.fromFile(romPath, lazy=lazy)
+    assert rom.extractTo(out) == len(rom.files)
+    # The files were hashed as they were written, and those hashes
+    # are cached for next time
+    assert os.path.exists(romPath + nds.FILE_HASH_CACHE_SUFFIX)
+    with open(os.path.join(out, nds.EXTRACT_MANIFEST_NAME)) as f:
+        manifest = json.load(f)
+    for path, fid in rom.filenames.walk()[1]:
+        with open(os.path.join(out, *path.split('/')), 'rb') as f:
+            assert f.read() == bytes(rom.files[fid])
+        assert manifest[path][2] == hashlib.sha1(rom.files[fid]).hexdigest()
+
+    # Only the file that was edited is imported
+    path, fid = rom.filenames.walk()[1][7]
+    with open(os.path.join(out, *path.split('/')), 'wb') as f:
+        f.write(b'edited')
+    assert rom.importFrom(out) == [fid]
+    assert rom.files[fid] == b'edited'
+    assert rom.importFrom(out) == []
+    rom.close()
+
+
+def test_fatIndex():
+    starts = [0x200, 0x400, 0x400, 0x1000, 0x900, 0x5000]
+    ends = [0x300, 0x500, 0x500, 0x1000, 0xA00, 0x5100]
+    index = nds.FatIndex(starts, ends)
+    assert index.ownerOf(0x200) == 0
+    assert index.ownerOf(0x2FF) == 0
+    assert index.ownerOf(0x300) is None
+    assert index.ownerOf(0x450) in (1, 2)
+    assert index.ownerOf(0x1000) is None
+    assert index.ownerOf(0x950) == 4
+    assert index.ownerOf(0) is None
+
+    report = index.validate(romSize=0x5000)
+    assert report.duplicates == [(1, 2)]
+    assert report.overlaps == []
+    assert report.outOfBounds == [5]
+    assert report.gaps == [(0x500, 0x900)]
+    assert not report.isValid()
+
+
+def test_fatIndexOverlap():
+    index = nds.FatIndex([0x200, 0x200, 0x300], [0x800, 0x280, 0x400])
+    assert index.ownerOf(0x350) == 2
+    assert index.ownerOf(0x500) == 0
+    assert index.validate().overlaps == [(0, 1), (0, 2)]
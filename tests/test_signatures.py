@@ -0,0 +1,112 @@
+import struct
+
+import pytest
+
+import nds
+from tests.reference import compressBlz, sampleData
+from tests.synthetic import makeRom
+
+
+def withSignature(data, offset, pattern):
+    data = bytearray(data)
+    data[offset : offset+len(pattern)] = pattern
+    return bytes(data)
+
+
+@pytest.fixture
+def overlayRom():
+    """
+    A ROM with two ARM9 overlays, each with an SDK function in it:
+    overlay 0 uncompressed, overlay 1 BLZ-compressed.
+    """
+    rom = makeRom(fileCount=4)
+    ov0 = withSignature(sampleData(0x400, seed=2), 0x10, bytes.fromhex('06DF7047'))
+    ov1 = withSignature(sampleData(0x800, seed=3), 0x20, bytes.fromhex('09DF7047'))
+    rom.files[2] = ov0
+    rom.files[3] = compressBlz(ov1)
+    rom.arm9OverlayTable = (
+        struct.pack('<8I', 0, 0x02100000, len(ov0), 0, 0, 0, 2, 0)
+        + struct.pack('<8I', 1, 0x02100000, len(ov1), 0, 0, 0, 3,
+                      len(rom.files[3]) | 1 << 24))
+    return nds.NintendoDSRom(rom.save())
+
+
+def test_findFunctionNamesInOverlays(overlayRom):
+    names = overlayRom.findFunctionNames('ARM9', main=False)
+    assert sorted(names) == [
+        (0, 0x02100010, 'SVC_Halt', True),
+        (1, 0x02100020, 'SVC_Div', True),
+    ]
+
+
+def test_findFunctionNamesOnlyLoadsRequestedOverlays(overlayRom, monkeypatch):
+    decompressed = []
+    decompressBlz = nds.decompressBlz
+    monkeypatch.setattr(nds, 'decompressBlz',
+                        lambda data: decompressed.append(data) or decompressBlz(data))
+
+    assert overlayRom.findFunctionNames('ARM9', main=False, idsToLoad={0}) == [
+        (0, 0x02100010, 'SVC_Halt', True)]
+    assert decompressed == []
+
+    assert overlayRom.findFunctionNames('ARM9', main=False, idsToLoad={1}) == [
+        (1, 0x02100020, 'SVC_Div', True)]
+    assert len(decompressed) == 1
+    assert overlayRom.findFunctionNames('ARM9', main=False, idsToLoad=set()) == []
+
+
+def test_overlayNamesAtMappedAddresses(overlayRom):
+    # Overlay 1 mapped in the overlay bank, overlay 0 not mapped
+    delta = nds.OVERLAY_BANK_BASE - 0x02100000
+    assert nds.OverlayNames(overlayRom, 'ARM9', {1: delta}) == [
+        (nds.OVERLAY_BANK_BASE + 0x20, 'SVC_Div', True)]
+    assert nds.OverlayNames(overlayRom, 'ARM9', {}) == []
+
+
+def test_overlayNamesAreCachedWithThePlan(overlayRom, tmp_path, monkeypatch):
+    cacheDir = str(tmp_path / 'plans')
+    expected = sorted(overlayRom.findFunctionNames('ARM9', main=False))
+    assert sorted(overlayRom.overlayFunctionNames('ARM9', cacheDir=cacheDir)) == expected
+
+    # A fresh ROM object reads them back from the plan's cache file,
+    # without decompressing or matching anything
+    def fail(*args):
+        raise AssertionError('overlay was matched again')
+    rom = nds.NintendoDSRom(overlayRom.save())
+    monkeypatch.setattr(nds, 'decompressBlz', fail)
+    monkeypatch.setattr(nds.SignatureMatcher, 'match', fail)
+    assert sorted(rom.overlayFunctionNames('ARM9', cacheDir=cacheDir)) == expected
+    assert rom.overlayFunctionNames('ARM9', {0}, cacheDir) == [expected[0]]
+
+
+def test_analysisPlanRoundTrip(overlayRom):
+    plan = overlayRom.analysisPlan('ARM9')
+    overlayRom.overlayFunctionNames('ARM9')
+    assert len(plan.overlayNames) == 2
+
+    loaded = nds.AnalysisPlan.fromBytes(plan.toBytes(b'key'), b'key')
+    assert loaded.sections == plan.sections
+    assert loaded.refs == plan.refs
+    assert loaded.thumbFunctions == plan.thumbFunctions
+    assert loaded.names == plan.names
+    assert loaded.overlayNames == plan.overlayNames
+    assert nds.AnalysisPlan.fromBytes(plan.toBytes(b'key'), b'other') is None
+
+
+def test_divRemMatchesOnlyMovR0R1():
+    matcher = nds.SignatureMatcher(nds.SDK_SIGNATURES)
+    data = withSignature(bytes(0x40), 0x10, bytes.fromhex('09DF081C7047'))
+    assert matcher.match(data, 0x02000000) == [(0x02000010, 'SVC_DivRem', True)]
+    data = withSignature(bytes(0x40), 0x10, bytes.fromhex('09DF12347047'))
+    assert matcher.match(data, 0x02000000) == []
+
+
+def test_trustedNamesDropsShortWildcardSignatures():
+    signatures = [
+        ('Short', 'thumb', '01 DF ?? ?? 70 47'),
+        ('Long', 'arm', '00 00 A0 E1 ?? ?? ?? ?? 1E FF 2F E1 04 00 90 E5'),
+        ('Both', 'thumb', '02 DF ?? 70 47'),
+        ('Both', 'thumb', '02 DF 00 20 70 47'),
+    ]
+    names = [(0x10, 'Short', True), (0x20, 'Long', False), (0x30, 'Both', True)]
+    assert nds.trustedNames(names, signatures) == names[1:]